@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import math
+import threading
+import time
+
+
+class RateLimiter:
+    """A token bucket per key (e.g. per peer or per voter).
+
+    Attributes:
+        :rate: Tokens added per second.
+        :burst: The maximum number of tokens a bucket holds.
+        :max_keys: Buckets kept at most; the least recently used go first.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.__buckets = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def acquire(self, key, take=True):
+        """Takes a token for the key. Returns 0 on success, the seconds until
+        a token is available otherwise.
+
+        Arguments:
+            :key: The key whose bucket is used.
+            :take: False only checks whether a token is available.
+        """
+        now = time.time()
+        with self.__lock:
+            tokens, updated = self.__buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                if take:
+                    tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+            self.__buckets[key] = (tokens, now)
+            while len(self.__buckets) > self.max_keys:
+                self.__buckets.popitem(last=False)
+        return wait
+
+
+class AdmissionControl:
+    """Decides whether a submission may enter the open submissions before
+    any signature or balance is checked, so a saturated node turns requests
+    away cheaply instead of stalling.
+
+    Attributes:
+        :max_submissions: The maximum number of open submissions.
+        :max_bytes: The maximum (estimated) size of all open submissions.
+        :retry_after: Seconds clients are asked to wait while the pool is
+        full.
+        :peer_limiter: Rate limit per peer address (None: unlimited).
+        :voter_limiter: Rate limit per voter key (None: unlimited). Voter
+        keys are public, so only accepted submissions are charged to it
+        (see record_accepted); otherwise anyone could send junk under a
+        voter's key and keep the voter locked out.
+    """
+
+    def __init__(self, max_submissions=5000, max_bytes=8 * 1024 * 1024,
+                 peer_rate=50.0, peer_burst=100, voter_rate=0.2,
+                 voter_burst=3, retry_after=10):
+        self.max_submissions = max_submissions
+        self.max_bytes = max_bytes
+        self.retry_after = retry_after
+        self.peer_limiter = (RateLimiter(peer_rate, peer_burst)
+                             if peer_rate else None)
+        self.voter_limiter = (RateLimiter(voter_rate, voter_burst)
+                              if voter_rate else None)
+        self.rejected = 0
+
+    @staticmethod
+    def size_of(voter, candidate, signature):
+        """Estimates the bytes a submission takes in the pool."""
+        return len(voter) + len(candidate) + len(signature) + 64
+
+    def has_room(self, pool_count, pool_bytes, size):
+        """Checks the pool limits only.
+
+        Arguments:
+            :pool_count: The number of open submissions.
+            :pool_bytes: The estimated size of the open submissions.
+            :size: The estimated size of the new submission.
+        """
+        return (pool_count < self.max_submissions and
+                pool_bytes + size <= self.max_bytes)
+
+    def check(self, pool_count, pool_bytes, voter, candidate, signature,
+              peer=None):
+        """Returns None if a submission is admitted, (retry after seconds,
+        reason) otherwise.
+
+        Arguments:
+            :pool_count: The number of open submissions.
+            :pool_bytes: The estimated size of the open submissions.
+            :voter: The voter of the submission.
+            :candidate: The candidate of the submission.
+            :signature: The signature of the submission.
+            :peer: The address of the peer which sent it (None if local).
+        """
+        rejection = None
+        size = self.size_of(voter, candidate, signature)
+        if not self.has_room(pool_count, pool_bytes, size):
+            rejection = (self.retry_after, 'Submission pool is full.')
+        elif peer is not None and self.peer_limiter is not None:
+            wait = self.peer_limiter.acquire(peer)
+            if wait:
+                rejection = (wait, 'Too many submissions from this peer.')
+        if rejection is None and self.voter_limiter is not None:
+            wait = self.voter_limiter.acquire(voter, take=False)
+            if wait:
+                rejection = (wait, 'Too many submissions from this voter.')
+        if rejection is None:
+            return None
+        self.rejected += 1
+        return int(math.ceil(rejection[0])), rejection[1]
+
+    def record_accepted(self, voter):
+        """Charges a submission whose signature and balance were verified
+        to its voter's rate limit."""
+        if self.voter_limiter is not None:
+            self.voter_limiter.acquire(voter)
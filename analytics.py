@@ -0,0 +1,345 @@
+"""Builds columnar (NumPy) views of the chain for election statistics.
+
+Every submission on the chain becomes one row of a set of arrays: the bloc
+index, the bloc timestamp, the day zero countdown, the amount and the voter
+and candidate as integer codes (see KeyDictionary). The reports below work
+on whole columns instead of looping over Bloc and Submission objects. The
+columns only grow by the blocs appended since the last sync, so keeping them
+up to date is cheap.
+
+The reports of a running node are served by GET /stats; they can also be
+built from the outside by polling a node's /bloc/<index> endpoint:
+
+    python analytics.py --node localhost:8105 --report turnout --watch 30
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+import json
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+import requests
+
+from bloc import Bloc
+from submission import Submission
+from utility.hash_util import hash_bloc
+
+# The voter of the submissions which grant the right to vote
+STATION = 'STATION'
+SECONDS_PER_DAY = 86400
+
+
+class KeyDictionary:
+    """Maps keys (public keys, 'STATION') to consecutive integer codes.
+
+    Attributes:
+        :keys: The keys, the position of a key is its code.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.__codes = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def code(self, key):
+        """Returns the code of a key, adding the key if it is new."""
+        code = self.__codes.get(key)
+        if code is None:
+            code = len(self.keys)
+            self.__codes[key] = code
+            self.keys.append(key)
+        return code
+
+    def lookup(self, key):
+        """Returns the code of a key or None if it never occurred."""
+        return self.__codes.get(key)
+
+
+class ChainColumns:
+    """The submissions of a chain as NumPy arrays, one row per submission.
+
+    Attributes:
+        :keys: The KeyDictionary of the voter and candidate columns.
+        :rows: The number of filled rows.
+    """
+
+    COLUMNS = (
+        ('bloc', 'int64'),
+        ('timestamp', 'float64'),
+        ('zero', 'float64'),
+        ('amount', 'int64'),
+        ('voter', 'int32'),
+        ('candidate', 'int32')
+    )
+
+    def __init__(self, capacity=1024):
+        if np is None:
+            raise ImportError('The chain statistics need NumPy '
+                              '(pip install numpy).')
+        self.keys = KeyDictionary()
+        self.rows = 0
+        self.__data = {name: np.empty(capacity, dtype=dtype)
+                       for name, dtype in self.COLUMNS}
+        # Hash of every bloc seen so far, to notice a replaced chain
+        self.__hashes = []
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        """Returns the number of blocs in the columns."""
+        return len(self.__hashes)
+
+    def column(self, name):
+        """Returns the filled part of a column (a view, not a copy)."""
+        return self.__data[name][:self.rows]
+
+    def tip_hash(self):
+        """Returns the hash of the last bloc (or None)."""
+        return self.__hashes[-1] if self.__hashes else None
+
+    def __reserve(self, rows):
+        capacity = len(self.__data['bloc'])
+        if rows <= capacity:
+            return
+        while capacity < rows:
+            capacity *= 2
+        for name, values in self.__data.items():
+            grown = np.empty(capacity, dtype=values.dtype)
+            grown[:self.rows] = values[:self.rows]
+            self.__data[name] = grown
+
+    def __append(self, bloc):
+        count = len(bloc.submissions)
+        self.__reserve(self.rows + count)
+        end = self.rows + count
+        self.__data['bloc'][self.rows:end] = bloc.index
+        self.__data['timestamp'][self.rows:end] = bloc.timestamp
+        self.__data['zero'][self.rows:end] = [
+            tx.zero for tx in bloc.submissions]
+        self.__data['amount'][self.rows:end] = [
+            tx.amount for tx in bloc.submissions]
+        self.__data['voter'][self.rows:end] = [
+            self.keys.code(tx.voter) for tx in bloc.submissions]
+        self.__data['candidate'][self.rows:end] = [
+            self.keys.code(tx.candidate) for tx in bloc.submissions]
+        self.rows = end
+        self.__hashes.append(hash_bloc(bloc))
+
+    def __truncate(self, height):
+        # The bloc column is sorted, so the cut is a binary search
+        self.rows = int(np.searchsorted(self.column('bloc'), height))
+        del self.__hashes[height:]
+
+    def append(self, bloc):
+        """Adds a bloc on top of the ones in the columns.
+
+        Arguments:
+            :bloc: The bloc (a Bloc object).
+        """
+        with self.__lock:
+            self.__append(bloc)
+
+    def truncate(self, height):
+        """Drops the rows of all blocs from the given height onwards.
+
+        Arguments:
+            :height: The number of blocs which are kept.
+        """
+        with self.__lock:
+            self.__truncate(height)
+
+    def sync(self, chain):
+        """Makes the columns match a chain, keeping the common prefix and
+        appending the new blocs only.
+
+        Arguments:
+            :chain: The list of blocs.
+        """
+        with self.__lock:
+            height = min(len(self.__hashes), len(chain))
+            while height > 0 and self.__hashes[height - 1] != hash_bloc(
+                    chain[height - 1]):
+                height -= 1
+            if height < len(self.__hashes):
+                self.__truncate(height)
+            for bloc in chain[height:]:
+                self.__append(bloc)
+
+
+def _vote_rows(columns):
+    """Returns a mask of the rows which are votes (not window grants)."""
+    station = columns.keys.lookup(STATION)
+    if station is None:
+        return np.ones(columns.rows, dtype=bool)
+    return columns.column('voter') != station
+
+
+def _day(day_number):
+    return datetime.fromtimestamp(
+        day_number * SECONDS_PER_DAY, timezone.utc).strftime('%Y-%m-%d')
+
+
+def summary(columns):
+    """Returns the size of the chain and the number of votes, voters and
+    candidates."""
+    votes = _vote_rows(columns)
+    return {
+        'blocs': len(columns),
+        'submissions': columns.rows,
+        'votes': int(columns.column('amount')[votes].sum()),
+        'voters': int(np.unique(columns.column('voter')[votes]).size),
+        'candidates': int(np.unique(columns.column('candidate')[votes]).size)
+    }
+
+
+def votes_per_candidate(columns):
+    """Returns the votes of every candidate."""
+    votes = _vote_rows(columns)
+    totals = np.bincount(columns.column('candidate')[votes],
+                         weights=columns.column('amount')[votes],
+                         minlength=len(columns.keys))
+    return {columns.keys.keys[code]: int(totals[code])
+            for code in np.flatnonzero(totals)}
+
+
+def turnout_per_day(columns):
+    """Returns the number of distinct voters and the votes cast per (UTC)
+    day."""
+    votes = _vote_rows(columns)
+    days = (columns.column('timestamp')[votes] // SECONDS_PER_DAY).astype(
+        'int64')
+    if not days.size:
+        return []
+    first = days.min()
+    offsets = days - first
+    voters = columns.column('voter')[votes].astype('int64')
+    # One entry per (day, voter) pair
+    pairs = np.unique(offsets * len(columns.keys) + voters)
+    distinct = np.bincount(pairs // len(columns.keys))
+    cast = np.bincount(offsets, weights=columns.column('amount')[votes])
+    return [{'day': _day(first + offset),
+             'voters': int(distinct[offset]),
+             'votes': int(cast[offset])}
+            for offset in np.flatnonzero(np.bincount(offsets))]
+
+
+def votes_over_time(columns, interval=SECONDS_PER_DAY):
+    """Returns the cumulative votes of every candidate at the end of each
+    interval in which votes were cast.
+
+    Arguments:
+        :interval: The length of an interval in seconds.
+    """
+    votes = _vote_rows(columns)
+    slots = (columns.column('timestamp')[votes] // interval).astype('int64')
+    if not slots.size:
+        return {'interval': interval, 'ends': [], 'candidates': {}}
+    used, slot_positions = np.unique(slots, return_inverse=True)
+    candidates, candidate_positions = np.unique(
+        columns.column('candidate')[votes], return_inverse=True)
+    counts = np.zeros((candidates.size, used.size))
+    np.add.at(counts, (candidate_positions, slot_positions),
+              columns.column('amount')[votes])
+    cumulative = counts.cumsum(axis=1).astype('int64')
+    return {
+        'interval': interval,
+        'ends': ((used + 1) * interval).tolist(),
+        'candidates': {columns.keys.keys[code]: cumulative[row].tolist()
+                       for row, code in enumerate(candidates)}
+    }
+
+
+def station_grants(columns):
+    """Returns the window submissions of every mined bloc: which station
+    sealed it and whether it granted the right to vote."""
+    station = columns.keys.lookup(STATION)
+    if station is None:
+        return []
+    rows = np.flatnonzero(columns.column('voter') == station)
+    blocs = columns.column('bloc')[rows].tolist()
+    timestamps = columns.column('timestamp')[rows].tolist()
+    zeros = columns.column('zero')[rows].tolist()
+    stations = columns.column('candidate')[rows].tolist()
+    granted = (columns.column('amount')[rows] > 0).tolist()
+    return [{'bloc': blocs[i],
+             'timestamp': timestamps[i],
+             'zero': zeros[i],
+             'station': columns.keys.keys[stations[i]],
+             'granted': granted[i]} for i in range(len(rows))]
+
+
+REPORTS = {
+    'summary': summary,
+    'candidates': votes_per_candidate,
+    'turnout': turnout_per_day,
+    'timeline': votes_over_time,
+    'grants': station_grants
+}
+
+
+def build_reports(columns, names=None):
+    """Runs the named reports (all by default) and returns their results.
+
+    Arguments:
+        :names: The report names (keys of REPORTS).
+    """
+    return {name: REPORTS[name](columns) for name in (names or REPORTS)}
+
+
+def fetch_new_blocs(columns, node, timeout=10.0):
+    """Appends the blocs a node has beyond the ones in the columns (stepping
+    back if the node replaced part of its chain) and returns their number.
+
+    Arguments:
+        :node: The node address (host:port).
+        :timeout: Seconds to wait for each request.
+    """
+    added = 0
+    while True:
+        url = 'http://{}/bloc/{}'.format(node, len(columns))
+        response = requests.get(url, timeout=timeout)
+        if response.status_code == 404:
+            return added
+        response.raise_for_status()
+        bloc = response.json()
+        if len(columns) and bloc['previous_hash'] != columns.tip_hash():
+            columns.truncate(len(columns) - 1)
+            continue
+        columns.append(Bloc(
+            bloc['index'],
+            bloc['previous_hash'],
+            [Submission(
+                tx['voter'],
+                tx['candidate'],
+                tx['zero'],
+                tx['signature'],
+                tx['amount']) for tx in bloc['submissions']],
+            bloc['proof'],
+            bloc['timestamp'],
+            bloc.get('difficulty')))
+        added += 1
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--node', default='localhost:8105')
+    parser.add_argument('--report', nargs='+', choices=sorted(REPORTS),
+                        default=None, help='the reports (default: all)')
+    parser.add_argument('--watch', type=float, default=None,
+                        help='poll for new blocs every WATCH seconds')
+    args = parser.parse_args()
+
+    chain_columns = ChainColumns()
+    while True:
+        fetch_new_blocs(chain_columns, args.node)
+        print(json.dumps(build_reports(chain_columns, args.report),
+                         indent=2, sort_keys=True))
+        if args.watch is None:
+            break
+        time.sleep(args.watch)
@@ -0,0 +1,173 @@
+import hashlib as hl
+import json
+import lzma
+import os
+import zlib
+
+from bloc import Bloc
+from submission import Submission
+from utility.hash_util import hash_bloc
+
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 9), zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress)
+}
+
+
+class ArchiveError(IOError):
+    """Raised when a segment is missing or doesn't match its checksum."""
+
+
+class SegmentArchive:
+    """Stores finalised blocs in immutable, compressed segment files so only
+    the recent tail of the chain has to be rewritten on every save.
+
+    The directory holds one file per segment (a compressed JSON list of
+    blocs) and an index.json listing every segment with its bloc range, the
+    hash of its last bloc and the SHA256 of the compressed file.
+
+    Attributes:
+        :directory: The directory of the segment files.
+        :segment_size: The number of blocs per segment.
+        :codec: The compression used for new segments ('zlib' or 'lzma').
+    """
+
+    def __init__(self, directory, segment_size=100, codec='zlib'):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.codec = codec
+        self.__index_path = os.path.join(directory, 'index.json')
+        try:
+            with open(self.__index_path, mode='r') as f:
+                self.segments = json.load(f)
+        except (IOError, ValueError):
+            self.segments = []
+
+    def __len__(self):
+        """Returns the number of archived blocs."""
+        if not self.segments:
+            return 0
+        return self.segments[-1]['last'] + 1
+
+    def __write_index(self):
+        temporary_path = self.__index_path + '.tmp'
+        with open(temporary_path, mode='w') as f:
+            json.dump(self.segments, f)
+        os.replace(temporary_path, self.__index_path)
+
+    def tip_hash(self):
+        """Returns the hash of the last archived bloc (or None)."""
+        return self.segments[-1]['tip_hash'] if self.segments else None
+
+    def append_segment(self, blocs):
+        """Archives blocs which directly follow the archived ones.
+
+        Arguments:
+            :blocs: The Bloc objects of the new segment.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        first = len(self)
+        saveable_blocs = []
+        for bloc in blocs:
+            dict_bloc = bloc.__dict__.copy()
+            dict_bloc['submissions'] = [
+                tx.__dict__ for tx in dict_bloc['submissions']]
+            saveable_blocs.append(dict_bloc)
+        compress = CODECS[self.codec][0]
+        data = compress(json.dumps(saveable_blocs).encode())
+        file_name = 'seg-{:08d}.{}'.format(first, self.codec)
+        temporary_path = os.path.join(self.directory, file_name + '.tmp')
+        with open(temporary_path, mode='wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, os.path.join(self.directory, file_name))
+        self.segments.append({
+            'first': first,
+            'last': first + len(blocs) - 1,
+            'file': file_name,
+            'codec': self.codec,
+            'bytes': len(data),
+            'sha256': hl.sha256(data).hexdigest(),
+            'tip_hash': hash_bloc(blocs[-1])
+        })
+        self.__write_index()
+
+    def truncate(self, height):
+        """Drops every segment which holds a bloc at or above the given
+        height (segments are never rewritten partially).
+
+        Arguments:
+            :height: The number of blocs which should stay valid.
+        """
+        kept = [segment for segment in self.segments
+                if segment['last'] < height]
+        for segment in self.segments[len(kept):]:
+            try:
+                os.remove(os.path.join(self.directory, segment['file']))
+            except OSError:
+                pass
+        self.segments = kept
+        self.__write_index()
+
+    def read_segment(self, segment):
+        """Returns the blocs (as dictionaries) of a segment after checking its
+        checksum.
+
+        Arguments:
+            :segment: The entry of the segment in the index.
+        """
+        try:
+            with open(os.path.join(self.directory, segment['file']),
+                      mode='rb') as f:
+                data = f.read()
+        except IOError as e:
+            raise ArchiveError(str(e))
+        if hl.sha256(data).hexdigest() != segment['sha256']:
+            raise ArchiveError('Checksum mismatch in {}'.format(
+                segment['file']))
+        return json.loads(CODECS[segment['codec']][1](data).decode())
+
+    def iter_blocs(self):
+        """Yields the archived blocs (Bloc objects) in order, reading one
+        segment at a time."""
+        for segment in self.segments:
+            for bloc in self.read_segment(segment):
+                yield Bloc(
+                    bloc['index'],
+                    bloc['previous_hash'],
+                    [Submission(
+                        tx['voter'],
+                        tx['candidate'],
+                        tx['zero'],
+                        tx['signature'],
+                        tx['amount']) for tx in bloc['submissions']],
+                    bloc['proof'],
+                    bloc['timestamp'],
+                    bloc.get('difficulty'))
+
+    def roll(self, chain, hot_blocs):
+        """Archives full segments of the chain which are older than the hot
+        tail and drops segments which no longer match the chain. Returns the
+        number of archived blocs.
+
+        Arguments:
+            :chain: The complete list of blocs.
+            :hot_blocs: The number of recent blocs which stay unarchived.
+        """
+        archived = len(self)
+        if archived and (archived > len(chain) or
+                         self.tip_hash() != hash_bloc(chain[archived - 1])):
+            # The chain was replaced below the archived blocs
+            while self.segments and (
+                    self.segments[-1]['last'] >= len(chain) or
+                    self.segments[-1]['tip_hash'] != hash_bloc(
+                        chain[self.segments[-1]['last']])):
+                self.truncate(self.segments[-1]['first'])
+            archived = len(self)
+        while len(chain) - archived >= hot_blocs + self.segment_size:
+            self.append_segment(
+                chain[archived:archived + self.segment_size])
+            archived = len(self)
+        return archived
@@ -1,8 +1,68 @@
-from Crypto.PublicKey import RSA
-from Crypto.Signature import PKCS1_v1_5
-from Crypto.Hash import SHA256
-import Crypto.Random
 import binascii
+from collections import OrderedDict
+import hashlib as hl
+import logging
+import threading
+
+from utility.tracing import traced
+
+logger = logging.getLogger(__name__)
+
+
+class VerifiedCache:
+    """Remembers the submissions whose signature was verified successfully,
+    so the RSA check isn't repeated when the same submission is verified
+    again (when mining, when it is broadcast back, ...). Only successes are
+    stored; the least recently used entries are dropped first.
+
+    Attributes:
+        :max_entries: The number of submissions remembered (0 disables
+        the cache, e.g. to measure the RSA checks themselves).
+        :hits: Verifications answered from the cache.
+        :misses: Verifications which needed the RSA check.
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def key(submission):
+        """Returns the digest of everything the verification depends on."""
+        return hl.sha256('|'.join([
+            str(submission.voter), str(submission.candidate),
+            str(submission.zero), str(submission.amount),
+            str(submission.signature)]).encode('utf8')).digest()
+
+    def __contains__(self, key):
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key):
+        """Records a successful verification."""
+        with self.__lock:
+            self.__entries[key] = True
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def get_stats(self):
+        """Returns the size and the hit counters of the cache."""
+        with self.__lock:
+            return {'entries': len(self.__entries), 'hits': self.hits,
+                    'misses': self.misses}
+
+
+# The cache shared by all verifications of this process
+verified_signatures = VerifiedCache()
 
 
 class Ballot:
@@ -30,7 +90,7 @@ class Ballot:
                     f.write(self.private_key)
                 return True
             except (IOError, IndexError):
-                print('Saving ballot failed...')
+                logger.error('Saving ballot failed...')
                 return False
 
     def load_keys(self):
@@ -44,11 +104,14 @@ class Ballot:
                 self.private_key = private_key
             return True
         except (IOError, IndexError):
-            print('Loading ballot failed...')
+            logger.error('Loading ballot failed...')
             return False
 
     def generate_keys(self):
         """Generate a new pair of private and public key."""
+        # pycryptodome is slow to import, load it when it is first needed
+        from Crypto.PublicKey import RSA
+        import Crypto.Random
         private_key = RSA.generate(1024, Crypto.Random.new().read)
         public_key = private_key.publickey()
         return (
@@ -60,6 +123,7 @@ class Ballot:
             .decode('ascii')
         )
 
+    @traced('Ballot.sign_submission')
     def sign_submission(self, voter, candidate, zero, amount):
         """Sign a submission and return the signature.
 
@@ -68,22 +132,72 @@ class Ballot:
             :candidate: The candidate for the submission.
             :amount: The votes in the submission.
         """
+        from Crypto.PublicKey import RSA
+        from Crypto.Signature import PKCS1_v1_5
         signer = PKCS1_v1_5.new(RSA.importKey(
             binascii.unhexlify(self.private_key)))
-        h = SHA256.new((str(voter) + str(candidate) + str(zero) +
-                        str(amount)).encode('utf8'))
+        h = Ballot.__digest(voter, candidate, zero, amount)
         signature = signer.sign(h)
         return binascii.hexlify(signature).decode('ascii')
 
     @staticmethod
+    @traced('Ballot.verify_submission')
     def verify_submission(submission):
         """Verify the signature of a submission.
 
         Arguments:
             :submission: The submission that should be verified.
         """
+        key = VerifiedCache.key(submission)
+        if key in verified_signatures:
+            return True
+        from Crypto.PublicKey import RSA
+        from Crypto.Signature import PKCS1_v1_5
         public_key = RSA.importKey(binascii.unhexlify(submission.voter))
         verifier = PKCS1_v1_5.new(public_key)
-        h = SHA256.new((str(submission.voter) + str(submission.candidate) + str(submission.zero) +
-                        str(submission.amount)).encode('utf8'))
-        return verifier.verify(h, binascii.unhexlify(submission.signature))
+        h = Ballot.__digest(submission.voter, submission.candidate,
+                            submission.zero, submission.amount)
+        valid = verifier.verify(h, binascii.unhexlify(submission.signature))
+        if valid:
+            verified_signatures.add(key)
+        return valid
+
+    @staticmethod
+    def verify_submissions(submissions):
+        """Verify the signatures of a batch of submissions, importing the
+        key of every voter only once. Returns False as soon as one signature
+        is invalid.
+
+        Arguments:
+            :submissions: The submissions that should be verified.
+        """
+        from Crypto.PublicKey import RSA
+        from Crypto.Signature import PKCS1_v1_5
+        verifiers = {}
+        for submission in submissions:
+            key = VerifiedCache.key(submission)
+            if key in verified_signatures:
+                continue
+            verifier = verifiers.get(submission.voter)
+            try:
+                if verifier is None:
+                    verifier = PKCS1_v1_5.new(RSA.importKey(
+                        binascii.unhexlify(submission.voter)))
+                    verifiers[submission.voter] = verifier
+                h = Ballot.__digest(submission.voter, submission.candidate,
+                                    submission.zero, submission.amount)
+                if not verifier.verify(
+                        h, binascii.unhexlify(submission.signature)):
+                    return False
+                verified_signatures.add(key)
+            except (ValueError, IndexError, TypeError, binascii.Error):
+                # Not a key or not a signature at all
+                return False
+        return True
+
+    @staticmethod
+    def __digest(voter, candidate, zero, amount):
+        """Returns the SHA256 hash object which is signed."""
+        from Crypto.Hash import SHA256
+        return SHA256.new((str(voter) + str(candidate) + str(zero) +
+                           str(amount)).encode('utf8'))
@@ -0,0 +1,120 @@
+"""Compares the disk footprint and read throughput of the plain JSON chain
+in the data file with compressed archive segments:
+
+    python -m benchmarks.archive_bench --blocs 2000 --submissions 20
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import random
+import tempfile
+import time
+
+from archive import SegmentArchive
+from bloc import Bloc
+from submission import Submission
+
+
+def synthetic_chain(blocs, submissions, candidates, seed):
+    """Builds a chain shaped like a real one (hex keys and signatures of
+    the same length, a STATION submission per bloc). The proofs are not
+    valid; nothing is verified here."""
+    rng = random.Random(seed)
+
+    def hex_string(length):
+        return '%0*x' % (length, rng.getrandbits(length * 4))
+
+    candidate_keys = [hex_string(324) for _ in range(candidates)]
+    miner_key = hex_string(324)
+    chain = [Bloc(0, '', [], 86400, 1577836799)]
+    for index in range(1, blocs):
+        txs = [Submission(hex_string(324), rng.choice(candidate_keys),
+                          -200.0, hex_string(256), 1)
+               for _ in range(submissions)]
+        txs.append(Submission('STATION', miner_key, -200.0, '', 0))
+        chain.append(Bloc(index, hex_string(64), txs, rng.randint(0, 999),
+                          1577836799 + index * 600))
+    return chain
+
+
+def plain_json(chain):
+    dict_chain = []
+    for bloc in chain:
+        dict_bloc = bloc.__dict__.copy()
+        dict_bloc['submissions'] = [
+            tx.__dict__ for tx in dict_bloc['submissions']]
+        dict_chain.append(dict_bloc)
+    return json.dumps(dict_chain)
+
+
+def measure_plain(chain, directory):
+    path = os.path.join(directory, 'chain.bit')
+    started = time.time()
+    with open(path, mode='w') as f:
+        f.write(plain_json(chain))
+    write_seconds = time.time() - started
+    started = time.time()
+    with open(path, mode='r') as f:
+        # Build the objects like Blocchain.load_data does
+        blocs = len([
+            Bloc(bloc['index'],
+                 bloc['previous_hash'],
+                 [Submission(tx['voter'], tx['candidate'], tx['zero'],
+                             tx['signature'], tx['amount'])
+                  for tx in bloc['submissions']],
+                 bloc['proof'],
+                 bloc['timestamp'],
+                 bloc.get('difficulty')) for bloc in json.loads(f.read())])
+    read_seconds = time.time() - started
+    return {
+        'bytes': os.path.getsize(path),
+        'write_seconds': write_seconds,
+        'read_seconds': read_seconds,
+        'read_blocs_per_second': blocs / read_seconds
+    }
+
+
+def measure_archive(chain, directory, codec, segment_size):
+    archive = SegmentArchive(os.path.join(directory, codec), segment_size,
+                             codec)
+    started = time.time()
+    archive.roll(chain, 0)
+    write_seconds = time.time() - started
+    size = sum(segment['bytes'] for segment in archive.segments)
+    started = time.time()
+    blocs = sum(1 for _ in archive.iter_blocs())
+    read_seconds = time.time() - started
+    return {
+        'bytes': size,
+        'segments': len(archive.segments),
+        'archived_blocs': blocs,
+        'write_seconds': write_seconds,
+        'read_seconds': read_seconds,
+        'read_blocs_per_second': blocs / read_seconds
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--blocs', type=int, default=2000)
+    parser.add_argument('--submissions', type=int, default=20,
+                        help='submissions per bloc')
+    parser.add_argument('--candidates', type=int, default=5)
+    parser.add_argument('--segment-size', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    chain = synthetic_chain(args.blocs, args.submissions, args.candidates,
+                            args.seed)
+    # Only whole segments are archived
+    archivable = len(chain) - len(chain) % args.segment_size
+    with tempfile.TemporaryDirectory() as directory:
+        plain = measure_plain(chain[:archivable], directory)
+        report = {'blocs': archivable, 'plain_json': plain}
+        for codec in ('zlib', 'lzma'):
+            result = measure_archive(chain[:archivable], directory, codec,
+                                     args.segment_size)
+            result['ratio'] = plain['bytes'] / result['bytes']
+            report[codec] = result
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,109 @@
+"""Measures the speed-up of the parallel chain verification over the serial
+one on a valid synthetic chain (real proofs and signatures):
+
+    python -m benchmarks.verify_bench --blocs 2000 --submissions 10 \\
+        --workers 1 2 4 8
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import random
+import time
+
+from ballot import Ballot, verified_signatures
+from bloc import Bloc
+from submission import Submission
+from utility.hash_util import hash_bloc, hash_string_256
+from utility.verification import (PARALLEL_MIN_BLOCS, RETARGET_INTERVAL,
+                                  TARGET_INTERVAL, Verification)
+
+
+def valid_chain(blocs, submissions, voters, candidates, seed):
+    """Builds a chain which passes verify_chain with signature checks. The
+    voters' keys are reused, so only a few signatures are computed."""
+    rng = random.Random(seed)
+    ballots = []
+    for number in range(voters):
+        ballot = Ballot(number)
+        ballot.create_keys()
+        ballots.append(ballot)
+    candidate_keys = [ballot.public_key for ballot in ballots[:candidates]]
+    signatures = {}
+    chain = [Bloc(0, '', [], 86400, 1577836799)]
+    for index in range(1, blocs):
+        txs = []
+        for _ in range(submissions):
+            ballot = rng.choice(ballots)
+            candidate = rng.choice(candidate_keys)
+            key = (ballot.public_key, candidate)
+            if key not in signatures:
+                signatures[key] = ballot.sign_submission(
+                    ballot.public_key, candidate, -200.0, 1)
+            txs.append(Submission(ballot.public_key, candidate, -200.0,
+                                  signatures[key], 1))
+        last_hash = hash_bloc(chain[-1])
+        difficulty = Verification.next_difficulty(chain[-RETARGET_INTERVAL:])
+        # The same guess as Verification.valid_proof, built once per bloc
+        prefix = str([tx.to_ordered_dict() for tx in txs]) + str(last_hash)
+        proof = 0
+        while int(hash_string_256((prefix + str(proof)).encode()),
+                  16) >> (256 - difficulty):
+            proof += 1
+        txs.append(Submission('STATION', candidate_keys[0], -200.0, '', 0))
+        # Blocs on the target interval keep the difficulty where it is
+        chain.append(Bloc(index, last_hash, txs, proof,
+                          1577836799 + index * TARGET_INTERVAL, difficulty))
+    return chain
+
+
+def measure(chain, workers, check_signatures, repeat):
+    # Start the pool before timing, it is shared by later verifications
+    # (shorter chains are verified in-process and wouldn't start it)
+    if workers > 1:
+        Verification.verify_chain(chain[:PARALLEL_MIN_BLOCS],
+                                  workers=workers)
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        valid = Verification.verify_chain(chain, check_signatures, workers)
+        seconds = time.time() - started
+        if not valid:
+            raise RuntimeError('The benchmark chain is invalid')
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--blocs', type=int, default=2000)
+    parser.add_argument('--submissions', type=int, default=10,
+                        help='submissions per bloc')
+    parser.add_argument('--voters', type=int, default=20)
+    parser.add_argument('--candidates', type=int, default=3)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # Measure the RSA checks, not lookups of signatures verified before
+    # (the worker pools copy this setting when they start)
+    verified_signatures.max_entries = 0
+    chain = valid_chain(args.blocs, args.submissions, args.voters,
+                        args.candidates, args.seed)
+    report = {'blocs': len(chain), 'cpus': os.cpu_count()}
+    for check_signatures in (False, True):
+        serial = measure(chain, 1, check_signatures, args.repeat)
+        curve = []
+        for workers in args.workers:
+            seconds = (serial if workers == 1 else
+                       measure(chain, workers, check_signatures,
+                               args.repeat))
+            curve.append({
+                'workers': workers,
+                'seconds': seconds,
+                'speedup': serial / seconds
+            })
+        report['signatures' if check_signatures else 'links'] = curve
+    print(json.dumps(report, indent=2))
@@ -1,4 +1,4 @@
-from time import time
+from time import time as current_time
 
 from utility.printable import Printable
 
@@ -9,15 +9,20 @@ class Bloc(Printable):
     Attributes:
         :index: The index of this bloc.
         :previous_hash: The hash of the previous bloc in the blocchain.
-        :timestamp: The timestamp of the bloc (automatically generated by
+        :timestamp: The timestamp of the bloc (the current time by
         default).
         :submissions: A list of submission which are included in the bloc.
         :proof: The proof by vote number that yielded this bloc.
+        :difficulty: The leading zero bits the proof had to reach (None for
+        the genesis bloc only).
     """
 
-    def __init__(self, index, previous_hash, submissions, proof, time=time()):
+    def __init__(self, index, previous_hash, submissions, proof, time=None,
+                 difficulty=None):
         self.index = index
         self.previous_hash = previous_hash
-        self.timestamp = time
+        # The default is taken per bloc, not once when the module is loaded
+        self.timestamp = current_time() if time is None else time
         self.submissions = submissions
         self.proof = proof
+        self.difficulty = difficulty
@@ -1,22 +1,52 @@
+from collections import deque
 from functools import reduce
 import hashlib as hl
 
 import json
+import logging
+import os
 #import pickle
-import requests
+import threading
 import time
 
 # Import two functions from our hash_util.py file. Omit the ".py" in the import
 from utility.hash_util import hash_bloc
-from utility.verification import Verification
+from utility.tracing import traced
+from utility.transport import HttpTransport, PeerUnavailable
+from utility.verification import RETARGET_INTERVAL, Verification
+from admission import AdmissionControl
+from archive import ArchiveError, SegmentArchive
 from bloc import Bloc
+from blocstore import BlocStore
 from submission import Submission
 from ballot import Ballot
+from orphan_pool import OrphanPool
+from peers import PeerManager
+from persistence import PersistenceWorker
 
-# The rights given to voters(for adding a new bloc)
+# The rights given to voters(for adding a new bloc), the initial value of
+# Blocchain.vote_window
 VOTE_WINDOW = True
 
-print(__name__)
+# The genesis bloc: its timestamp is day zero (when voting ends) and its
+# proof the length of a day in seconds
+GENESIS_TIMESTAMP = 1577836799
+GENESIS_PROOF = 86400
+
+# Seconds to wait for a peer before it counts as failed
+PEER_TIMEOUT = 5.0
+# How many peers resolve asks for their chain (the healthiest first)
+RESOLVE_FANOUT = 3
+
+# How many blocs the local chain may be rolled back to switch to a heavier
+# branch without asking the peers for their full chains
+MAX_REORG_DEPTH = 6
+
+# How many recent blocs stay in the data file; older ones are rolled into
+# compressed archive segments
+HOT_BLOCS = 50
+
+logger = logging.getLogger(__name__)
 
 
 class Blocchain:
@@ -29,19 +59,66 @@ class Blocchain:
         :hosting_node: The connected node (which runs the blocchain).
     """
 
-    def __init__(self, public_key, node_id):
-        """The constructor of the Blocchain class."""
+    def __init__(self, public_key, node_id, transport=None, admission=None,
+                 peers=None, durability='sync', commit_window=0.01,
+                 commit_interval=1.0, genesis_timestamp=GENESIS_TIMESTAMP,
+                 genesis_proof=GENESIS_PROOF, url_prefix='', clock=time.time):
+        """The constructor of the Blocchain class.
+
+        Arguments:
+            :public_key: The key of the ballot running the node.
+            :node_id: The id (port) of the node, used for the data file.
+            :transport: Sends the requests to peer nodes (default: HTTP).
+            :admission: Limits the open submissions (default:
+            AdmissionControl()).
+            :peers: Keeps the peer nodes and their health (default:
+            PeerManager()).
+            :durability: When changes are written: 'sync', 'group' or
+            'periodic' (see PersistenceWorker).
+            :commit_window: Seconds a group commit waits for more changes.
+            :commit_interval: Seconds between periodic writes.
+            :genesis_timestamp: Day zero of the election.
+            :genesis_proof: The length of a voting day in seconds.
+            :url_prefix: The path of this chain's endpoints on the peers
+            (e.g. '/election/<name>' for a hosted election).
+            :clock: Returns the current time, for the timestamps of mined
+            blocs and the check of received ones (default: time.time).
+        """
         # Our starting bloc for the blocchain
-        genesis_bloc = Bloc(0, '', [], 86400, 1577836799)
+        genesis_bloc = Bloc(0, '', [], genesis_proof, genesis_timestamp)
         # Initializing our (empty) blocchain list
         self.chain = [genesis_bloc]
         # Unhandled submissions
         self.__open_submissions = []
+        # Estimated size of the open submissions
+        self.__open_bytes = 0
+        self.admission = admission or AdmissionControl()
         self.public_key = public_key
-        self.__peer_nodes = set()
+        self.__peer_nodes = peers if peers is not None else PeerManager()
         self.node_id = node_id
+        self.transport = transport or HttpTransport(timeout=PEER_TIMEOUT)
+        self.url_prefix = url_prefix
+        self.clock = clock
         self.resolve_conflicts = False
+        # Whether the next mined bloc grants the right to vote
+        self.vote_window = VOTE_WINDOW
+        # Blocs which arrived before their parent or belong to a side branch
+        self.__orphans = OrphanPool()
+        # Guards the chain and the open submissions, which are shared between
+        # the request threads and the background miner
+        self.__lock = threading.RLock()
+        # Callbacks which are told about new submissions and blocs
+        self.__listeners = []
+        # Finalised blocs, stored next to the data file
+        self.archive = SegmentArchive(
+            'blocchain-{}.segments'.format(node_id))
         self.load_data()
+        # Serialised blocs for lookups by height or hash
+        self.bloc_store = BlocStore('blocs-{}'.format(self.node_id))
+        self.bloc_store.sync(self.__chain)
+        # Writes the data file after changes (see save_data)
+        self.persistence = PersistenceWorker(
+            self.__write_data, durability, commit_window, commit_interval)
 
     # This turns the chain attribute into a property with a getter (the method
     # below) and a setter (@chain.setter)
@@ -53,11 +130,97 @@ class Blocchain:
     @chain.setter
     def chain(self, val):
         self.__chain = val
+        # Signatures of the submissions on the chain, to reject replays
+        # before any signature is checked
+        self.__signatures = set()
+        self.__index_signatures(val)
+
+    def __index_signatures(self, blocs, remove=False):
+        """Adds the signatures of blocs to the replay index (or removes the
+        ones of rolled back blocs)."""
+        for bloc in blocs:
+            for tx in bloc.submissions:
+                # Window grants are not signed
+                if not tx.signature:
+                    continue
+                if remove:
+                    self.__signatures.discard(tx.signature)
+                else:
+                    self.__signatures.add(tx.signature)
+
+    def is_replay(self, signature):
+        """Returns True if a submission with this signature is on the chain
+        already."""
+        return bool(signature) and signature in self.__signatures
 
     def get_open_submissions(self):
         """Returns a copy of the open submissions list."""
         return self.__open_submissions[:]
 
+    def __set_open_submissions(self, submissions):
+        self.__open_submissions = submissions
+        self.__open_bytes = sum(
+            self.admission.size_of(tx.voter, tx.candidate, tx.signature)
+            for tx in submissions)
+
+    def get_pool_usage(self):
+        """Returns the number and the estimated size (bytes) of the open
+        submissions."""
+        return len(self.__open_submissions), self.__open_bytes
+
+    def admit_submission(self, voter, candidate, signature, peer=None):
+        """Checks the pool limits and rate limits before a submission is
+        verified. Returns None if it may be added, (retry after seconds,
+        reason) otherwise.
+
+        Arguments:
+            :voter: The person voting.
+            :candidate: The candidate recieving the votes.
+            :signature: The signature of the submission.
+            :peer: The address of the peer which sent it (None if local).
+        """
+        count, size = self.get_pool_usage()
+        return self.admission.check(count, size, voter, candidate,
+                                    signature, peer)
+
+    def add_listener(self, callback):
+        """Registers a callback which is called as callback(event, data)
+        whenever the blocchain changes.
+
+        Events:
+            :submission: A submission was added to the open submissions
+            (data: {'submission': Submission}).
+            :bloc: A bloc was appended to the chain (data: {'bloc': Bloc,
+            'source': 'local' or 'peer'}).
+            :chain: The chain was replaced from bloc data['fork'] onwards.
+        """
+        self.__listeners.append(callback)
+
+    def remove_listener(self, callback):
+        """Removes a callback registered with add_listener."""
+        try:
+            self.__listeners.remove(callback)
+        except ValueError:
+            pass
+
+    def __notify(self, event, data):
+        for callback in self.__listeners[:]:
+            try:
+                callback(event, data)
+            except Exception as e:
+                logger.exception('Listener failed on %s: %s', event, e)
+
+    @staticmethod
+    def __fork_point(old_chain, new_chain):
+        """Returns the number of leading blocs both chains share."""
+        shared = min(len(old_chain), len(new_chain))
+        while shared > 0:
+            if hash_bloc(old_chain[shared - 1]) == hash_bloc(
+                    new_chain[shared - 1]):
+                break
+            shared -= 1
+        return shared
+
     def load_data(self):
         """Initialize blocchain + open submissions data from a file."""
         try:
@@ -82,8 +245,17 @@ class Blocchain:
                         bloc['previous_hash'],
                         converted_tx,
                         bloc['proof'],
-                        bloc['timestamp'])
+                        bloc['timestamp'],
+                        bloc.get('difficulty'))
                     updated_blocchain.append(updated_bloc)
+                if updated_blocchain and updated_blocchain[0].index > 0:
+                    # The older blocs were rolled into archive segments
+                    archived_blocchain = [
+                        bloc for bloc in self.archive.iter_blocs()
+                        if bloc.index < updated_blocchain[0].index]
+                    if len(archived_blocchain) != updated_blocchain[0].index:
+                        raise ArchiveError('Archived blocs are missing')
+                    updated_blocchain = archived_blocchain + updated_blocchain
                 self.chain = updated_blocchain
                 open_submissions = json.loads(file_content[1][:-1])
                 # We need to convert  the loaded data because submissions
@@ -97,18 +269,55 @@ class Blocchain:
                         tx['signature'],
                         tx['amount'])
                     updated_submissions.append(updated_submission)
-                self.__open_submissions = updated_submissions
+                self.__set_open_submissions(updated_submissions)
                 peer_nodes = json.loads(file_content[2])
-                self.__peer_nodes = set(peer_nodes)
+                # The health of the peers was added later on
+                peer_metadata = {}
+                if len(file_content) > 3:
+                    peer_metadata = json.loads(file_content[3])
+                for node in peer_nodes:
+                    self.__peer_nodes.add(node, peer_metadata.get(node))
+        except ArchiveError:
+            # Don't start with a short chain which would overwrite the data
+            # file on the next save
+            raise
         except (IOError, IndexError):
             pass
         finally:
-            print('Cleanup!')
+            logger.debug('Cleanup!')
 
     def save_data(self):
-        """Save blocchain + open submissions snapshot to a file."""
+        """Records a change of the chain, the open submissions or the peers.
+        Depending on the durability mode it is written right away or by the
+        persistence worker; returns the ticket to wait for (see
+        PersistenceWorker.wait).
+
+        The bloc store follows the chain right away, /bloc/<index> must not
+        serve blocs the chain dropped or miss the ones it gained until the
+        data file is written."""
+        with self.__lock:
+            try:
+                self.bloc_store.sync(self.__chain)
+            except IOError:
+                # It catches up on the next change (or the next start)
+                logger.error('Updating the bloc store failed!')
+        return self.persistence.request()
+
+    @traced('Blocchain.write_data')
+    def __write_data(self):
+        """Save blocchain + open submissions snapshot to a file. Returns
+        False if that failed."""
+        with self.__lock:
+            chain = self.__chain[:]
+            open_submissions = self.__open_submissions[:]
+            peer_nodes = self.__peer_nodes.nodes()
+            peer_metadata = self.__peer_nodes.get_metadata()
+        path = 'blocchain-{}.bit'.format(self.node_id)
         try:
-            with open('blocchain-{}.bit'.format(self.node_id), mode='w') as f:
+            archived = self.archive.roll(chain, HOT_BLOCS)
+            # Write a new file and swap it in, so a crash never leaves a
+            # half written data file behind
+            with open(path + '.tmp', mode='w') as f:
                 saveable_chain = [
                     bloc.__dict__ for bloc in
                     [
@@ -116,37 +325,75 @@ class Blocchain:
                               bloc_el.previous_hash,
                               [tx.__dict__ for tx in bloc_el.submissions],
                               bloc_el.proof,
-                              bloc_el.timestamp) for bloc_el in self.__chain
+                              bloc_el.timestamp,
+                              bloc_el.difficulty)
+                        for bloc_el in chain[archived:]
                     ]
                 ]
                 f.write(json.dumps(saveable_chain))
                 f.write('\n')
-                saveable_tx = [tx.__dict__ for tx in self.__open_submissions]
+                saveable_tx = [tx.__dict__ for tx in open_submissions]
                 f.write(json.dumps(saveable_tx))
                 f.write('\n')
-                f.write(json.dumps(list(self.__peer_nodes)))
+                f.write(json.dumps(peer_nodes))
+                f.write('\n')
+                f.write(json.dumps(peer_metadata))
                 # save_data = {
                 #     'chain': blocchain,
                 #     'ot': open_submissions
                 # }
                 # f.write(pickle.dumps(save_data))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+            return True
         except IOError:
-            print('Saving failed!')
+            logger.error('Saving failed!')
+            return False
+
+    def next_difficulty(self):
+        """Returns the difficulty the next bloc has to record (see
+        Verification.next_difficulty)."""
+        with self.__lock:
+            return Verification.next_difficulty(
+                self.__chain[-RETARGET_INTERVAL:])
 
-    def proof_by_vote(self):
+    @traced('Blocchain.proof_by_vote')
+    def proof_by_vote(self, submissions=None, last_hash=None, abort=None,
+                      difficulty=None):
         """Generate a proof by vote for the open submissions, the hash of the
-        previous bloc and a random number (which is guessed until it fits)."""
-        last_bloc = self.__chain[-1]
-        last_hash = hash_bloc(last_bloc)
+        previous bloc and a random number (which is guessed until it fits).
+
+        Arguments:
+            :submissions: The submissions to prove (default: the open
+            submissions).
+            :last_hash: The hash of the bloc to build on (default: the hash
+            of the last bloc).
+            :abort: An optional threading.Event; if it is set while guessing
+            None is returned instead of a proof.
+            :difficulty: The leading zero bits to reach (default: the next
+            bloc's difficulty).
+        """
+        if submissions is None:
+            submissions = self.__open_submissions[:]
+        if last_hash is None:
+            last_hash = hash_bloc(self.__chain[-1])
+        if difficulty is None:
+            difficulty = self.next_difficulty()
         proof = 0
         # Try different Pbv numbers and return the first valid one
         while not Verification.valid_proof(
-            self.__open_submissions,
-            last_hash, proof
+            submissions,
+            last_hash, proof, difficulty
         ):
             proof += 1
+            # Checking the event on every guess would cost more than the
+            # hash itself
+            if abort is not None and proof % 64 == 0 and abort.is_set():
+                return None
         return proof
 
+    @traced('Blocchain.get_balance')
     def get_balance(self, voter=None):
         """Calculate and return the balance for a participant.
         """
@@ -171,7 +418,7 @@ class Blocchain:
             if tx.voter == participant
         ]
         tx_voter.append(open_tx_voter)
-        print(tx_voter)
+        logger.debug('Votes sent by %s: %s', participant, tx_voter)
         amount_sent = reduce(lambda tx_sum, tx_amt: tx_sum + sum(tx_amt)
                              if len(tx_amt) > 0 else tx_sum + 0, tx_voter, 0)
         # This fetches received votes in submissions that were already
@@ -205,6 +452,7 @@ class Blocchain:
     # (last_submission)
     # The optional one is optional because it has a default value => [1]
 
+    @traced('Blocchain.add_submission')
     def add_submission(self,
                         candidate,
                         voter,
@@ -228,29 +476,44 @@ class Blocchain:
         # if self.public_key == None:
         #     return False
         submission = Submission(voter, candidate, zero, signature, amount)
-        if Verification.verify_submission(submission, self.get_balance):
+        size = self.admission.size_of(voter, candidate, signature)
+        with self.__lock:
+            if not self.admission.has_room(len(self.__open_submissions),
+                                           self.__open_bytes, size):
+                return False
+            if self.is_replay(signature):
+                logger.info('Rejected replayed submission of %s', voter)
+                return False
+            if not Verification.verify_submission(submission,
+                                                  self.get_balance):
+                return False
             self.__open_submissions.append(submission)
+            self.__open_bytes += size
             self.save_data()
-            if not is_receiving:
-                for node in self.__peer_nodes:
-                    url = 'http://{}/broadcast-submission'.format(node)
-                    try:
-                        response = requests.post(url,
-                                                 json={
-                                                     'voter': voter,
-                                                     'candidate': candidate,
-                                                     'zero': zero,
-                                                     'amount': amount,
-                                                     'signature': signature
-                                                 })
-                        if (response.status_code == 400 or
-                                response.status_code == 500):
-                            print('Submission declined, needs resolving')
-                            return False
-                    except requests.exceptions.ConnectionError:
-                        continue
-            return True
-        return False
+        self.admission.record_accepted(voter)
+        self.__notify('submission', {'submission': submission})
+        if not is_receiving:
+            for node in self.__peer_nodes.available():
+                url = 'http://{}{}/broadcast-submission'.format(
+                    node, self.url_prefix)
+                try:
+                    response = self.__contact_peer(node, self.transport.post,
+                                                   url,
+                                                   json={
+                                                       'voter': voter,
+                                                       'candidate': candidate,
+                                                       'zero': zero,
+                                                       'amount': amount,
+                                                       'signature': signature
+                                                   })
+                    if (response.status_code == 400 or
+                            response.status_code == 500):
+                        logger.warning(
+                            'Submission declined, needs resolving')
+                        return False
+                except PeerUnavailable:
+                    continue
+        return True
 
     def submission_zero(self):
         """Countdown to day zero,the  amount of days left until voting ends."""
@@ -260,23 +523,47 @@ class Blocchain:
         submission_zero = (genesis_ts - time.time()) // genesis_pf
         return submission_zero
 
-    def mine_bloc(self):
-        global VOTE_WINDOW
-        """Create a new bloc and add open submissions to it."""
+    @traced('Blocchain.mine_bloc')
+    def mine_bloc(self, abort=None):
+        """Create a new bloc and add open submissions to it.
+
+        The proof is searched without holding the lock, so submissions and
+        peer blocs keep flowing in while mining. If the chain moved on in the
+        meantime the bloc is discarded and None is returned.
+
+        Arguments:
+            :abort: An optional threading.Event which stops the proof search
+            when set (e.g. because a peer's bloc was accepted).
+        """
         # update your ip (only if your publickey is registered) so that mining can be shared with all nodes
         if self.public_key is None:
             return None
 
         publickey = {"publickey": self.public_key}
-        requests.post('https://blocbit.net/kitty.php' ,params=publickey)
-        # Fetch the currently last bloc of the blocchain
-        last_bloc = self.__chain[-1]
+        self.transport.post('https://blocbit.net/kitty.php' ,params=publickey)
+        # Fetch the currently last bloc of the blocchain and the submissions
+        # we are going to seal
+        # Copy submission instead of manipulating the original
+        # open_submissions list
+        # This ensures that if for some reason the mining should fail,
+        # we don't have the reward submission stored in the open submissions
+        with self.__lock:
+            last_bloc = self.__chain[-1]
+            copied_submissions = self.__open_submissions[:]
+            recent = self.__chain[-RETARGET_INTERVAL:]
+            difficulty = Verification.next_difficulty(recent)
+        for tx in copied_submissions:
+            if not Ballot.verify_submission(tx):
+                return None
         #last_pf = last_bloc.proof
         #window = self.load_window_data()
         # Hash the last bloc (=> to be able to compare it to the stored hash
         # value)
         hashed_bloc = hash_bloc(last_bloc)
-        proof = self.proof_by_vote()
+        proof = self.proof_by_vote(copied_submissions, hashed_bloc, abort,
+                                   difficulty)
+        if proof is None:
+            return None
         # Added to avoid blocchain startup error after genesis bloxk as it contains no submission i.e. no zero
         # last_pf = last_bloc.proof
         # if last_pf != 86400:
@@ -294,41 +581,52 @@ class Blocchain:
             'STATION', self.public_key, zero, '', 1)
         Station_closed = Submission(
             'STATION', self.public_key, zero, '', 0)
-        # Copy submission instead of manipulating the original
-        # open_submissions list
-        # This ensures that if for some reason the mining should fail,
-        # we don't have the reward submission stored in the open submissions
-        copied_submissions = self.__open_submissions[:]
-        for tx in copied_submissions:
-            if not Ballot.verify_submission(tx):
+        with self.__lock:
+            # Another bloc was added while we were looking for the proof
+            if self.__chain[-1] is not last_bloc:
                 return None
-        
-        # if global var is set to true award right and then set back to false
-        if VOTE_WINDOW is False:
-            copied_submissions.append(Station_closed)
-        else:
-            copied_submissions.append(Station_open)
-            VOTE_WINDOW = False
-        bloc = Bloc(len(self.__chain), hashed_bloc,
-                      copied_submissions, proof)
-        self.__chain.append(bloc)
-        self.__open_submissions = []
-        self.save_data()
-        for node in self.__peer_nodes:
-            url = 'http://{}/broadcast-bloc'.format(node)
-            converted_bloc = bloc.__dict__.copy()
-            converted_bloc['submissions'] = [
-                tx.__dict__ for tx in converted_bloc['submissions']]
+            # if the window is open award right and then close it
+            if self.vote_window is False:
+                copied_submissions.append(Station_closed)
+            else:
+                copied_submissions.append(Station_open)
+                self.vote_window = False
+            # The timestamp has to pass the median of the blocs before, even
+            # if this node's clock is behind the miners of those blocs
+            median = Verification.median_time(recent)
+            timestamp = self.clock()
+            if median is not None:
+                timestamp = max(timestamp, median + 1)
+            bloc = Bloc(len(self.__chain), hashed_bloc,
+                          copied_submissions, proof, timestamp, difficulty)
+            self.__chain.append(bloc)
+            self.__index_signatures([bloc])
+            # Submissions which arrived while mining stay open
+            self.__set_open_submissions([
+                tx for tx in self.__open_submissions
+                if tx not in copied_submissions])
+            self.save_data()
+        self.__notify('bloc', {'bloc': bloc, 'source': 'local'})
+        converted_bloc = bloc.__dict__.copy()
+        converted_bloc['submissions'] = [
+            tx.__dict__ for tx in converted_bloc['submissions']]
+        for node in self.__peer_nodes.available():
+            url = 'http://{}{}/broadcast-bloc'.format(node, self.url_prefix)
             try:
-                response = requests.post(url, json={'bloc': converted_bloc})
+                response = self.__contact_peer(
+                    node, self.transport.post, url,
+                    json={'bloc': converted_bloc})
                 if response.status_code == 400 or response.status_code == 500:
-                    print('Bloc declined, needs resolving')
+                    logger.warning('Bloc declined, needs resolving')
                 if response.status_code == 409:
                     self.resolve_conflicts = True
-            except requests.exceptions.ConnectionError:
+                if response.status_code == 201:
+                    self.__peer_nodes.record_height(node, bloc.index + 1)
+            except PeerUnavailable:
                 continue
         return bloc
 
+    @traced('Blocchain.add_bloc')
     def add_bloc(self, bloc):
         """Add a bloc which was received via broadcasting to the localb
         lockchain."""
@@ -339,29 +637,232 @@ class Blocchain:
             tx['zero'],
             tx['signature'],
             tx['amount']) for tx in bloc['submissions']]
-        # Validate the proof of work of the bloc and store the result (True
-        # or False) in a variable
-        proof_is_valid = Verification.valid_proof(
-            submissions[:-1], bloc['previous_hash'], bloc['proof'])
-        # Check if previous_hash stored in the bloc is equal to the local
-        # blocchain's last bloc's hash and store the result in a bloc
-        hashes_match = hash_bloc(self.chain[-1]) == bloc['previous_hash']
-        if not proof_is_valid or not hashes_match:
-            return False
         # Create a bloc object
         converted_bloc = Bloc(
             bloc['index'],
             bloc['previous_hash'],
             submissions,
             bloc['proof'],
-            bloc['timestamp'])
-        self.__chain.append(converted_bloc)
+            bloc['timestamp'],
+            bloc.get('difficulty'))
+        # Check if previous_hash stored in the bloc is equal to the local
+        # blocchain's last bloc's hash and store the result in a bloc
+        with self.__lock:
+            hashes_match = hash_bloc(self.__chain[-1]) == bloc['previous_hash']
+            # The index has to follow too, the chain is indexed by position
+            index_follows = bloc['index'] == self.__chain[-1].index + 1
+            if not hashes_match or not index_follows:
+                return False
+            recent = self.__chain[-RETARGET_INTERVAL:]
+            if not Verification.valid_timestamp(recent, converted_bloc,
+                                                self.clock()):
+                logger.info('Rejected bloc %s with a wrong timestamp',
+                            bloc['index'])
+                return False
+            if not Verification.valid_difficulty(
+                    converted_bloc, Verification.next_difficulty(recent)):
+                logger.info('Rejected bloc %s with a wrong difficulty',
+                            bloc['index'])
+                return False
+            # The proof is only checked against the difficulty the chain
+            # asks for, never one the peer picked
+            if not Verification.valid_proof(
+                    submissions[:-1], bloc['previous_hash'], bloc['proof'],
+                    converted_bloc.difficulty):
+                return False
+            if any(self.is_replay(tx.signature) for tx in submissions):
+                logger.info('Rejected bloc %s replaying submissions',
+                            bloc['index'])
+                return False
+            self.__chain.append(converted_bloc)
+            self.__index_signatures([converted_bloc])
+            self.__remove_included(bloc['submissions'])
+            self.save_data()
+        self.__notify('bloc', {'bloc': converted_bloc, 'source': 'peer'})
+        return True
+
+    @traced('Blocchain.receive_bloc')
+    def receive_bloc(self, bloc):
+        """Handle a bloc which was broadcast by a peer.
+
+        Blocs which extend the tip are added right away. Blocs whose parent
+        is unknown or which fork off the chain are buffered; as soon as a
+        buffered branch connects to the tip it is added, and if a branch
+        forking at most MAX_REORG_DEPTH blocs deep holds more work than the
+        local chain the chain is reorganised onto it.
+
+        Returns one of:
+            :'added': The bloc (and maybe buffered descendants) was added.
+            :'reorganised': The chain switched to the branch of the bloc.
+            :'buffered': The bloc was kept until its parent arrives or its
+            branch outweighs the local chain.
+            :'known': The bloc is on the chain or buffered already.
+            :'stale': The bloc forks off deeper than MAX_REORG_DEPTH and
+            can't win anymore.
+            :'invalid': The proof of the bloc is invalid.
+            :'resolve': The bloc is too far ahead, resolve_conflicts is set.
+
+        Arguments:
+            :bloc: The bloc as a dictionary.
+        """
+        converted_bloc = Bloc(
+            bloc['index'],
+            bloc['previous_hash'],
+            [Submission(
+                tx['voter'],
+                tx['candidate'],
+                tx['zero'],
+                tx['signature'],
+                tx['amount']) for tx in bloc['submissions']],
+            bloc['proof'],
+            bloc['timestamp'],
+            bloc.get('difficulty'))
+        if not Verification.valid_proof(converted_bloc.submissions[:-1],
+                                        converted_bloc.previous_hash,
+                                        converted_bloc.proof,
+                                        converted_bloc.difficulty):
+            return 'invalid'
+        with self.__lock:
+            tip = self.__chain[-1]
+            if bloc['previous_hash'] == hash_bloc(tip):
+                if not self.add_bloc(bloc):
+                    return 'invalid'
+                self.__choose_fork()
+                return 'added'
+            bloc_hash = hash_bloc(converted_bloc)
+            index = converted_bloc.index
+            if (index < len(self.__chain) and
+                    hash_bloc(self.__chain[index]) == bloc_hash):
+                return 'known'
+            if index < len(self.__chain) - MAX_REORG_DEPTH:
+                return 'stale'
+            if index - tip.index > self.__orphans.max_blocs:
+                # We can't buffer the whole gap, fetch the peers' chains;
+                # but only for a bloc which took at least the work the
+                # chain could ask for at its height
+                if (converted_bloc.difficulty is None or
+                        converted_bloc.difficulty <
+                        Verification.lowest_difficulty(
+                            tip, index, converted_bloc.timestamp) or
+                        not Verification.valid_timestamp(
+                            [], converted_bloc, self.clock())):
+                    return 'invalid'
+                self.resolve_conflicts = True
+                return 'resolve'
+            if not self.__orphans.add(converted_bloc, bloc_hash):
+                return 'known'
+            result = self.__choose_fork()
+            if result is not None:
+                return result
+            return 'buffered'
+
+    def __choose_fork(self):
+        """Moves the chain onto the buffered branch with the most work
+        (see Verification.chain_work) which forks at most MAX_REORG_DEPTH
+        blocs below the tip. Returns 'added' if buffered blocs
+        were appended to the tip, 'reorganised' if blocs were rolled back and
+        None if the chain didn't change."""
+        best_fork = None
+        best_branch = []
+        # The work the best branch adds over the blocs it replaces
+        best_gain = 0
+        lowest = max(len(self.__chain) - 1 - MAX_REORG_DEPTH, 0)
+        for fork in range(len(self.__chain) - 1, lowest - 1, -1):
+            parent = self.__chain[fork]
+            branch = self.__orphans.longest_branch(hash_bloc(parent),
+                                                   parent.index)
+            branch = self.__valid_prefix(fork, branch)
+            # The branch has to beat the blocs it replaces
+            gain = (Verification.chain_work(bloc for _, bloc in branch) -
+                    Verification.chain_work(self.__chain[fork + 1:]))
+            if gain > best_gain:
+                best_fork = fork
+                best_branch = branch
+                best_gain = gain
+        if best_fork is None:
+            return None
+        old_tail = self.__chain[best_fork + 1:]
+        for bloc_hash, _ in best_branch:
+            self.__orphans.remove(bloc_hash)
+        new_tail = [bloc for _, bloc in best_branch]
+        self.__chain = self.__chain[:best_fork + 1] + new_tail
+        self.__index_signatures(old_tail, remove=True)
+        self.__index_signatures(new_tail)
+        if not old_tail:
+            for bloc in new_tail:
+                self.__remove_included(
+                    [tx.__dict__ for tx in bloc.submissions])
+            self.save_data()
+            for bloc in new_tail:
+                self.__notify('bloc', {'bloc': bloc, 'source': 'peer'})
+            return 'added'
+        # Keep the abandoned blocs around in case their branch wins again
+        for bloc in old_tail:
+            self.__orphans.add(bloc, hash_bloc(bloc))
+        included = set(tx.signature for bloc in new_tail
+                       for tx in bloc.submissions)
+        self.__open_submissions = [tx for tx in self.__open_submissions
+                                   if tx.signature not in included]
+        # Votes of the abandoned blocs go back to the open submissions if
+        # they are still valid on the new branch
+        for bloc in old_tail:
+            for tx in bloc.submissions[:-1]:
+                if tx.signature in included or tx.voter == 'STATION':
+                    continue
+                if Verification.verify_submission(tx, self.get_balance):
+                    self.__open_submissions.append(tx)
+        self.__set_open_submissions(self.__open_submissions)
+        self.save_data()
+        self.__notify('chain', {'fork': best_fork + 1})
+        return 'reorganised'
+
+    def __valid_prefix(self, fork, branch):
+        """Returns the part of a buffered branch forking after the bloc at
+        index fork whose blocs have valid timestamps, record the expected
+        difficulties and replay no submission of the chain up to the fork or
+        of the branch itself (buffered blocs never went through add_bloc's
+        checks)."""
+        recent = deque(self.__chain[max(fork + 1 - RETARGET_INTERVAL, 0):
+                                    fork + 1], maxlen=RETARGET_INTERVAL)
+        # The signatures of the blocs the branch would replace don't count
+        replaced = set(tx.signature for bloc in self.__chain[fork + 1:]
+                       for tx in bloc.submissions)
+        seen = set()
+        now = self.clock()
+        for position, (_, bloc) in enumerate(branch):
+            if not Verification.valid_timestamp(recent, bloc, now):
+                logger.info('Rejected buffered bloc %s with a wrong '
+                            'timestamp', bloc.index)
+                return branch[:position]
+            if not Verification.valid_difficulty(
+                    bloc, Verification.next_difficulty(recent)):
+                return branch[:position]
+            for tx in bloc.submissions:
+                # Window grants are not signed
+                if not tx.signature:
+                    continue
+                if tx.signature in seen or (
+                        self.is_replay(tx.signature) and
+                        tx.signature not in replaced):
+                    logger.info('Rejected buffered bloc %s replaying '
+                                'submissions', bloc.index)
+                    return branch[:position]
+                seen.add(tx.signature)
+            recent.append(bloc)
+        return branch
+
+    def __remove_included(self, included):
+        """Removes the open submissions which are part of a bloc.
+
+        Arguments:
+            :included: The submissions of the bloc as dictionaries.
+        """
         stored_submissions = self.__open_submissions[:]
         # Check which open submissions were included in the received bloc
         # and remove them
         # This could be improved by giving each submission an ID that would
         # uniquely identify it
-        for itx in bloc['submissions']:
+        for itx in included:
             for opentx in stored_submissions:
                 if (opentx.voter == itx['voter'] and
                         opentx.candidate == itx['candidate'] and
@@ -371,21 +872,32 @@ class Blocchain:
                     try:
                         self.__open_submissions.remove(opentx)
                     except ValueError:
-                        print('Item was already removed')
-        self.save_data()
-        return True
+                        logger.debug('Item was already removed')
+        self.__set_open_submissions(self.__open_submissions)
 
+    @traced('Blocchain.resolve')
     def resolve(self):
         """Checks all peer nodes' blocchains and replaces the local one with
-        longer valid ones."""
+        valid ones holding more work (see Verification.chain_work)."""
         # Initialize the winner chain with the local chain
         winner_chain = self.chain
         replace = False
-        for node in self.__peer_nodes:
-            url = 'http://{}/chain'.format(node)
+        answered = 0
+        # Ask the peers with the longest known chains and the healthiest
+        # connections first
+        peers = sorted(self.__peer_nodes.available(),
+                       key=lambda node: -(self.__peer_nodes.height(node) or 0))
+        for node in peers:
+            height = self.__peer_nodes.height(node)
+            # Enough peers answered and this one isn't known to be ahead
+            if answered >= RESOLVE_FANOUT and (
+                    height is None or height <= len(winner_chain)):
+                continue
+            url = 'http://{}{}/chain'.format(node, self.url_prefix)
             try:
                 # Send a request and store the response
-                response = requests.get(url)
+                response = self.__contact_peer(node, self.transport.get, url)
+                answered += 1
                 # Retrieve the JSON data as a dictionary
                 node_chain = response.json()
                 # Convert the dictionary list to a list of bloc AND
@@ -402,24 +914,36 @@ class Blocchain:
                             tx['amount']) for tx in bloc['submissions']
                     ],
                         bloc['proof'],
-                        bloc['timestamp']) for bloc in node_chain
+                        bloc['timestamp'],
+                        bloc.get('difficulty')) for bloc in node_chain
                 ]
                 node_chain_length = len(node_chain)
-                local_chain_length = len(winner_chain)
-                # Store the received chain as the current winner chain if it's
-                # longer AND valid
-                if (node_chain_length > local_chain_length and
-                        Verification.verify_chain(node_chain)):
+                self.__peer_nodes.record_height(node, node_chain_length)
+                # Store the received chain as the current winner chain if it
+                # holds more work AND is valid
+                if (Verification.chain_work(node_chain) >
+                        Verification.chain_work(winner_chain) and
+                        Verification.verify_chain(node_chain,
+                                                  check_signatures=True,
+                                                  now=self.clock())):
                     winner_chain = node_chain
                     replace = True
-            except requests.exceptions.ConnectionError:
+            except PeerUnavailable:
                 continue
         self.resolve_conflicts = False
-        # Replace the local chain with the winner chain
-        self.chain = winner_chain
+        with self.__lock:
+            # Blocs may have been added while the peers were queried
+            if replace and (Verification.chain_work(winner_chain) <=
+                            Verification.chain_work(self.__chain)):
+                replace = False
+            if replace:
+                fork = self.__fork_point(self.__chain, winner_chain)
+                # Replace the local chain with the winner chain
+                self.chain = winner_chain
+                self.__set_open_submissions([])
+            self.save_data()
         if replace:
-            self.__open_submissions = []
-        self.save_data()
+            self.__notify('chain', {'fork': fork})
         return replace
 
     def add_peer_node(self, node):
@@ -428,8 +952,9 @@ class Blocchain:
         Arguments:
             :node: The node URL which should be added.
         """
-        self.__peer_nodes.add(node)
-        self.save_data()
+        with self.__lock:
+            self.__peer_nodes.add(node)
+            self.save_data()
 
     def remove_peer_node(self, node):
         """Removes a node from the peer node set.
@@ -437,10 +962,34 @@ class Blocchain:
         Arguments:
             :node: The node URL which should be removed.
         """
-        self.__peer_nodes.discard(node)
-        self.save_data()
+        with self.__lock:
+            self.__peer_nodes.discard(node)
+            self.save_data()
 
     def get_peer_nodes(self):
         """Adds current peer to api and Returns a list of all connected peer nodes."""
         
-        return list(self.__peer_nodes)
\ No newline at end of file
+        return self.__peer_nodes.nodes()
+
+    def get_peer_metadata(self):
+        """Returns the health of every peer node (round trip time, failure
+        rate, last seen chain height and whether it is backed off)."""
+        return self.__peer_nodes.get_metadata()
+
+    @traced('Blocchain.contact_peer')
+    def __contact_peer(self, node, send, url, **kwargs):
+        """Sends a request to a peer and records how it went.
+
+        Arguments:
+            :node: The node URL.
+            :send: The transport method (get or post).
+            :url: The endpoint URL.
+        """
+        started = time.time()
+        try:
+            response = send(url, **kwargs)
+        except PeerUnavailable:
+            self.__peer_nodes.record_failure(node)
+            raise
+        self.__peer_nodes.record_success(node, time.time() - started)
+        return response
\ No newline at end of file
@@ -0,0 +1,184 @@
+from array import array
+import binascii
+import json
+import mmap
+import os
+import struct
+import threading
+
+from utility.hash_util import hash_bloc
+
+
+class BlocStore:
+    """An append-only file of serialised blocs which is memory-mapped for
+    reading, with an index from bloc height and bloc hash to the position of
+    the bloc in the file.
+
+    The data file (<name>.dat) only ever grows: when the chain is rolled
+    back the index is cut and the replacing blocs are appended, so mapped
+    records never disappear under a reader. Dead records are dropped when
+    the store is opened and they take up more space than the live ones.
+
+    The index file (<name>.idx) holds one fixed size entry per bloc: the
+    binary bloc hash, the offset and the length of its record.
+
+    Attributes:
+        :name: The file name without extension.
+    """
+
+    ENTRY = struct.Struct('<32sQI')
+
+    def __init__(self, name):
+        self.name = name
+        self.__data_path = '{}.dat'.format(name)
+        self.__index_path = '{}.idx'.format(name)
+        self.__lock = threading.Lock()
+        self.__offsets = array('Q')
+        self.__lengths = array('I')
+        self.__hashes = []
+        self.__heights = {}
+        self.__map = None
+        self.__load_index()
+
+    def __len__(self):
+        return len(self.__hashes)
+
+    def __load_index(self):
+        """Reads the index and drops entries which point past the end of the
+        data file (e.g. after a crash between the two writes)."""
+        try:
+            data_size = os.path.getsize(self.__data_path)
+            with open(self.__index_path, mode='rb') as f:
+                raw = f.read()
+        except (IOError, OSError):
+            data_size = 0
+            raw = b''
+        usable = len(raw) - len(raw) % self.ENTRY.size
+        for digest, offset, length in self.ENTRY.iter_unpack(raw[:usable]):
+            if offset + length > data_size:
+                break
+            self.__add_entry(digest, offset, length)
+        if len(self.__hashes) * self.ENTRY.size != len(raw):
+            self.__write_index()
+        live = sum(self.__lengths) + len(self.__lengths)
+        if data_size - live > live:
+            self.__compact()
+
+    def __add_entry(self, digest, offset, length):
+        self.__heights[digest] = len(self.__hashes)
+        self.__hashes.append(digest)
+        self.__offsets.append(offset)
+        self.__lengths.append(length)
+
+    def __write_index(self):
+        with open(self.__index_path, mode='wb') as f:
+            for height, digest in enumerate(self.__hashes):
+                f.write(self.ENTRY.pack(digest, self.__offsets[height],
+                                        self.__lengths[height]))
+
+    def __compact(self):
+        """Rewrites the data file with the live records only."""
+        records = [bytes(self.__read(height))
+                   for height in range(len(self.__hashes))]
+        self.__map = None
+        temporary_path = '{}.tmp'.format(self.__data_path)
+        offset = 0
+        with open(temporary_path, mode='wb') as f:
+            for height, record in enumerate(records):
+                f.write(record + b'\n')
+                self.__offsets[height] = offset
+                offset += len(record) + 1
+        os.replace(temporary_path, self.__data_path)
+        self.__write_index()
+
+    def __read(self, height):
+        """Returns a memoryview of the record at the given height."""
+        end = self.__offsets[height] + self.__lengths[height]
+        if self.__map is None or len(self.__map) < end:
+            # The file grew, map it again. The old map is not closed since
+            # readers may still hold views of it; it goes away with them.
+            with open(self.__data_path, mode='rb') as f:
+                self.__map = mmap.mmap(f.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+        return memoryview(self.__map)[self.__offsets[height]:end]
+
+    def get(self, height):
+        """Returns the stored record (JSON bytes, as a memoryview) of the bloc
+        at the given height or None.
+
+        Arguments:
+            :height: The index of the bloc.
+        """
+        with self.__lock:
+            if height < 0 or height >= len(self.__hashes):
+                return None
+            return self.__read(height)
+
+    def get_by_hash(self, bloc_hash):
+        """Returns the stored record of the bloc with the given hash or None.
+
+        Arguments:
+            :bloc_hash: The hash of the bloc (hex string).
+        """
+        try:
+            digest = binascii.unhexlify(bloc_hash)
+        except (binascii.Error, TypeError):
+            return None
+        with self.__lock:
+            height = self.__heights.get(digest)
+            if height is None:
+                return None
+            return self.__read(height)
+
+    def hash_at(self, height):
+        """Returns the hash (hex string) of the bloc at the given height."""
+        return binascii.hexlify(self.__hashes[height]).decode('ascii')
+
+    def append(self, bloc):
+        """Stores a bloc on top of the stored ones.
+
+        Arguments:
+            :bloc: The bloc (a Bloc object).
+        """
+        dict_bloc = bloc.__dict__.copy()
+        dict_bloc['submissions'] = [
+            tx.__dict__ for tx in dict_bloc['submissions']]
+        record = json.dumps(dict_bloc).encode()
+        digest = binascii.unhexlify(hash_bloc(bloc))
+        with self.__lock:
+            with open(self.__data_path, mode='ab') as f:
+                offset = f.tell()
+                f.write(record + b'\n')
+            with open(self.__index_path, mode='ab') as f:
+                f.write(self.ENTRY.pack(digest, offset, len(record)))
+            self.__add_entry(digest, offset, len(record))
+
+    def truncate(self, height):
+        """Forgets all blocs from the given height onwards.
+
+        Arguments:
+            :height: The number of blocs which are kept.
+        """
+        with self.__lock:
+            for digest in self.__hashes[height:]:
+                del self.__heights[digest]
+            del self.__hashes[height:]
+            del self.__offsets[height:]
+            del self.__lengths[height:]
+            with open(self.__index_path, mode='r+b') as f:
+                f.truncate(height * self.ENTRY.size)
+
+    def sync(self, chain):
+        """Makes the store match a chain, keeping the common prefix.
+
+        Arguments:
+            :chain: The list of blocs.
+        """
+        height = min(len(self), len(chain))
+        while height > 0 and self.hash_at(height - 1) != hash_bloc(
+                chain[height - 1]):
+            height -= 1
+        if height < len(self):
+            self.truncate(height)
+        for bloc in chain[height:]:
+            self.append(bloc)
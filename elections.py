@@ -0,0 +1,274 @@
+"""Hosts several independent elections in one node process.
+
+Every election has its own chain, open submissions, data files, peers and
+genesis parameters and is served under /election/<name>/ (see node.py).
+Mining and chain resolution of all elections run on one FairPool, which
+takes the elections in turn so a busy one can't starve the others.
+"""
+
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+import logging
+import re
+import threading
+
+from admission import AdmissionControl
+from blocchain import GENESIS_PROOF, GENESIS_TIMESTAMP, Blocchain
+from events import EventStream
+from miner import MiningScheduler
+from utility.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# Election names end up in URLs and file names
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+class FairPool:
+    """Runs jobs on a fixed number of threads, one queue per key (election).
+    The workers take the keys round robin, so every election gets its turn
+    no matter how many jobs another one has queued.
+
+    Attributes:
+        :workers: The number of threads.
+    """
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.__queues = OrderedDict()
+        self.__condition = threading.Condition()
+        self.__stopped = False
+        self.__threads = []
+        for number in range(workers):
+            thread = threading.Thread(target=self.__run,
+                                      name='fair-pool-{}'.format(number))
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def submit(self, key, function, *args, **kwargs):
+        """Queues a job and returns a concurrent.futures.Future of its
+        result.
+
+        Arguments:
+            :key: The queue of the job (e.g. the election name).
+            :function: The callable to run with the remaining arguments.
+        """
+        future = Future()
+        with self.__condition:
+            if self.__stopped:
+                raise RuntimeError('The pool was shut down.')
+            self.__queues.setdefault(key, deque()).append(
+                (future, function, args, kwargs))
+            self.__condition.notify()
+        return future
+
+    def __next_job(self):
+        """Takes the first job of the key whose turn it is (the condition
+        has to be held)."""
+        for key, jobs in self.__queues.items():
+            if jobs:
+                job = jobs.popleft()
+                # The key goes to the back of the line
+                self.__queues.move_to_end(key)
+                if not jobs:
+                    del self.__queues[key]
+                return job
+        return None
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                job = self.__next_job()
+                while job is None:
+                    if self.__stopped:
+                        return
+                    self.__condition.wait()
+                    job = self.__next_job()
+            future, function, args, kwargs = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+    def pending(self):
+        """Returns the number of queued jobs per key."""
+        with self.__condition:
+            return {key: len(jobs) for key, jobs in self.__queues.items()}
+
+    def shutdown(self):
+        """Lets the workers finish the queued jobs and stops them."""
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify_all()
+        for thread in self.__threads:
+            thread.join()
+
+
+class Election:
+    """One chain hosted by the node together with what belongs to it.
+
+    Attributes:
+        :name: The name of the election (None for the node's own chain).
+        :node_id: The id used for the data files.
+        :url_prefix: The path of the election's endpoints.
+        :public_key: The key of the ballot running the node (None until
+        one is loaded or created).
+        :blocchain: The chain (None until load finished).
+        :ready: Set once the chain is loaded and served.
+        :load_error: Why loading the chain failed (None otherwise).
+        :miner: The MiningScheduler (None unless auto mining is on).
+        :event_stream: Pushes the chain's changes to the UIs.
+        :chain_columns: The columnar copy behind /stats (built on first use).
+        :stats_lock: Guards chain_columns.
+    """
+
+    def __init__(self, name, port, genesis_timestamp=GENESIS_TIMESTAMP,
+                 genesis_proof=GENESIS_PROOF, admission_options=None,
+                 persistence_options=None, miner_options=None, pool=None,
+                 peer_nodes=()):
+        """
+        Arguments:
+            :name: The name of the election (None for the node's own chain).
+            :port: The port of the node.
+            :genesis_timestamp: Day zero of the election.
+            :genesis_proof: The length of a voting day in seconds.
+            :admission_options: Keyword arguments of AdmissionControl.
+            :persistence_options: Durability keyword arguments of Blocchain.
+            :miner_options: Keyword arguments of MiningScheduler, None
+            disables auto mining.
+            :pool: The FairPool shared by the node's elections (optional).
+            :peer_nodes: Peers added to the chain once it is loaded.
+        """
+        if name is not None and not NAME_PATTERN.match(name):
+            raise ValueError('Invalid election name: {}'.format(name))
+        self.name = name
+        if name is None:
+            self.node_id = port
+            self.url_prefix = ''
+        else:
+            self.node_id = '{}-{}'.format(port, name)
+            self.url_prefix = '/election/{}'.format(name)
+        self.genesis_timestamp = genesis_timestamp
+        self.genesis_proof = genesis_proof
+        self.admission = AdmissionControl(**(admission_options or {}))
+        self.persistence_options = persistence_options or {}
+        self.miner_options = miner_options
+        self.pool = pool
+        self.peer_nodes = list(peer_nodes)
+        self.public_key = None
+        self.blocchain = None
+        self.ready = threading.Event()
+        self.load_error = None
+        # Guards public_key against a load finishing at the same time
+        self.__key_lock = threading.Lock()
+        self.miner = None
+        self.event_stream = EventStream()
+        self.chain_columns = None
+        self.stats_lock = threading.Lock()
+
+    def load(self):
+        """(Re)creates the chain from the data files, writing out what the
+        previous instance has pending first."""
+        if self.blocchain is not None:
+            self.blocchain.persistence.stop()
+        blocchain = Blocchain(
+            None, self.node_id, admission=self.admission,
+            genesis_timestamp=self.genesis_timestamp,
+            genesis_proof=self.genesis_proof, url_prefix=self.url_prefix,
+            **self.persistence_options)
+        for node in self.peer_nodes:
+            blocchain.add_peer_node(node)
+        with self.__key_lock:
+            blocchain.public_key = self.public_key
+            self.blocchain = blocchain
+        if self.miner is not None:
+            self.miner.attach(blocchain)
+        elif self.miner_options is not None:
+            self.miner = MiningScheduler(blocchain, pool=self.pool,
+                                         pool_key=self.name,
+                                         **self.miner_options)
+            self.miner.start()
+        self.event_stream.attach(blocchain)
+        self.ready.set()
+
+    def load_in_background(self):
+        """Loads the chain on a separate thread, so the node can serve
+        /health and /ready (and answer 503 otherwise) while a long chain is
+        parsed."""
+        def run():
+            try:
+                self.load()
+            except Exception as e:
+                self.load_error = str(e)
+                logger.exception('Loading election %s failed', self.name)
+        thread = threading.Thread(
+            target=run, name='load-{}'.format(self.name or 'default'))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def set_public_key(self, public_key):
+        """Switches the loaded (or loading) chain to another ballot's key.
+
+        Arguments:
+            :public_key: The key of the ballot running the node.
+        """
+        with self.__key_lock:
+            self.public_key = public_key
+            if self.blocchain is not None:
+                self.blocchain.public_key = public_key
+
+    def run(self, function, *args, **kwargs):
+        """Runs a (CPU heavy) job of this election on the shared pool and
+        returns its result; without a pool it runs right away.
+
+        The job's spans go into the caller's trace, and the persistence
+        ticket of its changes is handed to the caller, so the request waits
+        for them like for its own (see node.acknowledge_persisted)."""
+        if self.pool is None:
+            return function(*args, **kwargs)
+        persistence = self.blocchain.persistence
+        trace = tracer.current()
+
+        def job():
+            # Drop a ticket left over from an earlier job of this thread
+            persistence.take_ticket()
+            with tracer.attach(trace):
+                result = function(*args, **kwargs)
+            return result, persistence.take_ticket()
+
+        result, ticket = self.pool.submit(self.name, job).result()
+        persistence.adopt_ticket(ticket)
+        return result
+
+    def get_info(self):
+        """Returns the settings and the chain length of the election."""
+        loaded = self.ready.is_set()
+        return {
+            'name': self.name,
+            'url_prefix': self.url_prefix,
+            'genesis_timestamp': self.genesis_timestamp,
+            'genesis_proof': self.genesis_proof,
+            'ready': loaded,
+            'length': len(self.blocchain.chain) if loaded else None,
+            'open_submissions': (self.blocchain.get_pool_usage()[0]
+                                 if loaded else None),
+            'auto_mine': self.miner_options is not None
+        }
+
+
+def parse_election(value):
+    """Parses an --election argument: name[:genesis_timestamp[:day_length]].
+
+    Arguments:
+        :value: The argument.
+    """
+    parts = value.split(':')
+    if len(parts) > 3 or not NAME_PATTERN.match(parts[0]):
+        raise ValueError('Expected name[:genesis_timestamp[:day_length]]')
+    timestamp = int(parts[1]) if len(parts) > 1 else GENESIS_TIMESTAMP
+    proof = int(parts[2]) if len(parts) > 2 else GENESIS_PROOF
+    return parts[0], timestamp, proof
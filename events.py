@@ -0,0 +1,143 @@
+"""Pushes chain changes to the UI as server-sent events (GET /events).
+
+The blocchain's listener events are turned into small deltas: a new bloc,
+a new open submission or a changed tip after a fork was resolved. Each
+event is serialised once and queued for every connected client. Clients
+which reconnect with a Last-Event-ID get the events they missed from a
+short history; clients which fall too far behind get a 'reset' event and
+load the chain again.
+"""
+
+from collections import deque
+import json
+import queue
+import threading
+
+
+class Subscription:
+    """The queue of events waiting to be sent to one client."""
+
+    def __init__(self, max_pending):
+        self.events = queue.Queue(max_pending)
+        self.lagging = False
+
+
+class EventStream:
+    """Fans the blocchain's events out to the connected clients.
+
+    Attributes:
+        :blocchain: The blocchain whose events are sent.
+        :max_pending: The events a client may fall behind before it is reset.
+        :heartbeat: Seconds between keep-alive comments on an idle stream.
+    """
+
+    def __init__(self, history=256, max_pending=256, heartbeat=15.0):
+        self.blocchain = None
+        self.max_pending = max_pending
+        self.heartbeat = heartbeat
+        self.__last_id = 0
+        # (id, frame) of the last events for reconnecting clients
+        self.__history = deque(maxlen=history)
+        self.__subscriptions = set()
+        self.__lock = threading.Lock()
+
+    def attach(self, blocchain):
+        """Switches the stream to another blocchain instance and tells the
+        clients to load it.
+
+        Arguments:
+            :blocchain: The blocchain whose events should be sent.
+        """
+        if self.blocchain is not None:
+            self.blocchain.remove_listener(self.__on_event)
+            self.publish('reset', {})
+        self.blocchain = blocchain
+        blocchain.add_listener(self.__on_event)
+
+    def __on_event(self, event, data):
+        if event == 'submission':
+            self.publish('submission', data['submission'].__dict__)
+        elif event == 'bloc':
+            dict_bloc = data['bloc'].__dict__.copy()
+            dict_bloc['submissions'] = [
+                tx.__dict__ for tx in dict_bloc['submissions']]
+            self.publish('bloc', {'bloc': dict_bloc,
+                                  'source': data['source']})
+        elif event == 'chain':
+            self.publish('chain', {'fork': data['fork'],
+                                   'length': len(self.blocchain.chain)})
+
+    def publish(self, event, data):
+        """Sends an event to every connected client.
+
+        Arguments:
+            :event: The event name.
+            :data: The JSON-serialisable payload.
+        """
+        with self.__lock:
+            self.__last_id += 1
+            event_id = self.__last_id
+            frame = 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+                event_id, event, json.dumps(data))
+            self.__history.append((event_id, frame))
+            for subscription in self.__subscriptions:
+                if subscription.lagging:
+                    continue
+                try:
+                    subscription.events.put_nowait(frame)
+                except queue.Full:
+                    # Don't let a slow client hold up the others
+                    subscription.lagging = True
+
+    def subscribe(self, last_event_id=None):
+        """Registers a client and returns its Subscription.
+
+        Arguments:
+            :last_event_id: The id of the last event the client received
+            before it reconnected (optional).
+        """
+        subscription = Subscription(self.max_pending)
+        with self.__lock:
+            if last_event_id is not None:
+                missed = [frame for event_id, frame in self.__history
+                          if event_id > last_event_id]
+                first = (self.__history[0][0] if self.__history
+                         else self.__last_id + 1)
+                if (last_event_id > self.__last_id or
+                        first > last_event_id + 1 or
+                        len(missed) > self.max_pending):
+                    # The node restarted or the events are gone already
+                    subscription.lagging = True
+                else:
+                    for frame in missed:
+                        subscription.events.put_nowait(frame)
+            self.__subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Removes a client."""
+        with self.__lock:
+            self.__subscriptions.discard(subscription)
+
+    def stream(self, subscription):
+        """Yields the frames of a client until it disconnects.
+
+        Arguments:
+            :subscription: The client's Subscription.
+        """
+        try:
+            # Let the browser retry quickly after a dropped connection
+            yield 'retry: 3000\n\n'
+            while True:
+                if subscription.lagging:
+                    with self.__lock:
+                        subscription.events = queue.Queue(self.max_pending)
+                        subscription.lagging = False
+                    yield 'event: reset\ndata: {}\n\n'
+                    continue
+                try:
+                    yield subscription.events.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+        finally:
+            self.unsubscribe(subscription)
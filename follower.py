@@ -0,0 +1,340 @@
+"""A read-only follower which mirrors a primary node's chain and serves it to
+explorers and UIs, so reads scale by adding followers behind a load
+balancer instead of loading the writing nodes:
+
+    python follower.py --primary localhost:8105 --port 8205
+
+The follower tails the primary's /bloc/<index> endpoint, checks every new
+bloc's link, timestamp, difficulty and proof, and keeps it in its own bloc
+store together with the history of every key and the vote tally. It never
+mines and rejects submissions. Responses carry ETags and Cache-Control headers.
+Only blocs addressed by hash are cached for good; a height may get another
+bloc when the primary resolves onto a different chain, so everything else
+is revalidated after a short while.
+"""
+
+from argparse import ArgumentParser
+from collections import Counter, defaultdict, deque
+import json
+import logging
+import threading
+import time
+
+from flask import Flask, Response, jsonify, request
+from flask_cors import CORS
+
+from bloc import Bloc
+from blocstore import BlocStore
+from submission import Submission
+from utility.hash_util import hash_bloc
+from utility.transport import HttpTransport, PeerUnavailable
+from utility.verification import RETARGET_INTERVAL, Verification
+
+logger = logging.getLogger(__name__)
+
+# Seconds a bloc addressed by its hash may be cached
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def bloc_from_dict(bloc):
+    """Builds a Bloc (with Submission objects) from its JSON form."""
+    return Bloc(
+        bloc['index'],
+        bloc['previous_hash'],
+        [Submission(
+            tx['voter'],
+            tx['candidate'],
+            tx['zero'],
+            tx['signature'],
+            tx['amount']) for tx in bloc['submissions']],
+        bloc['proof'],
+        bloc['timestamp'],
+        bloc.get('difficulty'))
+
+
+class Follower:
+    """Mirrors the chain of a primary node and indexes it for reading.
+
+    Attributes:
+        :primary: The address of the primary (host:port, may include an
+        election prefix like host:port/election/<name>).
+        :store: The BlocStore holding the mirrored blocs.
+        :poll_interval: Seconds between two polls once caught up.
+        :last_poll: The time of the last successful poll (or None).
+    """
+
+    def __init__(self, primary, name, poll_interval=1.0, timeout=5.0):
+        self.primary = primary
+        self.poll_interval = poll_interval
+        self.transport = HttpTransport(timeout=timeout)
+        self.store = BlocStore('follower-{}'.format(name))
+        self.last_poll = None
+        self.last_error = None
+        # Submissions (with their bloc height) per voter and candidate key
+        self.__history = defaultdict(list)
+        self.__tally = Counter()
+        # The last blocs, for the link and the difficulty of the next one
+        self.__recent = deque(maxlen=RETARGET_INTERVAL)
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+        for height in range(len(self.store)):
+            bloc = self.__stored_bloc(height)
+            self.__index(bloc)
+            self.__recent.append(bloc)
+
+    def __stored_bloc(self, height):
+        return bloc_from_dict(json.loads(bytes(self.store.get(height))))
+
+    def __index(self, bloc):
+        for position, tx in enumerate(bloc.submissions):
+            entry = (bloc.index, position, tx)
+            self.__history[tx.voter].append(entry)
+            if tx.candidate != tx.voter:
+                self.__history[tx.candidate].append(entry)
+            if tx.voter != 'STATION':
+                self.__tally[tx.candidate] += tx.amount
+
+    def __unindex(self, bloc):
+        # The bloc's entries are the last ones of every list
+        for tx in reversed(bloc.submissions):
+            for key in {tx.voter, tx.candidate}:
+                self.__history[key].pop()
+                if not self.__history[key]:
+                    del self.__history[key]
+            if tx.voter != 'STATION':
+                self.__tally[tx.candidate] -= tx.amount
+                if not self.__tally[tx.candidate]:
+                    del self.__tally[tx.candidate]
+
+    def __roll_back(self):
+        """Drops the tip (the primary replaced it)."""
+        height = len(self.store) - 1
+        self.__unindex(self.__recent.pop())
+        self.store.truncate(height)
+        # The next bloc's timestamp and difficulty are checked against a
+        # full window again
+        self.__recent.clear()
+        self.__recent.extend(
+            self.__stored_bloc(index) for index in
+            range(max(height - RETARGET_INTERVAL, 0), height))
+
+    def poll(self):
+        """Fetches the blocs the primary added since the last poll and
+        returns their number."""
+        added = 0
+        while True:
+            height = len(self.store)
+            url = 'http://{}/bloc/{}'.format(self.primary, height)
+            response = self.transport.get(url)
+            if response.status_code == 404:
+                break
+            if response.status_code != 200:
+                raise PeerUnavailable('{} answered {}'.format(
+                    url, response.status_code))
+            try:
+                bloc = bloc_from_dict(response.json())
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError('Bloc {} from {} is malformed: {!r}'.format(
+                    height, self.primary, e))
+            with self.__lock:
+                if self.__recent and (
+                        bloc.previous_hash != hash_bloc(self.__recent[-1])):
+                    # The primary switched to another branch, step back
+                    # until the blocs connect again
+                    self.__roll_back()
+                    continue
+                if self.__recent and not Verification.verify_next(
+                        self.__recent, bloc):
+                    raise ValueError('Bloc {} from {} is invalid'.format(
+                        bloc.index, self.primary))
+                self.store.append(bloc)
+                self.__index(bloc)
+                self.__recent.append(bloc)
+            added += 1
+        self.last_poll = time.time()
+        self.last_error = None
+        return added
+
+    def start(self):
+        """Starts tailing the primary in the background."""
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name='follower')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """Stops tailing the primary."""
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self):
+        while not self.__stop.is_set():
+            try:
+                self.poll()
+            except (PeerUnavailable, ValueError) as e:
+                self.last_error = str(e)
+                logger.warning('Polling %s failed: %s', self.primary, e)
+            except Exception as e:
+                # Keep following, the next poll may get a good answer
+                self.last_error = str(e)
+                logger.exception('Polling %s failed: %s', self.primary, e)
+            self.__stop.wait(self.poll_interval)
+
+    def height(self):
+        """Returns the number of mirrored blocs."""
+        return len(self.store)
+
+    def tip_hash(self):
+        """Returns the hash of the last mirrored bloc (or None)."""
+        with self.__lock:
+            return hash_bloc(self.__recent[-1]) if self.__recent else None
+
+    def records(self):
+        """Returns the stored records of all mirrored blocs and the hash of
+        the last one, taken together so a rollback can't tear them apart
+        (the records stay readable, the store's data file only grows)."""
+        with self.__lock:
+            records = [self.store.get(height)
+                       for height in range(len(self.store))]
+            tip_hash = hash_bloc(self.__recent[-1]) if self.__recent else None
+        return records, tip_hash
+
+    def history(self, key):
+        """Returns the submissions a key sent or received, oldest first."""
+        with self.__lock:
+            entries = list(self.__history.get(key, []))
+        return [{'bloc': height, 'position': position,
+                 'submission': tx.__dict__}
+                for height, position, tx in entries]
+
+    def tally(self):
+        """Returns the votes per candidate."""
+        with self.__lock:
+            return dict(self.__tally)
+
+    def is_ready(self):
+        """Returns True if the last poll succeeded recently enough to serve
+        reads (used by load balancer checks)."""
+        return (self.last_poll is not None and
+                time.time() - self.last_poll < 3 * self.poll_interval + 5)
+
+
+app = Flask(__name__)
+CORS(app)
+
+# The follower served by this process (set up in __main__)
+follower = None
+
+
+def cached(response, max_age, etag):
+    """Adds the caching headers and answers If-None-Match with 304."""
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    if etag is not None:
+        response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+@app.route('/bloc/<int:index>', methods=['GET'])
+def get_bloc(index):
+    record = follower.store.get(index)
+    if record is None:
+        response = {'message': 'Bloc not found.'}
+        return jsonify(response), 404
+    # Blocchain.resolve can replace a bloc at any depth, so a height is
+    # only cached briefly and then revalidated against the bloc's hash
+    return cached(Response(bytes(record), mimetype='application/json'),
+                  follower.poll_interval, follower.store.hash_at(index))
+
+
+@app.route('/bloc/hash/<bloc_hash>', methods=['GET'])
+def get_bloc_by_hash(bloc_hash):
+    record = follower.store.get_by_hash(bloc_hash)
+    if record is None:
+        response = {'message': 'Bloc not found.'}
+        return jsonify(response), 404
+    # A bloc's content never changes under its hash
+    return cached(Response(bytes(record), mimetype='application/json'),
+                  IMMUTABLE_MAX_AGE, bloc_hash)
+
+
+@app.route('/chain', methods=['GET'])
+def get_chain():
+    records, tip_hash = follower.records()
+
+    def generate():
+        # The stored records are joined as they are, without parsing them
+        yield b'['
+        for index, record in enumerate(records):
+            if index:
+                yield b','
+            yield bytes(record)
+        yield b']'
+    return cached(Response(generate(), mimetype='application/json'),
+                  follower.poll_interval, tip_hash)
+
+
+@app.route('/tip', methods=['GET'])
+def get_tip():
+    response = {'height': follower.height(), 'hash': follower.tip_hash()}
+    return cached(jsonify(response), follower.poll_interval,
+                  response['hash'])
+
+
+@app.route('/history/<key>', methods=['GET'])
+def get_history(key):
+    response = {'key': key, 'submissions': follower.history(key)}
+    return cached(jsonify(response), follower.poll_interval,
+                  follower.tip_hash())
+
+
+@app.route('/tally', methods=['GET'])
+def get_tally():
+    response = {'height': follower.height(), 'votes': follower.tally()}
+    return cached(jsonify(response), follower.poll_interval,
+                  follower.tip_hash())
+
+
+@app.route('/ready', methods=['GET'])
+def get_ready():
+    response = {
+        'ready': follower.is_ready(),
+        'height': follower.height(),
+        'last_poll': follower.last_poll,
+        'last_error': follower.last_error
+    }
+    return jsonify(response), 200 if response['ready'] else 503
+
+
+@app.route('/submission', methods=['POST'])
+@app.route('/broadcast-submission', methods=['POST'])
+@app.route('/broadcast-bloc', methods=['POST'])
+@app.route('/mine', methods=['POST'])
+@app.route('/node', methods=['POST'])
+def reject_write():
+    response = {
+        'message': 'This is a read-only follower, send writes to the '
+                   'primary.',
+        'primary': follower.primary
+    }
+    return jsonify(response), 403
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--primary', default='localhost:8105',
+                        help='the node to follow (host:port[/election/name])')
+    parser.add_argument('-p', '--port', type=int, default=8205)
+    parser.add_argument('--poll', type=float, default=1.0,
+                        help='seconds between polls of the primary')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=args.log_level.upper(),
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    follower = Follower(args.primary, args.port, args.poll)
+    follower.start()
+    app.run(host='0.0.0.0', port=args.port)
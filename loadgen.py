@@ -0,0 +1,357 @@
+"""Generates HTTP load against running blocchain nodes.
+
+Ballot key pairs and signed submissions are created up front so the
+measured time is spent in the nodes only. The endpoints are driven either
+at a target rate (open loop) or with a fixed number of concurrent clients
+(closed loop); latency percentiles, error rates and chain growth are
+written to a JSON report which can be diffed between releases:
+
+    python loadgen.py --nodes localhost:8105 localhost:8106 --rate 50 \\
+        --duration 30 --report load-report.json
+
+Accepted (2xx) and rejected requests are counted and timed separately,
+since a rejection is usually much cheaper than the work it turns away.
+
+Before the run the synthetic voters get their right to vote: a bloc of
+STATION grants, one vote per candidate for every voter, is mined on top
+of the first node's chain and broadcast to the nodes. Every
+/broadcast-submission then carries a fresh vote (one voter for one
+candidate, signed when it is sent), so it measures the path of accepted
+votes; once all voters voted for all candidates no more are sent.
+/submission is signed by the node's own ballot and is only accepted while
+that ballot has votes left.
+"""
+
+from argparse import ArgumentParser
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import random
+import threading
+import time
+
+import requests
+
+from ballot import Ballot
+from bloc import Bloc
+from submission import Submission
+from utility.hash_util import hash_bloc
+from utility.stats import percentiles
+from utility.verification import RETARGET_INTERVAL, Verification
+
+ENDPOINTS = ['submission', 'broadcast-submission', 'mine', 'chain']
+
+
+class LoadGenerator:
+    """Sends a mix of requests to a set of nodes and records the results.
+
+    Attributes:
+        :nodes: The node addresses (host:port).
+        :mix: Relative weight of every endpoint.
+        :timeout: Seconds to wait for a response.
+    """
+
+    def __init__(self, nodes, mix, voters=100, candidates=3, timeout=30.0,
+                 seed=None):
+        self.nodes = nodes
+        self.mix = mix
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__latencies = defaultdict(list)
+        self.__statuses = defaultdict(Counter)
+        self.__local = threading.local()
+        # Both /submission and /broadcast-submission vote for these keys
+        self.candidate_keys = [ballot.public_key for ballot in
+                               self.__ballots('load-candidate', candidates)]
+        self.__voters = []
+        # The (voter, candidate) pairs which didn't vote yet
+        self.__votes = []
+        self.zero = None
+        if self.mix.get('broadcast-submission'):
+            self.__voters = self.__ballots('load-voter', voters)
+            self.__votes = [(ballot, candidate)
+                            for ballot in self.__voters
+                            for candidate in self.candidate_keys]
+            self.random.shuffle(self.__votes)
+
+    @staticmethod
+    def __ballots(prefix, count):
+        ballots = []
+        for number in range(count):
+            ballot = Ballot('{}-{}'.format(prefix, number))
+            ballot.create_keys()
+            ballots.append(ballot)
+        return ballots
+
+    def grant_votes(self, attempts=3):
+        """Gives every voter one vote per candidate: mines a bloc of STATION
+        grants on top of the first node's chain and broadcasts it to all
+        nodes. Returns the status every node answered with.
+
+        Arguments:
+            :attempts: How often the bloc is mined again when the first
+            node's chain moved on in the meantime.
+        """
+        if not self.__voters:
+            return {}
+        for _ in range(attempts):
+            chain = [Bloc(bloc['index'],
+                          bloc['previous_hash'],
+                          [Submission(
+                              tx['voter'],
+                              tx['candidate'],
+                              tx['zero'],
+                              tx['signature'],
+                              tx['amount']) for tx in bloc['submissions']],
+                          bloc['proof'],
+                          bloc['timestamp'],
+                          bloc.get('difficulty'))
+                     for bloc in requests.get(
+                         'http://{}/chain'.format(self.nodes[0]),
+                         timeout=self.timeout).json()]
+            genesis = chain[0]
+            # Same countdown as Blocchain.submission_zero
+            self.zero = (genesis.timestamp - time.time()) // genesis.proof
+            grants = [Submission('STATION', ballot.public_key, self.zero, '',
+                                 len(self.candidate_keys))
+                      for ballot in self.__voters]
+            recent = chain[-RETARGET_INTERVAL:]
+            difficulty = Verification.next_difficulty(recent)
+            last_hash = hash_bloc(chain[-1])
+            proof = 0
+            while not Verification.valid_proof(grants[:-1], last_hash, proof,
+                                               difficulty):
+                proof += 1
+            median = Verification.median_time(recent)
+            timestamp = time.time()
+            if median is not None:
+                timestamp = max(timestamp, median + 1)
+            bloc = Bloc(len(chain), last_hash, grants, proof, timestamp,
+                        difficulty).__dict__.copy()
+            bloc['submissions'] = [tx.__dict__ for tx in grants]
+            statuses = {}
+            for node in self.nodes:
+                try:
+                    statuses[node] = requests.post(
+                        'http://{}/broadcast-bloc'.format(node),
+                        json={'bloc': bloc}, timeout=self.timeout
+                    ).status_code
+                except requests.exceptions.RequestException as e:
+                    statuses[node] = type(e).__name__
+            if statuses[self.nodes[0]] == 201:
+                return statuses
+        raise RuntimeError('The voters could not be granted their votes: '
+                           '{}'.format(statuses))
+
+    def votes_left(self):
+        """Returns the number of fresh votes /broadcast-submission can still
+        send."""
+        with self.__lock:
+            return len(self.__votes)
+
+    def __next_vote(self):
+        """Returns a freshly signed submission of a voter who didn't vote
+        for that candidate yet (None once all did)."""
+        with self.__lock:
+            if not self.__votes:
+                return None
+            ballot, candidate = self.__votes.pop()
+        return {
+            'voter': ballot.public_key,
+            'candidate': candidate,
+            'zero': self.zero,
+            'amount': 1,
+            'signature': ballot.sign_submission(
+                ballot.public_key, candidate, self.zero, 1)
+        }
+
+    def __session(self):
+        if not hasattr(self.__local, 'session'):
+            self.__local.session = requests.Session()
+        return self.__local.session
+
+    def chain_lengths(self):
+        """Returns the chain length of every reachable node."""
+        lengths = {}
+        for node in self.nodes:
+            try:
+                lengths[node] = len(requests.get(
+                    'http://{}/chain'.format(node),
+                    timeout=self.timeout).json())
+            except (requests.exceptions.RequestException, ValueError):
+                lengths[node] = None
+        return lengths
+
+    def pick(self):
+        """Chooses the endpoint and node of the next request."""
+        endpoints = [endpoint for endpoint in ENDPOINTS
+                     if self.mix.get(endpoint)]
+        if 'broadcast-submission' in endpoints and not self.votes_left():
+            endpoints.remove('broadcast-submission')
+        endpoint = self.random.choices(
+            endpoints, [self.mix[endpoint] for endpoint in endpoints])[0]
+        return endpoint, self.random.choice(self.nodes)
+
+    def send(self, endpoint, node, scheduled=None):
+        """Sends one request and records its latency and status.
+
+        Arguments:
+            :endpoint: The endpoint (see ENDPOINTS).
+            :node: The node address.
+            :scheduled: When the request was due (open loop). The latency is
+            measured from then, so time spent queued behind slow requests
+            counts too.
+        """
+        url = 'http://{}/{}'.format(node, endpoint)
+        session = self.__session()
+        payload = None
+        if endpoint == 'broadcast-submission':
+            # Every request carries a vote the node didn't see before
+            payload = self.__next_vote()
+            if payload is None:
+                return
+        started = time.time() if scheduled is None else scheduled
+        try:
+            if endpoint == 'submission':
+                response = session.post(url, json={
+                    'candidate': self.random.choice(self.candidate_keys),
+                    'amount': 1}, timeout=self.timeout)
+            elif endpoint == 'broadcast-submission':
+                response = session.post(url, json=payload,
+                                        timeout=self.timeout)
+            elif endpoint == 'mine':
+                response = session.post(url, timeout=self.timeout)
+            else:
+                response = session.get(url, timeout=self.timeout)
+            status = response.status_code
+        except requests.exceptions.RequestException as e:
+            status = type(e).__name__
+        latency = time.time() - started
+        with self.__lock:
+            self.__latencies[endpoint].append((str(status), latency))
+            self.__statuses[endpoint][str(status)] += 1
+
+    def run_rate(self, rate, duration, concurrency):
+        """Sends requests at a fixed rate (open loop)."""
+        with ThreadPoolExecutor(concurrency) as executor:
+            started = time.time()
+            sent = 0
+            while time.time() - started < duration:
+                due = started + sent / rate
+                if due > time.time():
+                    time.sleep(due - time.time())
+                endpoint, node = self.pick()
+                executor.submit(self.send, endpoint, node, due)
+                sent += 1
+
+    def run_concurrency(self, concurrency, duration):
+        """Keeps a number of clients busy sending requests (closed loop)."""
+        deadline = time.time() + duration
+
+        def client():
+            while time.time() < deadline:
+                self.send(*self.pick())
+
+        with ThreadPoolExecutor(concurrency) as executor:
+            for _ in range(concurrency):
+                executor.submit(client)
+
+    def report(self, seconds):
+        """Returns the recorded results per endpoint."""
+        endpoints = {}
+        with self.__lock:
+            for endpoint, latencies in self.__latencies.items():
+                statuses = dict(self.__statuses[endpoint])
+                accepted = [latency for status, latency in latencies
+                            if status.startswith('2')]
+                # Answers other than 2xx; exceptions never reached the node
+                rejected = [latency for status, latency in latencies
+                            if status.isdigit() and not status.startswith('2')]
+                failed = len(latencies) - len(accepted) - len(rejected)
+                endpoints[endpoint] = {
+                    'requests': len(latencies),
+                    'per_second': len(latencies) / seconds,
+                    'accepted': len(accepted),
+                    'accepted_per_second': len(accepted) / seconds,
+                    'rejected': len(rejected),
+                    'failed': failed,
+                    'error_rate': 1 - len(accepted) / len(latencies),
+                    'statuses': statuses,
+                    'latency_seconds': percentiles(
+                        [latency for _, latency in latencies]),
+                    'accepted_latency_seconds': percentiles(accepted),
+                    'rejected_latency_seconds': percentiles(rejected)
+                }
+        return endpoints
+
+
+def parse_mix(value):
+    """Parses 'submission=5,mine=1' into {'submission': 5.0, 'mine': 1.0}."""
+    mix = {}
+    for part in value.split(','):
+        endpoint, _, weight = part.partition('=')
+        if endpoint not in ENDPOINTS:
+            raise ValueError('Unknown endpoint {}'.format(endpoint))
+        mix[endpoint] = float(weight or 1)
+    return mix
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--nodes', nargs='+', default=['localhost:8105'])
+    parser.add_argument('--mix', type=parse_mix,
+                        default='submission=5,broadcast-submission=3,'
+                                'mine=1,chain=1',
+                        help='endpoint weights, e.g. submission=5,mine=1')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='requests per second (default: closed loop)')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--voters', type=int, default=100,
+                        help='voters for broadcast-submission, each votes '
+                             'once per candidate')
+    parser.add_argument('--candidates', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--report', default=None,
+                        help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    generator = LoadGenerator(args.nodes, args.mix, args.voters,
+                              args.candidates, args.timeout, args.seed)
+    grants = generator.grant_votes()
+    lengths_before = generator.chain_lengths()
+    started = time.time()
+    if args.rate:
+        generator.run_rate(args.rate, args.duration, args.concurrency)
+    else:
+        generator.run_concurrency(args.concurrency, args.duration)
+    seconds = time.time() - started
+    lengths_after = generator.chain_lengths()
+    report = {
+        'started': started,
+        'seconds': seconds,
+        'settings': {
+            'nodes': args.nodes,
+            'mix': args.mix,
+            'rate': args.rate,
+            'concurrency': args.concurrency,
+            'duration': args.duration
+        },
+        'endpoints': generator.report(seconds),
+        # What the nodes answered the bloc granting the voters' votes
+        'grants': grants,
+        'votes_left': generator.votes_left(),
+        'chain_growth': {
+            node: {
+                'before': lengths_before[node],
+                'after': lengths_after[node]
+            } for node in args.nodes
+        }
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.report:
+        with open(args.report, mode='w') as f:
+            f.write(output)
+    print(output)
@@ -0,0 +1,200 @@
+from collections import OrderedDict, deque
+import logging
+import threading
+import time
+
+from utility.stats import percentiles
+
+logger = logging.getLogger(__name__)
+
+
+class MiningScheduler:
+    """Seals blocs in the background instead of waiting for POST /mine.
+
+    A bloc is mined as soon as the open submissions reach max_submissions or
+    the oldest of them has waited max_age seconds. Mining runs on its own
+    thread; when a peer's bloc is accepted (or the chain is replaced) the
+    running proof search is aborted and started again on the new tip.
+
+    Attributes:
+        :blocchain: The blocchain which is mined.
+        :max_submissions: Pool size which triggers mining.
+        :max_age: Age in seconds of the oldest open submission which triggers
+        mining.
+        :blocs_mined: The number of blocs this scheduler added.
+        :aborted: The number of proof searches which were abandoned.
+        :resolves: The number of conflict resolutions it ran (a peer
+        rejected a bloc or announced one far ahead).
+        :max_resolve_backoff: The most seconds between two resolutions
+        while the conflicts keep coming.
+        :pool: An optional FairPool which runs the proof searches (shared
+        by the elections of a node), pool_key names this chain's queue.
+    """
+
+    def __init__(self, blocchain, max_submissions=10, max_age=30.0,
+                 retry_interval=1.0, history=1000, pool=None,
+                 pool_key=None, max_resolve_backoff=60.0):
+        self.blocchain = None
+        self.pool = pool
+        self.pool_key = pool_key
+        self.max_submissions = max_submissions
+        self.max_age = max_age
+        self.retry_interval = retry_interval
+        self.max_resolve_backoff = max_resolve_backoff
+        self.blocs_mined = 0
+        self.aborted = 0
+        self.resolves = 0
+        # The earliest time of the next resolution and the wait after it
+        self.__next_resolve = 0.0
+        self.__resolve_backoff = retry_interval
+        # Arrival time of every open submission, keyed by its signature
+        self.__arrivals = OrderedDict()
+        # Seconds between arrival and inclusion of the last submissions
+        self.__latencies = deque(maxlen=history)
+        self.__lock = threading.Lock()
+        self.__wakeup = threading.Event()
+        self.__abort = threading.Event()
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.attach(blocchain)
+
+    def attach(self, blocchain):
+        """Switches the scheduler to another blocchain instance.
+
+        Arguments:
+            :blocchain: The blocchain which should be mined from now on.
+        """
+        if self.blocchain is not None:
+            self.blocchain.remove_listener(self.__on_event)
+            self.__abort.set()
+        self.blocchain = blocchain
+        now = time.time()
+        with self.__lock:
+            self.__arrivals = OrderedDict(
+                (tx.signature, now)
+                for tx in blocchain.get_open_submissions())
+        blocchain.add_listener(self.__on_event)
+        self.__wakeup.set()
+
+    def start(self):
+        """Starts the mining thread."""
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run,
+                                         name='mining-scheduler')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """Stops the mining thread and aborts a running proof search."""
+        self.__stop.set()
+        self.__abort.set()
+        self.__wakeup.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __on_event(self, event, data):
+        now = time.time()
+        with self.__lock:
+            if event == 'submission':
+                self.__arrivals[data['submission'].signature] = now
+            elif event == 'bloc':
+                for tx in data['bloc'].submissions:
+                    arrived = self.__arrivals.pop(tx.signature, None)
+                    if arrived is not None:
+                        self.__latencies.append(now - arrived)
+                if data['source'] == 'peer':
+                    self.__abort.set()
+            elif event == 'chain':
+                # The open submissions were dropped with the old chain
+                open_signatures = set(
+                    tx.signature
+                    for tx in self.blocchain.get_open_submissions())
+                for signature in list(self.__arrivals):
+                    if signature not in open_signatures:
+                        del self.__arrivals[signature]
+                self.__abort.set()
+        self.__wakeup.set()
+
+    def __seconds_until_due(self):
+        """Returns 0 if a bloc should be mined now, the seconds until the
+        oldest submission gets too old otherwise (None if there is none)."""
+        with self.__lock:
+            if not self.__arrivals:
+                return None
+            if len(self.__arrivals) >= self.max_submissions:
+                return 0
+            oldest = next(iter(self.__arrivals.values()))
+        return max(oldest + self.max_age - time.time(), 0)
+
+    def __run(self):
+        while not self.__stop.is_set():
+            wait = self.__seconds_until_due()
+            if wait != 0:
+                self.__wakeup.wait(wait)
+                self.__wakeup.clear()
+                continue
+            if self.blocchain.resolve_conflicts:
+                self.__resolve()
+                continue
+            self.__abort.clear()
+            try:
+                if self.pool is not None:
+                    bloc = self.pool.submit(
+                        self.pool_key, self.blocchain.mine_bloc,
+                        abort=self.__abort).result()
+                else:
+                    bloc = self.blocchain.mine_bloc(abort=self.__abort)
+            except Exception as e:
+                logger.exception('Background mining failed: %s', e)
+                bloc = None
+            if bloc is not None:
+                self.blocs_mined += 1
+                self.__resolve_backoff = self.retry_interval
+            elif self.__abort.is_set():
+                # The tip moved, start over right away
+                self.aborted += 1
+            else:
+                self.__stop.wait(self.retry_interval)
+
+    def __resolve(self):
+        """Replaces the chain with the longest valid one of the peers, at
+        growing intervals while no bloc gets mined in between."""
+        wait = self.__next_resolve - time.time()
+        if wait > 0:
+            self.__stop.wait(wait)
+            return
+        try:
+            if self.pool is not None:
+                self.pool.submit(self.pool_key,
+                                 self.blocchain.resolve).result()
+            else:
+                self.blocchain.resolve()
+            self.resolves += 1
+        except Exception as e:
+            logger.exception('Resolving conflicts failed: %s', e)
+        self.__next_resolve = time.time() + self.__resolve_backoff
+        self.__resolve_backoff = min(2 * self.__resolve_backoff,
+                                     self.max_resolve_backoff)
+
+    def get_stats(self):
+        """Returns the scheduler settings, the pool state and the inclusion
+        latency percentiles (in seconds)."""
+        now = time.time()
+        with self.__lock:
+            pending = len(self.__arrivals)
+            oldest = next(iter(self.__arrivals.values()), None)
+            latencies = list(self.__latencies)
+        return {
+            'running': self.__thread is not None and self.__thread.is_alive(),
+            'max_submissions': self.max_submissions,
+            'max_age': self.max_age,
+            'pending': pending,
+            'oldest_age': None if oldest is None else now - oldest,
+            'blocs_mined': self.blocs_mined,
+            'aborted': self.aborted,
+            'resolves': self.resolves,
+            'inclusion_latency': percentiles(latencies)
+        }
@@ -1,11 +1,88 @@
-from flask import Flask, jsonify, request, send_from_directory
+import logging
+
+from flask import (Blueprint, Flask, Response, abort, g, jsonify, request,
+                   send_from_directory)
 from flask_cors import CORS
+from werkzeug.local import LocalProxy
 
 from ballot import Ballot
-from blocchain import Blocchain
+from elections import Election, FairPool, parse_election
+from utility.profiler import ProfilerBusy, profile_capture
+from utility.tracing import JsonFileSink, tracer
 
 app = Flask(__name__)
 CORS(app)
+# The endpoints of a chain: served for the node's own chain at / and for
+# every hosted election at /election/<election>/
+chain_api = Blueprint('chain', __name__)
+
+# The node's own chain
+default_election = None
+# The hosted elections by name (--election)
+elections = {}
+# Runs the mining and chain resolution of all elections
+fair_pool = None
+# The blocchain of the election the current request is for
+blocchain = LocalProxy(lambda: g.election.blocchain)
+
+
+def all_elections():
+    return [default_election] + list(elections.values())
+
+
+def too_many_requests(rejection):
+    """Builds the 429 response for a submission which was not admitted."""
+    retry_after, message = rejection
+    response = jsonify({'message': message})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+
+@app.before_request
+def start_trace():
+    tracer.start('{} {}'.format(request.method, request.path))
+    g.profile = profile_capture.begin_request()
+
+
+@chain_api.url_value_preprocessor
+def select_election(endpoint, values):
+    name = values.pop('election', None) if values else None
+    if name is None:
+        g.election = default_election
+    else:
+        g.election = elections.get(name)
+        if g.election is None:
+            abort(404)
+
+
+@chain_api.before_request
+def require_loaded():
+    # The chain is loaded in the background after the server came up
+    if not g.election.ready.is_set():
+        response = {
+            'message': 'The chain is still loading.',
+            'error': g.election.load_error
+        }
+        response = jsonify(response)
+        response.headers['Retry-After'] = '1'
+        return response, 503
+
+
+@app.after_request
+def acknowledge_persisted(response):
+    # In group commit mode changes are acknowledged once they are on disk
+    election = g.get('election')
+    if election is not None and election.ready.is_set():
+        if not election.blocchain.persistence.wait():
+            response = jsonify({'message': 'Saving the change failed.'})
+            response.status_code = 500
+    return response
+
+
+@app.teardown_request
+def finish_trace(exception=None):
+    profile_capture.end_request(g.pop('profile', None))
+    tracer.finish()
 
 
 @app.route('/', methods=['GET'])
@@ -18,16 +95,59 @@ def get_network_ui():
     return send_from_directory('ui', 'network.html')
 
 
+@app.route('/health', methods=['GET'])
+def get_health():
+    # The process is up, whether or not the chains are loaded yet
+    return jsonify({'status': 'ok'}), 200
+
+
+@app.route('/ready', methods=['GET'])
+def get_ready():
+    loading = [election.name for election in all_elections()
+               if not election.ready.is_set()]
+    response = {
+        'ready': not loading,
+        'loading': loading,
+        'errors': {election.name: election.load_error
+                   for election in all_elections() if election.load_error}
+    }
+    return jsonify(response), 503 if loading else 200
+
+
+def own_funds():
+    """Returns the balance on the node's own chain (None while it loads)."""
+    if not default_election.ready.is_set():
+        return None
+    return default_election.blocchain.get_balance()
+
+
+@chain_api.route('/events', methods=['GET'])
+def get_events():
+    event_stream = g.election.event_stream
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID'))
+    except (TypeError, ValueError):
+        last_event_id = None
+    subscription = event_stream.subscribe(last_event_id)
+    response = Response(event_stream.stream(subscription),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Keep reverse proxies from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @app.route('/ballot', methods=['POST'])
 def create_keys():
     ballot.create_keys()
     if ballot.save_keys():
-        global blocchain
-        blocchain = Blocchain(ballot.public_key, port)
+        # The loaded chains are kept, only the key changes
+        for election in all_elections():
+            election.set_public_key(ballot.public_key)
         response = {
             'public_key': ballot.public_key,
             'private_key': ballot.private_key,
-            'funds': blocchain.get_balance()
+            'funds': own_funds()
         }
         return jsonify(response), 201
     else:
@@ -40,12 +160,13 @@ def create_keys():
 @app.route('/ballot', methods=['GET'])
 def load_keys():
     if ballot.load_keys():
-        global blocchain
-        blocchain = Blocchain(ballot.public_key, port)
+        # The loaded chains are kept, only the key changes
+        for election in all_elections():
+            election.set_public_key(ballot.public_key)
         response = {
             'public_key': ballot.public_key,
             'private_key': ballot.private_key,
-            'funds': blocchain.get_balance()
+            'funds': own_funds()
         }
         return jsonify(response), 201
     else:
@@ -55,7 +176,7 @@ def load_keys():
         return jsonify(response), 500
 
 
-@app.route('/balance', methods=['GET'])
+@chain_api.route('/balance', methods=['GET'])
 def get_balance():
     balance = blocchain.get_balance()
     if balance is not None:
@@ -72,7 +193,7 @@ def get_balance():
         return jsonify(response), 500
 
 
-@app.route('/broadcast-submission', methods=['POST'])
+@chain_api.route('/broadcast-submission', methods=['POST'])
 def broadcast_submission():
     values = request.get_json()
     if not values:
@@ -82,6 +203,11 @@ def broadcast_submission():
     if not all(key in values for key in required):
         response = {'message': 'Some data is missing.'}
         return jsonify(response), 400
+    rejection = blocchain.admit_submission(
+        values['voter'], values['candidate'], values['signature'],
+        peer=request.remote_addr)
+    if rejection is not None:
+        return too_many_requests(rejection)
     success = blocchain.add_submission(
         values['candidate'],
         values['voter'],
@@ -108,7 +234,7 @@ def broadcast_submission():
         return jsonify(response), 500
 
 
-@app.route('/broadcast-bloc', methods=['POST'])
+@chain_api.route('/broadcast-bloc', methods=['POST'])
 def broadcast_bloc():
     values = request.get_json()
     if not values:
@@ -118,17 +244,26 @@ def broadcast_bloc():
         response = {'message': 'Some data is missing.'}
         return jsonify(response), 400
     bloc = values['bloc']
-    if bloc['index'] == blocchain.chain[-1].index + 1:
-        if blocchain.add_bloc(bloc):
-            response = {'message': 'Bloc added'}
-            return jsonify(response), 201
-        else:
-            response = {'message': 'Bloc seems invalid.'}
-            return jsonify(response), 409
-    elif bloc['index'] > blocchain.chain[-1].index:
+    status = blocchain.receive_bloc(bloc)
+    if status == 'added':
+        response = {'message': 'Bloc added'}
+        return jsonify(response), 201
+    elif status == 'reorganised':
+        response = {'message': 'Bloc added, switched to its branch'}
+        return jsonify(response), 201
+    elif status == 'buffered':
+        response = {'message': 'Bloc buffered until its branch connects '
+                               'or outweighs the chain.'}
+        return jsonify(response), 202
+    elif status == 'known':
+        response = {'message': 'Bloc already known.'}
+        return jsonify(response), 200
+    elif status == 'invalid':
+        response = {'message': 'Bloc seems invalid.'}
+        return jsonify(response), 409
+    elif status == 'resolve':
         response = {
             'message': 'Blocchain seems to differ from local blocchain.'}
-        blocchain.resolve_conflicts = True
         return jsonify(response), 200
     else:
         response = {
@@ -136,7 +271,7 @@ def broadcast_bloc():
         return jsonify(response), 409
 
 
-@app.route('/submission', methods=['POST'])
+@chain_api.route('/submission', methods=['POST'])
 def add_submission():
     if ballot.public_key is None:
         response = {
@@ -158,6 +293,9 @@ def add_submission():
     candidate = values['candidate']
     amount = 1
     zero = blocchain.submission_zero()
+    rejection = blocchain.admit_submission(ballot.public_key, candidate, '')
+    if rejection is not None:
+        return too_many_requests(rejection)
     signature = ballot.sign_submission(ballot.public_key, candidate, zero, amount)
     success = blocchain.add_submission(
         candidate, ballot.public_key, zero, signature, amount)
@@ -181,12 +319,12 @@ def add_submission():
         return jsonify(response), 500
 
 
-@app.route('/mine', methods=['POST'])
+@chain_api.route('/mine', methods=['POST'])
 def mine():
     if blocchain.resolve_conflicts:
         response = {'message': 'Resolve conflicts first, bloc not added!'}
         return jsonify(response), 409
-    bloc = blocchain.mine_bloc()
+    bloc = g.election.run(blocchain.mine_bloc)
     if bloc is not None:
         dict_bloc = bloc.__dict__.copy()
         dict_bloc['submissions'] = [
@@ -205,23 +343,71 @@ def mine():
         return jsonify(response), 500
 
 
-@app.route('/resolve-conflicts', methods=['POST'])
+@chain_api.route('/miner', methods=['GET'])
+def get_miner():
+    miner = g.election.miner
+    if miner is None:
+        response = {'message': 'Auto mining is disabled.'}
+        return jsonify(response), 404
+    return jsonify(miner.get_stats()), 200
+
+
+@app.route('/admin/profile', methods=['POST'])
+def capture_profile():
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        response = {'message': 'Profiling is only allowed from localhost.'}
+        return jsonify(response), 403
+    values = request.get_json(silent=True) or {}
+    mode = values.get('mode', 'cprofile')
+    if mode not in ('cprofile', 'sample'):
+        response = {'message': 'Unknown profiling mode.'}
+        return jsonify(response), 400
+    try:
+        seconds = min(float(values.get('seconds', 10)), 300.0)
+        limit = int(values.get('limit', 30))
+    except (TypeError, ValueError):
+        response = {'message': 'Invalid seconds or limit.'}
+        return jsonify(response), 400
+    try:
+        report = profile_capture.capture(seconds, mode, limit)
+    except ProfilerBusy as e:
+        response = {'message': str(e)}
+        return jsonify(response), 409
+    return jsonify(report), 200
+
+
+@chain_api.route('/persistence', methods=['GET'])
+def get_persistence():
+    return jsonify(blocchain.persistence.get_stats()), 200
+
+
+@app.route('/elections', methods=['GET'])
+def get_elections():
+    response = {
+        'elections': [election.get_info()
+                      for election in elections.values()],
+        'pool': fair_pool.pending() if fair_pool is not None else None
+    }
+    return jsonify(response), 200
+
+
+@chain_api.route('/resolve-conflicts', methods=['POST'])
 def resolve_conflicts():
-    replaced = blocchain.resolve()
+    replaced = g.election.run(blocchain.resolve)
     if replaced:
         response = {'message': 'Chain was replaced!'}
     else:
         response = {'message': 'Local chain kept!'}
     return jsonify(response), 200
 
-@app.route('/submissions', methods=['GET'])
+@chain_api.route('/submissions', methods=['GET'])
 def get_open_submission():
     submissions = blocchain.get_open_submissions()
     dict_submissions = [tx.__dict__ for tx in submissions]
     return jsonify(dict_submissions), 200
 
 
-@app.route('/chain', methods=['GET'])
+@chain_api.route('/chain', methods=['GET'])
 def get_chain():
     chain_snapshot = blocchain.chain
     dict_chain = [bloc.__dict__.copy() for bloc in chain_snapshot]
@@ -231,7 +417,51 @@ def get_chain():
     return jsonify(dict_chain), 200
 
 
-@app.route('/node', methods=['POST'])
+@chain_api.route('/bloc/<int:index>', methods=['GET'])
+def get_bloc(index):
+    record = blocchain.bloc_store.get(index)
+    if record is None:
+        response = {'message': 'Bloc not found.'}
+        return jsonify(response), 404
+    # The stored record is sent as it is, without parsing it again
+    return Response(bytes(record), mimetype='application/json'), 200
+
+
+@chain_api.route('/bloc/hash/<bloc_hash>', methods=['GET'])
+def get_bloc_by_hash(bloc_hash):
+    record = blocchain.bloc_store.get_by_hash(bloc_hash)
+    if record is None:
+        response = {'message': 'Bloc not found.'}
+        return jsonify(response), 404
+    return Response(bytes(record), mimetype='application/json'), 200
+
+
+@chain_api.route('/stats', methods=['GET'])
+def get_stats():
+    # numpy is only loaded once statistics are asked for
+    import analytics
+    election = g.election
+    names = request.args.getlist('report') or None
+    if names and any(name not in analytics.REPORTS for name in names):
+        response = {
+            'message': 'Unknown report.',
+            'reports': sorted(analytics.REPORTS)
+        }
+        return jsonify(response), 400
+    with election.stats_lock:
+        if election.chain_columns is None:
+            try:
+                election.chain_columns = analytics.ChainColumns()
+            except ImportError as e:
+                response = {'message': str(e)}
+                return jsonify(response), 501
+        # Only the blocs added since the last request are converted
+        election.chain_columns.sync(blocchain.chain)
+        reports = analytics.build_reports(election.chain_columns, names)
+    return jsonify(reports), 200
+
+
+@chain_api.route('/node', methods=['POST'])
 def add_node():
     values = request.get_json()
     if not values:
@@ -253,7 +483,7 @@ def add_node():
     return jsonify(response), 201
 
 
-@app.route('/node/<node_url>', methods=['DELETE'])
+@chain_api.route('/node/<node_url>', methods=['DELETE'])
 def remove_node(node_url):
     if node_url == '' or node_url is None:
         response = {
@@ -268,25 +498,100 @@ def remove_node(node_url):
     return jsonify(response), 200
 
 
-@app.route('/nodes', methods=['GET'])
+@chain_api.route('/nodes', methods=['GET'])
 def get_nodes():
     nodes = blocchain.get_peer_nodes()
     response = {
-        'all_nodes': nodes
+        'all_nodes': nodes,
+        'peers': blocchain.get_peer_metadata()
     }
     return jsonify(response), 200
 
 
+app.register_blueprint(chain_api)
+app.register_blueprint(chain_api, url_prefix='/election/<election>',
+                       name='election')
+
+
 if __name__ == '__main__':
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', type=int, default=8105)
+    parser.add_argument('--auto-mine', action='store_true',
+                        help='seal blocs in the background')
+    parser.add_argument('--mine-size', type=int, default=10,
+                        help='open submissions which trigger auto mining')
+    parser.add_argument('--mine-age', type=float, default=30.0,
+                        help='seconds the oldest submission may wait')
+    parser.add_argument('--max-pool', type=int, default=5000,
+                        help='maximum number of open submissions')
+    parser.add_argument('--max-pool-bytes', type=int,
+                        default=8 * 1024 * 1024,
+                        help='maximum size of the open submissions')
+    parser.add_argument('--peer-rate', type=float, default=50.0,
+                        help='submissions per second accepted from a peer')
+    parser.add_argument('--voter-rate', type=float, default=0.2,
+                        help='submissions per second accepted per voter')
+    parser.add_argument('--durability', default='sync',
+                        choices=['sync', 'group', 'periodic'],
+                        help='write the data file per change, in groups of '
+                             'changes or periodically')
+    parser.add_argument('--commit-window', type=float, default=0.01,
+                        help='seconds a group commit waits for more changes')
+    parser.add_argument('--commit-interval', type=float, default=1.0,
+                        help='seconds between periodic writes')
+    parser.add_argument('--election', action='append', default=[],
+                        type=parse_election,
+                        help='host an election, name[:genesis_timestamp'
+                             '[:day_length]] (repeatable)')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='threads mining and resolving the elections')
+    parser.add_argument('--log-level', default='INFO',
+                        help='DEBUG, INFO, WARNING or ERROR')
+    parser.add_argument('--trace-threshold', type=float, default=0.5,
+                        help='seconds after which a request trace is logged')
+    parser.add_argument('--trace-file',
+                        help='append slow request traces to this JSON file')
     args = parser.parse_args()
+    logging.basicConfig(
+        level=args.log_level.upper(),
+        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    tracer.slow_threshold = args.trace_threshold
+    if args.trace_file:
+        tracer.sink = JsonFileSink(args.trace_file)
     port = args.port
+    persistence_options = {
+        'durability': args.durability,
+        'commit_window': args.commit_window,
+        'commit_interval': args.commit_interval
+    }
+    admission_options = {
+        'max_submissions': args.max_pool,
+        'max_bytes': args.max_pool_bytes,
+        'peer_rate': args.peer_rate,
+        'voter_rate': args.voter_rate,
+        'retry_after': int(args.mine_age)
+    }
+    miner_options = None
+    if args.auto_mine:
+        miner_options = {
+            'max_submissions': args.mine_size,
+            'max_age': args.mine_age
+        }
+    fair_pool = FairPool(args.workers)
     ballot = Ballot(port)
-    blocchain = Blocchain(ballot.public_key, port)
-
-    blocchain.add_peer_node('https://explorer.blocbit.net')
-
+    default_election = Election(
+        None, port, admission_options=admission_options,
+        persistence_options=persistence_options,
+        miner_options=miner_options, pool=fair_pool,
+        peer_nodes=['https://explorer.blocbit.net'])
+    for name, genesis_timestamp, genesis_proof in args.election:
+        elections[name] = Election(
+            name, port, genesis_timestamp, genesis_proof,
+            admission_options, persistence_options, miner_options,
+            fair_pool)
+    # The port is bound right away, the chains follow (see /ready)
+    for election in all_elections():
+        election.load_in_background()
 
     app.run(host='0.0.0.0', port=port)
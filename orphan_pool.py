@@ -0,0 +1,90 @@
+from collections import OrderedDict
+
+
+class OrphanPool:
+    """A bounded buffer for blocs which can't be appended to the local chain
+    (yet), either because their parent didn't arrive so far or because they
+    belong to a competing branch.
+
+    Blocs are keyed by the hash of their parent so a bloc's children can be
+    found as soon as it is connected. When the pool is full the oldest bloc
+    is dropped.
+
+    Attributes:
+        :max_blocs: The maximum number of buffered blocs.
+    """
+
+    def __init__(self, max_blocs=64):
+        self.max_blocs = max_blocs
+        # previous_hash -> {bloc hash: bloc}
+        self.__by_parent = {}
+        # bloc hash -> previous_hash, in arrival order
+        self.__arrivals = OrderedDict()
+
+    def __len__(self):
+        return len(self.__arrivals)
+
+    def __contains__(self, bloc_hash):
+        return bloc_hash in self.__arrivals
+
+    def add(self, bloc, bloc_hash):
+        """Buffers a bloc. Returns False if it is already buffered.
+
+        Arguments:
+            :bloc: The bloc (a Bloc object).
+            :bloc_hash: The hash of the bloc.
+        """
+        if bloc_hash in self.__arrivals:
+            return False
+        while len(self.__arrivals) >= self.max_blocs:
+            oldest = next(iter(self.__arrivals))
+            self.remove(oldest)
+        self.__arrivals[bloc_hash] = bloc.previous_hash
+        self.__by_parent.setdefault(
+            bloc.previous_hash, OrderedDict())[bloc_hash] = bloc
+        return True
+
+    def remove(self, bloc_hash):
+        """Drops a bloc from the pool (if it is buffered).
+
+        Arguments:
+            :bloc_hash: The hash of the bloc.
+        """
+        parent_hash = self.__arrivals.pop(bloc_hash, None)
+        if parent_hash is None:
+            return
+        children = self.__by_parent[parent_hash]
+        del children[bloc_hash]
+        if not children:
+            del self.__by_parent[parent_hash]
+
+    def children(self, parent_hash):
+        """Returns (hash, bloc) pairs of all buffered children of a bloc.
+
+        Arguments:
+            :parent_hash: The hash of the parent bloc.
+        """
+        return list(self.__by_parent.get(parent_hash, {}).items())
+
+    def longest_branch(self, parent_hash, parent_index):
+        """Returns the longest chain of buffered blocs (as (hash, bloc) pairs)
+        which grows from the given parent. Blocs whose index doesn't follow
+        their parent's are not followed.
+
+        Arguments:
+            :parent_hash: The hash of the bloc the branch starts at.
+            :parent_index: The index of that bloc.
+        """
+        best = []
+        # Depth first search over (hash, index, branch so far)
+        stack = [(parent_hash, parent_index, [])]
+        while stack:
+            bloc_hash, index, branch = stack.pop()
+            if len(branch) > len(best):
+                best = branch
+            for child_hash, child in self.children(bloc_hash):
+                if child.index != index + 1:
+                    continue
+                stack.append((child_hash, child.index,
+                              branch + [(child_hash, child)]))
+        return best
@@ -0,0 +1,148 @@
+import threading
+import time
+
+
+class PeerManager:
+    """Keeps the peer nodes together with their health: round trip time,
+    failure rate and the last chain height seen from them. Peers which fail
+    are skipped for an exponentially growing time.
+
+    Attributes:
+        :base_backoff: Seconds a peer is skipped after its first failure.
+        :max_backoff: The longest a peer is skipped.
+        :clock: Returns the current time (default: time.time).
+    """
+
+    # Weight of the newest measurement in the moving averages
+    SMOOTHING = 0.2
+
+    def __init__(self, base_backoff=2.0, max_backoff=300.0, clock=time.time):
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.__peers = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__peers)
+
+    def __contains__(self, node):
+        return node in self.__peers
+
+    @staticmethod
+    def __new_stats():
+        return {
+            'rtt': None,
+            'failure_rate': 0.0,
+            'successes': 0,
+            'failures': 0,
+            'consecutive_failures': 0,
+            'last_seen': None,
+            'height': None,
+            'retry_at': 0.0
+        }
+
+    def add(self, node, stats=None):
+        """Adds a peer (keeping its stats if it is known already).
+
+        Arguments:
+            :node: The node URL.
+            :stats: Previously saved stats of the peer (optional).
+        """
+        with self.__lock:
+            if node not in self.__peers:
+                self.__peers[node] = self.__new_stats()
+            if stats:
+                self.__peers[node].update(
+                    (key, value) for key, value in stats.items()
+                    if key in self.__peers[node])
+
+    def discard(self, node):
+        """Removes a peer if it is known."""
+        with self.__lock:
+            self.__peers.pop(node, None)
+
+    def nodes(self):
+        """Returns all peer URLs."""
+        with self.__lock:
+            return list(self.__peers)
+
+    def record_success(self, node, rtt):
+        """Records an answered request.
+
+        Arguments:
+            :node: The node URL.
+            :rtt: The seconds the request took.
+        """
+        with self.__lock:
+            stats = self.__peers.get(node)
+            if stats is None:
+                return
+            if stats['rtt'] is None:
+                stats['rtt'] = rtt
+            else:
+                stats['rtt'] += self.SMOOTHING * (rtt - stats['rtt'])
+            stats['failure_rate'] *= 1 - self.SMOOTHING
+            stats['successes'] += 1
+            stats['consecutive_failures'] = 0
+            stats['retry_at'] = 0.0
+            stats['last_seen'] = self.clock()
+
+    def record_height(self, node, height):
+        """Records the chain length a peer reported last. It may go down,
+        e.g. after the peer switched to a shorter chain with more work or
+        restarted with an empty store.
+
+        Arguments:
+            :node: The node URL.
+            :height: The number of blocs in its chain.
+        """
+        with self.__lock:
+            stats = self.__peers.get(node)
+            if stats is not None:
+                stats['height'] = height
+
+    def record_failure(self, node):
+        """Records a request which could not reach the peer and backs it
+        off."""
+        with self.__lock:
+            stats = self.__peers.get(node)
+            if stats is None:
+                return
+            stats['failure_rate'] += self.SMOOTHING * (
+                1 - stats['failure_rate'])
+            stats['failures'] += 1
+            stats['consecutive_failures'] += 1
+            backoff = min(
+                self.base_backoff * 2 ** (stats['consecutive_failures'] - 1),
+                self.max_backoff)
+            stats['retry_at'] = self.clock() + backoff
+
+    def __score(self, node):
+        stats = self.__peers[node]
+        rtt = stats['rtt'] if stats['rtt'] is not None else float('inf')
+        return (stats['failure_rate'], rtt)
+
+    def available(self):
+        """Returns the peers which are not backed off, best first."""
+        now = self.clock()
+        with self.__lock:
+            nodes = [node for node, stats in self.__peers.items()
+                     if stats['retry_at'] <= now]
+            return sorted(nodes, key=self.__score)
+
+    def height(self, node):
+        """Returns the last chain length seen from a peer (or None)."""
+        with self.__lock:
+            stats = self.__peers.get(node)
+            return None if stats is None else stats['height']
+
+    def get_metadata(self):
+        """Returns a copy of the stats of every peer."""
+        now = self.clock()
+        with self.__lock:
+            metadata = {}
+            for node, stats in self.__peers.items():
+                metadata[node] = dict(stats)
+                metadata[node]['healthy'] = stats['retry_at'] <= now
+            return metadata
@@ -0,0 +1,195 @@
+from collections import deque
+import threading
+import time
+
+from utility.stats import percentiles
+
+MODES = ('sync', 'group', 'periodic')
+
+
+class PersistenceWorker:
+    """Decides when the node's data file is written after a mutation.
+
+    Modes:
+        :sync: Every mutation is written (and fsynced) right away by the
+        thread which made it.
+        :group: Mutations are handed to a background thread which waits
+        window seconds for more of them and writes them all at once. The
+        request threads wait (see wait) until their mutation is on disk.
+        :periodic: The background thread writes every interval seconds;
+        nobody waits, so the last interval can be lost on a crash.
+
+    Attributes:
+        :save: Writes the current state, returns False if that failed.
+        :mode: One of MODES.
+        :window: Seconds a group commit waits for further mutations.
+        :interval: Seconds between two periodic writes.
+    """
+
+    def __init__(self, save, mode='sync', window=0.01, interval=1.0,
+                 history=1000):
+        if mode not in MODES:
+            raise ValueError('Unknown durability mode: {}'.format(mode))
+        self.save = save
+        self.mode = mode
+        self.window = window
+        self.interval = interval
+        self.commits = 0
+        self.failures = 0
+        # Number of mutations requested and written so far
+        self.__requested = 0
+        self.__committed = 0
+        # The last mutation a failed write tried to save
+        self.__failed = 0
+        self.__first_pending = None
+        self.__latencies = deque(maxlen=history)
+        self.__batch_sizes = deque(maxlen=history)
+        self.__waits = deque(maxlen=history)
+        self.__condition = threading.Condition()
+        self.__write_lock = threading.Lock()
+        self.__dirty = threading.Event()
+        self.__stop = threading.Event()
+        # The last ticket of each request thread
+        self.__local = threading.local()
+        self.__thread = None
+        if mode != 'sync':
+            self.__thread = threading.Thread(target=self.__run,
+                                             name='persistence')
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def request(self):
+        """Registers a mutation and returns its ticket. In sync mode it is
+        written before this returns."""
+        with self.__condition:
+            self.__requested += 1
+            ticket = self.__requested
+            if self.__first_pending is None:
+                self.__first_pending = time.time()
+        self.__local.ticket = ticket
+        if self.mode == 'sync':
+            self.__commit()
+        else:
+            self.__dirty.set()
+        return ticket
+
+    def wait(self, ticket=None, timeout=None):
+        """Blocks in group mode until a mutation is written. Returns False
+        if writing it failed or the timeout passed first (periodic mode
+        never waits and returns True).
+
+        Arguments:
+            :ticket: The ticket returned by request (default: the last one
+            of the current thread).
+            :timeout: The longest to wait in seconds.
+        """
+        if ticket is None:
+            ticket = self.take_ticket()
+        if ticket is None or self.mode == 'periodic':
+            return True
+        with self.__condition:
+            self.__condition.wait_for(
+                lambda: (self.__committed >= ticket or
+                         self.__failed >= ticket), timeout)
+            return self.__committed >= ticket
+
+    def take_ticket(self):
+        """Returns the current thread's last ticket (or None) and forgets
+        it."""
+        ticket = getattr(self.__local, 'ticket', None)
+        self.__local.ticket = None
+        return ticket
+
+    def adopt_ticket(self, ticket):
+        """Makes a ticket taken on another thread (e.g. by a pool job) the
+        current thread's, so wait() covers it."""
+        if ticket is None:
+            return
+        current = getattr(self.__local, 'ticket', None)
+        self.__local.ticket = ticket if current is None else max(current,
+                                                                 ticket)
+
+    def flush(self):
+        """Writes the pending mutations right away (e.g. on shutdown)."""
+        with self.__condition:
+            pending = self.__committed < self.__requested
+        if pending:
+            self.__commit()
+
+    def stop(self):
+        """Stops the background thread after writing what is pending."""
+        self.__stop.set()
+        self.__dirty.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        self.flush()
+
+    def __run(self):
+        while not self.__stop.is_set():
+            self.__dirty.wait()
+            if self.__stop.is_set():
+                break
+            # Give further mutations the chance to join this write
+            self.__stop.wait(self.window if self.mode == 'group'
+                             else self.interval)
+            self.__dirty.clear()
+            if not self.__commit():
+                # Try again, but don't hammer a failing disk
+                self.__stop.wait(self.interval)
+                self.__dirty.set()
+
+    def __commit(self):
+        """Writes the pending mutations, returns False if that failed."""
+        with self.__write_lock:
+            with self.__condition:
+                target = self.__requested
+                batch = target - self.__committed
+                first_pending = self.__first_pending
+                self.__first_pending = None
+            if batch <= 0:
+                return True
+            started = time.time()
+            saved = self.save()
+            finished = time.time()
+            with self.__condition:
+                self.commits += 1
+                self.__latencies.append(finished - started)
+                if saved is False:
+                    # The mutations stay pending for the next write; their
+                    # waiters are told it failed
+                    self.failures += 1
+                    self.__failed = max(self.__failed, target)
+                    if self.__first_pending is None:
+                        self.__first_pending = first_pending
+                    self.__condition.notify_all()
+                    return False
+                self.__committed = max(self.__committed, target)
+                self.__batch_sizes.append(batch)
+                if first_pending is not None:
+                    # How long the oldest mutation of the batch was unsaved
+                    self.__waits.append(finished - first_pending)
+                self.__condition.notify_all()
+                return True
+
+    def get_stats(self):
+        """Returns the mode, the counters and the percentiles of the write
+        latency, the batch size and the time mutations stayed unsaved (all
+        in seconds)."""
+        with self.__condition:
+            latencies = list(self.__latencies)
+            batch_sizes = list(self.__batch_sizes)
+            waits = list(self.__waits)
+            pending = self.__requested - self.__committed
+        return {
+            'mode': self.mode,
+            'window': self.window,
+            'interval': self.interval,
+            'commits': self.commits,
+            'failures': self.failures,
+            'mutations': self.__requested,
+            'pending': pending,
+            'commit_latency': percentiles(latencies),
+            'batch_size': percentiles(batch_sizes),
+            'unsaved_time': percentiles(waits)
+        }
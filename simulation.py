@@ -0,0 +1,483 @@
+"""Simulates a network of blocchain nodes inside one process.
+
+Every node is a real Blocchain instance; only its peer requests are routed
+through an in-memory transport with configurable latency, loss and
+partitions instead of HTTP. Time is virtual, so a run takes as long as the
+mining and signature checks need and works offline (e.g. in CI):
+
+    python simulation.py --sizes 3 5 8 --duration 120 --latency 0.2
+"""
+
+from argparse import ArgumentParser
+import heapq
+import json
+import os
+import random
+import tempfile
+import time
+
+from ballot import Ballot
+from bloc import Bloc
+from blocchain import GENESIS_PROOF, GENESIS_TIMESTAMP, Blocchain
+from peers import PeerManager
+from submission import Submission
+from utility.hash_util import hash_bloc
+from utility.stats import percentiles
+from utility.transport import PeerUnavailable
+from utility.verification import (DEFAULT_DIFFICULTY, TARGET_INTERVAL,
+                                  Verification)
+
+# The status codes node.py answers /broadcast-bloc with
+BLOC_STATUS_CODES = {
+    'added': 201,
+    'reorganised': 201,
+    'buffered': 202,
+    'known': 200,
+    'invalid': 409,
+    'resolve': 200,
+    'stale': 409
+}
+
+# The longest a node skips a failed peer (see PeerManager)
+PEER_MAX_BACKOFF = 300.0
+
+
+class SimResponse:
+    """A minimal stand-in for a requests response."""
+
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self.__data = data
+
+    def json(self):
+        return self.__data
+
+
+class InMemoryTransport:
+    """Routes the peer requests of one node to the other nodes of a
+    SimNetwork.
+
+    POST requests are delivered after the network latency (or lost) and
+    answered with 202 right away. GET requests are answered immediately.
+    Requests to hosts outside the network get a 404.
+
+    Attributes:
+        :network: The simulated network.
+        :source: The address of the sending node.
+    """
+
+    def __init__(self, network, source):
+        self.network = network
+        self.source = source
+
+    def get(self, url, **kwargs):
+        return self.network.request(self.source, url)
+
+    def post(self, url, json=None, **kwargs):
+        return self.network.send(self.source, url, json)
+
+
+class SimNode:
+    """A blocchain node of the simulation with its ballot and the peer
+    endpoints of node.py.
+
+    Attributes:
+        :address: The address the other nodes know this node by.
+        :ballot: The keys of the node.
+        :blocchain: The blocchain run by the node.
+    """
+
+    def __init__(self, address, ballot, blocchain):
+        self.address = address
+        self.ballot = ballot
+        self.blocchain = blocchain
+
+    def handle(self, path, payload):
+        """Answers a peer request like node.py would and returns a
+        SimResponse.
+
+        Arguments:
+            :path: The endpoint path (e.g. '/broadcast-bloc').
+            :payload: The JSON payload of the request (or None).
+        """
+        if path == '/chain':
+            dict_chain = [bloc.__dict__.copy()
+                          for bloc in self.blocchain.chain]
+            for dict_bloc in dict_chain:
+                dict_bloc['submissions'] = [
+                    tx.__dict__.copy() for tx in dict_bloc['submissions']]
+            return SimResponse(200, dict_chain)
+        if path == '/broadcast-submission':
+            success = self.blocchain.add_submission(
+                payload['candidate'],
+                payload['voter'],
+                payload['zero'],
+                payload['signature'],
+                payload['amount'],
+                is_receiving=True)
+            return SimResponse(201 if success else 500)
+        if path == '/broadcast-bloc':
+            status = self.blocchain.receive_bloc(payload['bloc'])
+            return SimResponse(BLOC_STATUS_CODES[status], status)
+        return SimResponse(404)
+
+
+class SimNetwork:
+    """A virtual clock and message queue connecting SimNodes.
+
+    Attributes:
+        :latency: Base one-way delay of a message in (virtual) seconds.
+        :jitter: Maximum random delay added to the latency.
+        :loss: Probability that a message is dropped.
+        :clock: The current virtual time.
+        :nodes: The nodes by address.
+    """
+
+    def __init__(self, latency=0.1, jitter=0.05, loss=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.clock = 0.0
+        self.nodes = {}
+        self.messages_sent = 0
+        self.messages_lost = 0
+        self.__groups = None
+        self.__queue = []
+        self.__sequence = 0
+        self.__delivery_hooks = []
+
+    def add_node(self, node):
+        self.nodes[node.address] = node
+
+    def partition(self, *groups):
+        """Splits the network; nodes of different groups can't talk.
+
+        Arguments:
+            :groups: Lists of node addresses.
+        """
+        self.__groups = {}
+        for number, group in enumerate(groups):
+            for address in group:
+                self.__groups[address] = number
+
+    def heal(self):
+        """Removes a partition."""
+        self.__groups = None
+
+    def reachable(self, source, target):
+        if self.__groups is None:
+            return True
+        return self.__groups.get(source) == self.__groups.get(target)
+
+    def on_delivery(self, hook):
+        """Registers hook(source, target, path, response) which is called
+        after every delivered POST."""
+        self.__delivery_hooks.append(hook)
+
+    def schedule(self, delay, action):
+        """Runs action() after delay virtual seconds."""
+        self.__sequence += 1
+        heapq.heappush(self.__queue,
+                       (self.clock + delay, self.__sequence, action))
+
+    def run(self, until=None):
+        """Processes events in time order until the queue is empty or the
+        next event is after until."""
+        while self.__queue:
+            if until is not None and self.__queue[0][0] > until:
+                self.clock = until
+                return
+            self.clock, _, action = heapq.heappop(self.__queue)
+            action()
+
+    @staticmethod
+    def __split(url):
+        address = url.split('://', 1)[-1]
+        host, _, path = address.partition('/')
+        return host, '/' + path.split('?', 1)[0]
+
+    def request(self, source, url):
+        host, path = self.__split(url)
+        if host not in self.nodes:
+            return SimResponse(404, [])
+        if not self.reachable(source, host):
+            raise PeerUnavailable('{} is partitioned from {}'.format(
+                host, source))
+        return self.nodes[host].handle(path, None)
+
+    def send(self, source, url, payload):
+        host, path = self.__split(url)
+        if host not in self.nodes:
+            return SimResponse(404)
+        if not self.reachable(source, host):
+            raise PeerUnavailable('{} is partitioned from {}'.format(
+                host, source))
+        self.messages_sent += 1
+        if self.random.random() < self.loss:
+            self.messages_lost += 1
+            return SimResponse(202)
+        # Blocs and submissions are shared between the nodes in memory, so
+        # hand over a copy like a real request would
+        payload = json.loads(json.dumps(payload))
+
+        def deliver():
+            if not self.reachable(source, host):
+                self.messages_lost += 1
+                return
+            response = self.nodes[host].handle(path, payload)
+            for hook in self.__delivery_hooks:
+                hook(source, host, path, response)
+
+        self.schedule(self.latency + self.random.uniform(0, self.jitter),
+                      deliver)
+        return SimResponse(202)
+
+
+class Simulation:
+    """Drives synthetic vote load through a SimNetwork and measures bloc
+    propagation, forks, conflict resolutions and throughput.
+
+    Attributes:
+        :network: The simulated network.
+        :voters: The ballots of the synthetic voters.
+    """
+
+    def __init__(self, size, voters, network):
+        self.network = network
+        self.voters = voters
+        self.__mined = {}
+        self.__arrivals = {}
+        self.resolves = 0
+        self.reorgs = 0
+        self.submitted = 0
+        self.accepted = 0
+        self.__submit_seconds = 0.0
+        # Bloc timestamps follow the virtual clock, stretched in run so that
+        # the simulated bloc interval counts as TARGET_INTERVAL and the
+        # difficulty stays put
+        self.__epoch = time.time()
+        self.__time_scale = 1.0
+        genesis_chain = self.__genesis_chain()
+        for number in range(size):
+            address = 'node{}'.format(number)
+            ballot = Ballot(address)
+            ballot.create_keys()
+            peers = PeerManager(max_backoff=PEER_MAX_BACKOFF,
+                                clock=lambda: network.clock)
+            blocchain = Blocchain(ballot.public_key, address,
+                                  InMemoryTransport(network, address),
+                                  peers=peers, clock=self.__bloc_clock)
+            blocchain.chain = genesis_chain[:]
+            blocchain.add_listener(self.__recorder(address, blocchain))
+            network.add_node(SimNode(address, ballot, blocchain))
+        for node in network.nodes.values():
+            for peer in network.nodes:
+                if peer != node.address:
+                    node.blocchain.add_peer_node(peer)
+        network.on_delivery(self.__on_delivery)
+
+    def __genesis_chain(self):
+        """Returns the genesis bloc and a bloc which grants every synthetic
+        voter the right to vote once."""
+        genesis_bloc = Bloc(0, '', [], GENESIS_PROOF, GENESIS_TIMESTAMP)
+        zero = (genesis_bloc.timestamp - time.time()) // genesis_bloc.proof
+        grants = [Submission('STATION', voter.public_key, zero, '', 1)
+                  for voter in self.voters]
+        last_hash = hash_bloc(genesis_bloc)
+        proof = 0
+        while not Verification.valid_proof(grants[:-1], last_hash, proof,
+                                           DEFAULT_DIFFICULTY):
+            proof += 1
+        return [genesis_bloc, Bloc(1, last_hash, grants, proof, self.__epoch,
+                                   DEFAULT_DIFFICULTY)]
+
+    def __bloc_clock(self):
+        return self.__epoch + self.network.clock * self.__time_scale
+
+    def __recorder(self, address, blocchain):
+        def record(event, data):
+            if event == 'bloc':
+                blocs = [data['bloc']]
+                if data['source'] == 'local':
+                    self.__mined[hash_bloc(data['bloc'])] = self.network.clock
+            elif event == 'chain':
+                blocs = blocchain.chain[data['fork']:]
+            else:
+                return
+            for bloc in blocs:
+                self.__arrivals.setdefault(hash_bloc(bloc), {}).setdefault(
+                    address, self.network.clock)
+        return record
+
+    def __on_delivery(self, source, target, path, response):
+        if path != '/broadcast-bloc':
+            return
+        if response.json() == 'reorganised':
+            self.reorgs += 1
+        # Mirrors what mine_bloc does with the answer of a peer
+        if response.status_code == 409:
+            self.network.nodes[source].blocchain.resolve_conflicts = True
+
+    def __submit(self):
+        if not self.voters:
+            return
+        voter = self.voters.pop()
+        node = self.network.random.choice(list(self.network.nodes.values()))
+        candidate = self.network.random.choice(
+            list(self.network.nodes.values())).ballot.public_key
+        zero = node.blocchain.submission_zero()
+        signature = voter.sign_submission(voter.public_key, candidate,
+                                          zero, 1)
+        self.submitted += 1
+        started = time.time()
+        if node.blocchain.add_submission(candidate, voter.public_key, zero,
+                                         signature, 1):
+            self.accepted += 1
+        self.__submit_seconds += time.time() - started
+
+    def __mine(self, node):
+        if node.blocchain.resolve_conflicts:
+            node.blocchain.resolve()
+            self.resolves += 1
+        node.blocchain.mine_bloc()
+
+    def __repeat(self, rate, action, until):
+        """Schedules action at exponentially distributed intervals."""
+        def step():
+            action()
+            delay = self.network.random.expovariate(rate)
+            if self.network.clock + delay <= until:
+                self.network.schedule(delay, step)
+        self.network.schedule(self.network.random.expovariate(rate), step)
+
+    def run(self, duration, vote_rate, bloc_interval,
+            partition_at=None, heal_at=None):
+        """Runs the simulation and returns its report.
+
+        Arguments:
+            :duration: Virtual seconds of vote load and mining.
+            :vote_rate: Submissions per virtual second.
+            :bloc_interval: Average virtual seconds between two blocs of the
+            whole network.
+            :partition_at: Fraction of the duration at which the network is
+            split in two halves (optional).
+            :heal_at: Fraction of the duration at which the split is healed.
+        """
+        nodes = list(self.network.nodes.values())
+        self.__time_scale = TARGET_INTERVAL / bloc_interval
+        self.__repeat(vote_rate, self.__submit, duration)
+        for node in nodes:
+            self.__repeat(1.0 / (bloc_interval * len(nodes)),
+                          lambda node=node: self.__mine(node), duration)
+        if partition_at is not None:
+            half = len(nodes) // 2
+            self.network.schedule(
+                partition_at * duration,
+                lambda: self.network.partition(
+                    [node.address for node in nodes[:half]],
+                    [node.address for node in nodes[half:]]))
+            self.network.schedule((heal_at or 1.0) * duration,
+                                  self.network.heal)
+        started = time.time()
+        self.network.run(until=duration)
+        # Let the last messages arrive
+        self.network.heal()
+        self.network.run()
+        for node in nodes:
+            if node.blocchain.resolve_conflicts:
+                node.blocchain.resolve()
+                self.resolves += 1
+        self.network.run()
+        converged = self.__converged(nodes)
+        # Peers which failed during a partition are only retried after
+        # their backoff
+        self.network.clock += PEER_MAX_BACKOFF
+        # Nodes which missed a bloc only catch up by resolving, like an
+        # operator pressing "Resolve Conflicts"
+        for node in nodes:
+            node.blocchain.resolve()
+        report = self.__report(nodes, duration, time.time() - started)
+        report['consensus_before_settle'] = converged
+        return report
+
+    @staticmethod
+    def __converged(nodes):
+        return len(set(hash_bloc(node.blocchain.chain[-1])
+                       for node in nodes)) == 1
+
+    def __report(self, nodes, duration, wall_seconds):
+        final_chain = max((node.blocchain.chain for node in nodes), key=len)
+        final_hashes = set(hash_bloc(bloc) for bloc in final_chain)
+        included = sum(len(bloc.submissions) - 1
+                       for bloc in final_chain[2:])
+        propagation = []
+        for bloc_hash, mined_at in self.__mined.items():
+            arrivals = self.__arrivals.get(bloc_hash, {})
+            if len(arrivals) == len(nodes):
+                propagation.append(max(arrivals.values()) - mined_at)
+        mined = len(self.__mined)
+        return {
+            'nodes': len(nodes),
+            'virtual_seconds': duration,
+            'wall_seconds': wall_seconds,
+            'blocs_mined': mined,
+            'blocs_in_final_chain': len(final_chain) - 2,
+            'fork_rate': (len([h for h in self.__mined
+                               if h not in final_hashes]) / mined
+                          if mined else 0.0),
+            'consensus': self.__converged(nodes),
+            'propagation_seconds': percentiles(propagation),
+            'fully_propagated': len(propagation),
+            'resolves': self.resolves,
+            'reorgs': self.reorgs,
+            'submissions_sent': self.submitted,
+            'submissions_accepted': self.accepted,
+            'submissions_included': included,
+            'included_per_virtual_second': included / duration,
+            'accepted_per_wall_second': (
+                self.accepted / self.__submit_seconds
+                if self.__submit_seconds else None),
+            'messages_sent': self.network.messages_sent,
+            'messages_lost': self.network.messages_lost
+        }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[3, 5, 8],
+                        help='network sizes to simulate')
+    parser.add_argument('--voters', type=int, default=40)
+    parser.add_argument('--duration', type=float, default=120.0)
+    parser.add_argument('--vote-rate', type=float, default=0.3,
+                        help='submissions per virtual second')
+    parser.add_argument('--bloc-interval', type=float, default=10.0)
+    parser.add_argument('--latency', type=float, default=0.1)
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--partition-at', type=float, default=None)
+    parser.add_argument('--heal-at', type=float, default=None)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    voter_ballots = []
+    for number in range(args.voters):
+        voter_ballot = Ballot('voter{}'.format(number))
+        voter_ballot.create_keys()
+        voter_ballots.append(voter_ballot)
+    reports = []
+    # The nodes write their data files to the working directory
+    with tempfile.TemporaryDirectory() as data_dir:
+        cwd = os.getcwd()
+        os.chdir(data_dir)
+        try:
+            for size in args.sizes:
+                network = SimNetwork(args.latency, args.jitter, args.loss,
+                                     args.seed)
+                simulation = Simulation(size, voter_ballots[:], network)
+                reports.append(simulation.run(
+                    args.duration, args.vote_rate, args.bloc_interval,
+                    args.partition_at, args.heal_at))
+        finally:
+            os.chdir(cwd)
+    print(json.dumps(reports, indent=2))
@@ -0,0 +1,151 @@
+"""Checks the pool limits, the rate limits and the 429 answers of the node
+(python -m pytest tests)."""
+
+import os
+import tempfile
+import time
+import unittest
+
+import node
+from admission import AdmissionControl, RateLimiter
+from ballot import Ballot
+from elections import Election, FairPool
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_burst_then_wait(self):
+        limiter = RateLimiter(rate=20.0, burst=2)
+        self.assertEqual(limiter.acquire('voter'), 0)
+        self.assertEqual(limiter.acquire('voter'), 0)
+        wait = limiter.acquire('voter')
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 1 / 20.0)
+        # Other keys have their own bucket
+        self.assertEqual(limiter.acquire('other'), 0)
+        time.sleep(wait + 0.01)
+        self.assertEqual(limiter.acquire('voter'), 0)
+
+    def test_peeking_takes_no_token(self):
+        limiter = RateLimiter(rate=0.001, burst=1)
+        for _ in range(3):
+            self.assertEqual(limiter.acquire('voter', take=False), 0)
+        self.assertEqual(limiter.acquire('voter'), 0)
+        self.assertGreater(limiter.acquire('voter', take=False), 0)
+
+    def test_least_recently_used_buckets_are_dropped(self):
+        limiter = RateLimiter(rate=0.001, burst=1, max_keys=2)
+        limiter.acquire('a')
+        limiter.acquire('b')
+        limiter.acquire('c')
+        # 'a' was forgotten and starts with a full bucket again
+        self.assertEqual(limiter.acquire('a'), 0)
+        self.assertGreater(limiter.acquire('c'), 0)
+
+
+class AdmissionControlTest(unittest.TestCase):
+
+    def test_full_pool_is_rejected(self):
+        admission = AdmissionControl(max_submissions=2, retry_after=7)
+        self.assertIsNone(admission.check(1, 0, 'voter', 'candidate', 'sig'))
+        self.assertEqual(admission.check(2, 0, 'voter', 'candidate', 'sig'),
+                         (7, 'Submission pool is full.'))
+        self.assertEqual(admission.rejected, 1)
+
+    def test_pool_bytes_are_limited(self):
+        size = AdmissionControl.size_of('voter', 'candidate', 'sig')
+        admission = AdmissionControl(max_bytes=10 * size)
+        self.assertIsNone(
+            admission.check(0, 9 * size, 'voter', 'candidate', 'sig'))
+        self.assertIsNotNone(
+            admission.check(0, 9 * size + 1, 'voter', 'candidate', 'sig'))
+
+    def test_peer_rate_is_limited(self):
+        admission = AdmissionControl(peer_rate=0.5, peer_burst=2,
+                                     voter_rate=None)
+        for voter in ('a', 'b'):
+            self.assertIsNone(admission.check(0, 0, voter, 'candidate',
+                                              'sig', peer='10.0.0.1'))
+        retry_after, message = admission.check(0, 0, 'c', 'candidate',
+                                               'sig', peer='10.0.0.1')
+        self.assertEqual(message, 'Too many submissions from this peer.')
+        # Whole seconds, rounded up (2 seconds per token)
+        self.assertEqual(retry_after, 2)
+        self.assertIsNone(admission.check(0, 0, 'c', 'candidate', 'sig',
+                                          peer='10.0.0.2'))
+        # Local submissions aren't limited per peer
+        self.assertIsNone(admission.check(0, 0, 'c', 'candidate', 'sig'))
+
+    def test_only_accepted_submissions_count_for_the_voter(self):
+        admission = AdmissionControl(peer_rate=None, voter_rate=0.001,
+                                     voter_burst=2)
+        # Rejected junk under the voter's key doesn't lock the voter out
+        for _ in range(5):
+            self.assertIsNone(admission.check(0, 0, 'voter', 'candidate',
+                                              'sig'))
+        admission.record_accepted('voter')
+        admission.record_accepted('voter')
+        retry_after, message = admission.check(0, 0, 'voter', 'candidate',
+                                               'sig')
+        self.assertEqual(message, 'Too many submissions from this voter.')
+        self.assertGreater(retry_after, 0)
+
+
+class NodeAdmissionTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.voter = Ballot('voter')
+        cls.voter.create_keys()
+
+    def setUp(self):
+        # The node writes its data files to the working directory
+        self.cwd = os.getcwd()
+        self.data_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.data_dir.name)
+        self.pool = FairPool(1)
+        self.client = node.app.test_client()
+
+    def tearDown(self):
+        node.default_election.blocchain.persistence.stop()
+        node.default_election = None
+        self.pool.shutdown()
+        os.chdir(self.cwd)
+        self.data_dir.cleanup()
+
+    def start(self, **admission_options):
+        node.default_election = Election(
+            None, 0, admission_options=admission_options, pool=self.pool)
+        node.default_election.load()
+
+    def submission(self, candidate='candidate'):
+        zero = node.default_election.blocchain.submission_zero()
+        return {'voter': self.voter.public_key, 'candidate': candidate,
+                'zero': zero, 'amount': 1,
+                'signature': self.voter.sign_submission(
+                    self.voter.public_key, candidate, zero, 1)}
+
+    def test_full_pool_answers_429(self):
+        self.start(max_submissions=0, retry_after=9)
+        response = self.client.post('/broadcast-submission',
+                                    json=self.submission())
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '9')
+        self.assertEqual(response.get_json()['message'],
+                         'Submission pool is full.')
+
+    def test_peer_over_its_rate_answers_429(self):
+        self.start(peer_rate=0.01, peer_burst=1, voter_rate=None)
+        # Without a right to vote the first one fails the balance check
+        response = self.client.post('/broadcast-submission',
+                                    json=self.submission('first'))
+        self.assertEqual(response.status_code, 500)
+        response = self.client.post('/broadcast-submission',
+                                    json=self.submission('second'))
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response.headers['Retry-After']), 0)
+        self.assertEqual(node.default_election.admission.rejected, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+"""Checks how finalised blocs roll into archive segments, how they are read
+back and that damaged segments are refused (python -m pytest tests)."""
+
+import os
+import tempfile
+import unittest
+
+from archive import ArchiveError, SegmentArchive
+from ballot import Ballot
+from bloc import Bloc
+from blocchain import HOT_BLOCS, Blocchain
+from submission import Submission
+from utility.hash_util import hash_bloc
+
+START = 1600000000.0
+
+
+def chain(blocs, branch=''):
+    """Returns a chain of blocs (their proofs aren't searched); chains of
+    another branch share only the genesis bloc."""
+    result = [Bloc(0, '', [], 86400, 1577836799)]
+    for index in range(1, blocs):
+        submissions = [Submission('STATION', 'candidate' + branch, -200.0,
+                                  '', 0)]
+        result.append(Bloc(index, hash_bloc(result[-1]), submissions, index,
+                           START + index, 8))
+    return result
+
+
+def hashes(blocs):
+    return [hash_bloc(bloc) for bloc in blocs]
+
+
+class SegmentArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.data_dir.name, 'segments')
+
+    def tearDown(self):
+        self.data_dir.cleanup()
+
+    def test_roll_archives_full_segments_and_keeps_the_hot_tail(self):
+        archive = SegmentArchive(self.directory, segment_size=10)
+        blocs = chain(34)
+        # 34 blocs with a hot tail of 5 leave room for 2 full segments
+        self.assertEqual(archive.roll(blocs, 5), 20)
+        self.assertEqual(len(archive), 20)
+        self.assertEqual(archive.tip_hash(), hash_bloc(blocs[19]))
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['index.json', 'seg-00000000.zlib',
+                          'seg-00000010.zlib'])
+        # Nothing changes until the next segment and the hot tail are full
+        self.assertEqual(archive.roll(blocs, 5), 20)
+        self.assertEqual(archive.roll(chain(35), 5), 30)
+
+    def test_blocs_read_back_unchanged(self):
+        blocs = chain(30)
+        for codec in ('zlib', 'lzma'):
+            directory = os.path.join(self.directory, codec)
+            SegmentArchive(directory, segment_size=10, codec=codec).roll(
+                blocs, 0)
+            # A new instance only knows what the index on disk says
+            archive = SegmentArchive(directory)
+            self.assertEqual(len(archive), 30)
+            read_blocs = list(archive.iter_blocs())
+            self.assertEqual(hashes(read_blocs), hashes(blocs))
+            self.assertEqual(read_blocs[-1].difficulty, 8)
+
+    def test_damaged_segment_fails_its_checksum(self):
+        archive = SegmentArchive(self.directory, segment_size=10)
+        archive.roll(chain(20), 0)
+        path = os.path.join(self.directory, archive.segments[1]['file'])
+        with open(path, mode='r+b') as f:
+            data = bytearray(f.read())
+            data[len(data) // 2] ^= 0xff
+            f.seek(0)
+            f.write(data)
+        self.assertEqual(len(archive.read_segment(archive.segments[0])), 10)
+        with self.assertRaises(ArchiveError):
+            list(archive.iter_blocs())
+
+    def test_missing_segment_is_an_archive_error(self):
+        archive = SegmentArchive(self.directory, segment_size=10)
+        archive.roll(chain(10), 0)
+        os.remove(os.path.join(self.directory, archive.segments[0]['file']))
+        with self.assertRaises(ArchiveError):
+            list(archive.iter_blocs())
+
+    def test_replaced_chain_drops_the_segments_it_no_longer_matches(self):
+        archive = SegmentArchive(self.directory, segment_size=10)
+        blocs = chain(30)
+        archive.roll(blocs, 0)
+        # Only the last segment differs from the new branch
+        branch = blocs[:20]
+        for index in range(20, 40):
+            branch.append(Bloc(index, hash_bloc(branch[-1]), [], 0,
+                               START + index, 8))
+        self.assertEqual(archive.roll(branch, 0), 40)
+        self.assertEqual(hashes(archive.iter_blocs()), hashes(branch))
+        # Another branch forking after genesis keeps no old segment
+        other = chain(15, 'other')
+        self.assertEqual(archive.roll(other, 5), 10)
+        self.assertEqual(hashes(archive.iter_blocs()), hashes(other[:10]))
+
+    def test_truncate_drops_whole_segments(self):
+        archive = SegmentArchive(self.directory, segment_size=10)
+        archive.roll(chain(30), 0)
+        archive.truncate(25)
+        self.assertEqual(len(archive), 20)
+        self.assertNotIn('seg-00000020.zlib', os.listdir(self.directory))
+        self.assertEqual(len(SegmentArchive(self.directory)), 20)
+
+
+class BlocchainArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        # The nodes write their data files to the working directory
+        self.cwd = os.getcwd()
+        self.data_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.data_dir.name)
+        self.ballot = Ballot('miner')
+        self.ballot.create_keys()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.data_dir.cleanup()
+
+    def node(self):
+        return Blocchain(self.ballot.public_key, 'archive')
+
+    def test_chain_is_rebuilt_from_segments_and_data_file(self):
+        blocchain = self.node()
+        blocs = chain(HOT_BLOCS + blocchain.archive.segment_size + 7)
+        blocchain.chain = blocs
+        self.assertTrue(blocchain.persistence.wait(blocchain.save_data()))
+        blocchain.persistence.stop()
+        self.assertEqual(len(blocchain.archive),
+                         blocchain.archive.segment_size)
+        reloaded = self.node()
+        self.assertEqual(hashes(reloaded.chain), hashes(blocs))
+        reloaded.persistence.stop()
+
+    def test_damaged_archive_stops_the_load(self):
+        blocchain = self.node()
+        blocchain.chain = chain(HOT_BLOCS + blocchain.archive.segment_size)
+        self.assertTrue(blocchain.persistence.wait(blocchain.save_data()))
+        blocchain.persistence.stop()
+        segment = blocchain.archive.segments[0]
+        with open(os.path.join(blocchain.archive.directory,
+                               segment['file']), mode='ab') as f:
+            f.write(b'\0')
+        # Starting with only the hot tail would overwrite the data file
+        with self.assertRaises(ArchiveError):
+            self.node()
+
+
+if __name__ == '__main__':
+    unittest.main()
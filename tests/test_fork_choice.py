@@ -0,0 +1,118 @@
+"""Checks how a node answers broadcast blocs: buffering, orphans connecting
+to the tip and reorganisations (python -m pytest tests)."""
+
+import os
+import tempfile
+import unittest
+
+from ballot import Ballot
+from blocchain import MAX_REORG_DEPTH, Blocchain
+from utility.hash_util import hash_bloc
+from utility.verification import DEFAULT_DIFFICULTY
+
+
+class StubTransport:
+    """Answers the requests mine_bloc sends without any network."""
+
+    class Response:
+        status_code = 200
+
+        def json(self):
+            return {}
+
+    def get(self, url, **kwargs):
+        return self.Response()
+
+    def post(self, url, **kwargs):
+        return self.Response()
+
+
+def as_dict(bloc):
+    """Returns a bloc the way /broadcast-bloc receives it."""
+    converted_bloc = bloc.__dict__.copy()
+    converted_bloc['submissions'] = [
+        tx.__dict__ for tx in converted_bloc['submissions']]
+    return converted_bloc
+
+
+class ForkChoiceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.ballot = Ballot('miner')
+        cls.ballot.create_keys()
+
+    def setUp(self):
+        # The nodes write their data files to the working directory
+        self.cwd = os.getcwd()
+        self.data_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.data_dir.name)
+        self.nodes = 0
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.data_dir.cleanup()
+
+    def node(self):
+        self.nodes += 1
+        return Blocchain(self.ballot.public_key, 'node{}'.format(self.nodes),
+                         StubTransport())
+
+    @staticmethod
+    def mine(blocchain, count):
+        return [blocchain.mine_bloc() for _ in range(count)]
+
+    def test_orphans_connect_when_their_parent_arrives(self):
+        local, peer = self.node(), self.node()
+        blocs = self.mine(peer, 3)
+        self.assertEqual(local.receive_bloc(as_dict(blocs[2])), 'buffered')
+        self.assertEqual(local.receive_bloc(as_dict(blocs[1])), 'buffered')
+        self.assertEqual(len(local.chain), 1)
+        self.assertEqual(local.receive_bloc(as_dict(blocs[0])), 'added')
+        self.assertEqual(len(local.chain), 4)
+        self.assertFalse(local.resolve_conflicts)
+
+    def test_sibling_is_buffered_and_wins_once_longer(self):
+        local, peer = self.node(), self.node()
+        self.mine(local, 1)
+        siblings = self.mine(peer, 2)
+        # A one bloc race is no conflict, the sibling waits for its branch
+        self.assertEqual(local.receive_bloc(as_dict(siblings[0])),
+                         'buffered')
+        self.assertEqual(local.receive_bloc(as_dict(siblings[0])), 'known')
+        self.assertEqual(local.receive_bloc(as_dict(siblings[1])),
+                         'reorganised')
+        self.assertEqual(hash_bloc(local.chain[-1]),
+                         hash_bloc(peer.chain[-1]))
+        self.assertEqual(local.receive_bloc(as_dict(siblings[1])), 'known')
+
+    def test_blocs_claiming_a_wrong_difficulty_are_invalid(self):
+        local, peer = self.node(), self.node()
+        bloc = as_dict(self.mine(peer, 1)[0])
+        for difficulty in (300, 0, -1, None):
+            bloc['difficulty'] = difficulty
+            self.assertEqual(local.receive_bloc(dict(bloc)), 'invalid')
+            self.assertFalse(local.add_bloc(dict(bloc)))
+        self.assertEqual(len(local.chain), 1)
+        # Far ahead, a bloc needs the work its height and time can ask for
+        self.mine(local, 1)
+        bloc.update(index=500, difficulty=1)
+        self.assertEqual(local.receive_bloc(dict(bloc)), 'invalid')
+        self.assertFalse(local.resolve_conflicts)
+        bloc['difficulty'] = DEFAULT_DIFFICULTY
+        self.assertEqual(local.receive_bloc(dict(bloc)), 'resolve')
+        self.assertTrue(local.resolve_conflicts)
+
+    def test_branches_forking_too_deep_are_stale(self):
+        local, peer = self.node(), self.node()
+        self.mine(local, MAX_REORG_DEPTH + 1)
+        tip = local.chain[-1]
+        blocs = self.mine(peer, MAX_REORG_DEPTH + 3)
+        answers = [local.receive_bloc(as_dict(bloc)) for bloc in blocs]
+        self.assertEqual(answers[0], 'stale')
+        self.assertNotIn('reorganised', answers)
+        self.assertIs(local.chain[-1], tip)
+
+
+if __name__ == '__main__':
+    unittest.main()
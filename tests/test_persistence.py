@@ -0,0 +1,128 @@
+"""Checks when the durability modes write and what they acknowledge
+(python -m pytest tests)."""
+
+import os
+import tempfile
+import threading
+import unittest
+
+from ballot import Ballot
+from blocchain import Blocchain
+from persistence import PersistenceWorker
+from utility.hash_util import hash_bloc
+
+
+class Disk:
+    """Counts the writes and fails them while broken is set."""
+
+    def __init__(self):
+        self.writes = 0
+        self.broken = False
+        self.lock = threading.Lock()
+
+    def save(self):
+        with self.lock:
+            self.writes += 1
+            return not self.broken
+
+
+class PersistenceWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.disk = Disk()
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def worker(self, mode, **options):
+        worker = PersistenceWorker(self.disk.save, mode, **options)
+        self.workers.append(worker)
+        return worker
+
+    def test_unknown_mode_is_refused(self):
+        with self.assertRaises(ValueError):
+            PersistenceWorker(self.disk.save, 'eventually')
+
+    def test_sync_writes_every_change_right_away(self):
+        worker = self.worker('sync')
+        for _ in range(3):
+            worker.request()
+            self.assertTrue(worker.wait())
+        self.assertEqual(self.disk.writes, 3)
+
+    def test_group_writes_changes_together(self):
+        worker = self.worker('group', window=0.2)
+        tickets = [worker.request() for _ in range(5)]
+        self.assertTrue(worker.wait(tickets[-1], timeout=5))
+        self.assertTrue(worker.wait(tickets[0], timeout=5))
+        self.assertEqual(self.disk.writes, 1)
+        self.assertEqual(worker.get_stats()['pending'], 0)
+
+    def test_periodic_doesnt_wait_and_flushes_on_stop(self):
+        worker = self.worker('periodic', interval=60)
+        worker.request()
+        self.assertTrue(worker.wait(timeout=0))
+        self.assertEqual(self.disk.writes, 0)
+        worker.stop()
+        self.assertEqual(self.disk.writes, 1)
+
+    def test_failed_sync_write_is_not_acknowledged(self):
+        worker = self.worker('sync')
+        self.disk.broken = True
+        ticket = worker.request()
+        self.assertFalse(worker.wait(ticket))
+        self.assertEqual(worker.get_stats()['failures'], 1)
+        self.assertEqual(worker.get_stats()['pending'], 1)
+        # The next write saves the change which failed as well
+        self.disk.broken = False
+        worker.request()
+        self.assertTrue(worker.wait(ticket))
+
+    def test_failed_group_write_is_not_acknowledged_and_retried(self):
+        worker = self.worker('group', window=0.01, interval=0.05)
+        self.disk.broken = True
+        ticket = worker.request()
+        self.assertFalse(worker.wait(ticket, timeout=5))
+        self.disk.broken = False
+        worker.flush()
+        self.assertTrue(worker.wait(ticket, timeout=5))
+        self.assertEqual(worker.get_stats()['pending'], 0)
+
+
+class BlocStoreFollowsChainTest(unittest.TestCase):
+
+    class Transport:
+        class Response:
+            status_code = 200
+
+        def post(self, url, **kwargs):
+            return self.Response()
+
+    def setUp(self):
+        # The nodes write their data files to the working directory
+        self.cwd = os.getcwd()
+        self.data_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.data_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.data_dir.cleanup()
+
+    def test_mined_bloc_is_served_before_the_write(self):
+        ballot = Ballot('miner')
+        ballot.create_keys()
+        for mode in ('group', 'periodic'):
+            blocchain = Blocchain(ballot.public_key, mode, self.Transport(),
+                                  durability=mode, commit_window=60,
+                                  commit_interval=60)
+            bloc = blocchain.mine_bloc()
+            self.assertEqual(len(blocchain.bloc_store), 2)
+            self.assertEqual(blocchain.bloc_store.hash_at(1),
+                             hash_bloc(bloc))
+            blocchain.persistence.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
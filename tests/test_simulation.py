@@ -0,0 +1,61 @@
+"""Runs small simulated networks offline (python -m pytest tests)."""
+
+import os
+import tempfile
+import unittest
+
+from ballot import Ballot
+from simulation import SimNetwork, Simulation
+
+
+class SimulationTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.voters = []
+        for number in range(8):
+            ballot = Ballot('voter{}'.format(number))
+            ballot.create_keys()
+            cls.voters.append(ballot)
+
+    def setUp(self):
+        # The nodes write their data files to the working directory
+        self.cwd = os.getcwd()
+        self.data_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.data_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.data_dir.cleanup()
+
+    def simulate(self, size, duration, **options):
+        network = SimNetwork(seed=1, **options)
+        simulation = Simulation(size, self.voters[:], network)
+        return simulation.run(duration, vote_rate=0.3, bloc_interval=5.0)
+
+    def test_blocs_propagate_without_resolving(self):
+        report = self.simulate(3, 120.0)
+        # Agreement has to come from propagation and fork choice, not from
+        # the resolves run when the simulation settles
+        self.assertTrue(report['consensus_before_settle'])
+        self.assertEqual(report['resolves'], 0)
+        self.assertGreater(report['blocs_in_final_chain'], 10)
+        self.assertEqual(report['fully_propagated'],
+                         report['blocs_mined'])
+        self.assertLess(report['propagation_seconds']['p90'], 1.0)
+        self.assertLess(report['fork_rate'], 0.5)
+        self.assertGreater(report['submissions_included'], 0)
+        self.assertGreater(report['included_per_virtual_second'], 0)
+
+    def test_nodes_recover_from_lost_messages(self):
+        report = self.simulate(4, 120.0, latency=1.0, loss=0.1)
+        # Lost blocs are never asked for again, so the nodes only agree
+        # once the settling resolves fetched the full chains
+        self.assertGreater(report['messages_lost'], 0)
+        self.assertGreater(report['fully_propagated'], 0)
+        self.assertGreater(report['blocs_in_final_chain'], 0)
+        self.assertTrue(report['consensus'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+"""Checks the difficulty retargets, the timestamp rules, the bounds on the
+difficulty a bloc may claim and the parallel verification (python -m
+pytest tests)."""
+
+import unittest
+
+from benchmarks.verify_bench import valid_chain
+from bloc import Bloc
+from submission import Submission
+from utility.hash_util import hash_bloc
+from utility.verification import (DEFAULT_DIFFICULTY, MAX_DIFFICULTY,
+                                  MAX_FUTURE_DRIFT, MAX_RETARGET_STEP,
+                                  PARALLEL_MIN_BLOCS, RETARGET_INTERVAL,
+                                  Verification)
+
+GENESIS = Bloc(0, '', [], 86400, 1577836799)
+START = 1600000000.0
+
+
+def station():
+    return [Submission('STATION', 'candidate', -200.0, '', 0)]
+
+
+def chain(blocs, spacing, difficulty=DEFAULT_DIFFICULTY):
+    """Returns the genesis bloc and blocs mined every spacing seconds at
+    the given difficulty (their proofs aren't searched)."""
+    result = [GENESIS]
+    for index in range(1, blocs):
+        result.append(Bloc(index, hash_bloc(result[-1]), station(), 0,
+                           START + index * spacing, difficulty))
+    return result
+
+
+def mined(previous_bloc, timestamp, difficulty):
+    """Returns a bloc on top of previous_bloc with a valid proof."""
+    last_hash = hash_bloc(previous_bloc)
+    proof = 0
+    while not Verification.valid_proof([], last_hash, proof, difficulty):
+        proof += 1
+    return Bloc(previous_bloc.index + 1, last_hash, station(), proof,
+                timestamp, difficulty)
+
+
+class RetargetTest(unittest.TestCase):
+
+    def test_difficulty_holds_between_retargets(self):
+        blocs = chain(RETARGET_INTERVAL + 5, 1.0)
+        self.assertEqual(Verification.next_difficulty(blocs),
+                         DEFAULT_DIFFICULTY)
+
+    def test_fast_blocs_raise_the_difficulty(self):
+        blocs = chain(2 * RETARGET_INTERVAL, 1.0)
+        self.assertTrue(Verification.is_retarget_height(len(blocs)))
+        self.assertEqual(
+            Verification.next_difficulty(blocs[-RETARGET_INTERVAL:]),
+            DEFAULT_DIFFICULTY + MAX_RETARGET_STEP)
+
+    def test_slow_blocs_lower_the_difficulty(self):
+        blocs = chain(2 * RETARGET_INTERVAL, 1000.0)
+        self.assertEqual(
+            Verification.next_difficulty(blocs[-RETARGET_INTERVAL:]),
+            DEFAULT_DIFFICULTY - MAX_RETARGET_STEP)
+
+    def test_retarget_without_the_full_window_fails(self):
+        blocs = chain(2 * RETARGET_INTERVAL, 1.0)
+        bloc = mined(blocs[-1], blocs[-1].timestamp + 1,
+                     DEFAULT_DIFFICULTY + MAX_RETARGET_STEP)
+        self.assertIsNone(Verification.next_difficulty(blocs[-5:]))
+        self.assertFalse(Verification.verify_next(blocs[-5:], bloc,
+                                                  now=bloc.timestamp))
+        self.assertFalse(Verification.verify_bloc(blocs[-1], bloc))
+        self.assertTrue(Verification.verify_next(
+            blocs[-RETARGET_INTERVAL:], bloc, now=bloc.timestamp))
+
+    def test_blocs_after_genesis_record_a_difficulty(self):
+        blocs = chain(3, 1.0)
+        bloc = mined(blocs[-1], blocs[-1].timestamp + 1, None)
+        self.assertFalse(Verification.verify_next(blocs, bloc,
+                                                  now=bloc.timestamp))
+
+
+class TimestampTest(unittest.TestCase):
+
+    def setUp(self):
+        self.blocs = chain(30, 10.0)
+        self.median = Verification.median_time(self.blocs)
+
+    def test_timestamp_has_to_pass_the_median(self):
+        for timestamp, valid in ((self.median - 1, False),
+                                 (self.median, False),
+                                 (self.median + 1, True)):
+            bloc = mined(self.blocs[-1], timestamp, DEFAULT_DIFFICULTY)
+            self.assertEqual(
+                Verification.valid_timestamp(self.blocs, bloc, START + 1e6),
+                valid)
+
+    def test_timestamp_may_not_run_ahead(self):
+        now = self.blocs[-1].timestamp
+        bloc = mined(self.blocs[-1], now + MAX_FUTURE_DRIFT + 1,
+                     DEFAULT_DIFFICULTY)
+        self.assertFalse(Verification.valid_timestamp(self.blocs, bloc, now))
+        self.assertFalse(Verification.verify_next(self.blocs, bloc, now=now))
+        self.assertTrue(Verification.valid_timestamp(
+            self.blocs, bloc, now + 1))
+
+    def test_genesis_timestamp_is_ignored(self):
+        self.assertIsNone(Verification.median_time([GENESIS]))
+
+
+class DifficultyBoundsTest(unittest.TestCase):
+
+    def test_out_of_range_difficulties_are_no_valid_proof(self):
+        for difficulty in (0, -1, MAX_DIFFICULTY + 1, 300, 8.0, True, '8'):
+            self.assertFalse(
+                Verification.valid_proof([], 'hash', 0, difficulty),
+                difficulty)
+
+    def test_out_of_range_difficulty_fails_verification(self):
+        bloc = Bloc(1, hash_bloc(GENESIS), station(), 0, START, 300)
+        self.assertFalse(Verification.verify_bloc(GENESIS, bloc))
+
+    def test_work_decides_over_length(self):
+        cheap = chain(5, 1.0, difficulty=4)
+        heavy = chain(3, 1.0, difficulty=10)
+        self.assertGreater(Verification.chain_work(heavy),
+                           Verification.chain_work(cheap))
+
+
+class ParallelVerificationTest(unittest.TestCase):
+
+    def test_broken_pool_falls_back_to_in_process(self):
+        blocs = valid_chain(PARALLEL_MIN_BLOCS, 1, 2, 2, 1)
+        self.assertTrue(Verification.verify_chain(blocs, workers=2))
+        executor = Verification.pool(2)
+        # Like a worker killed for its memory
+        for process in list(executor._processes.values()):
+            process.kill()
+        self.assertTrue(Verification.verify_chain(blocs, workers=2))
+        self.assertIsNot(Verification.pool(2), executor)
+        self.assertTrue(Verification.verify_chain(blocs, workers=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
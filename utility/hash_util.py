@@ -1,6 +1,8 @@
 import hashlib as hl
 import json
 
+from utility.tracing import traced
+
 # __all__ = ['hash_string_256', 'hash_bloc']
 
 
@@ -13,6 +15,7 @@ def hash_string_256(string):
     return hl.sha256(string).hexdigest()
 
 
+@traced('hash_util.hash_bloc')
 def hash_bloc(bloc):
     """Hashes a bloc and returns a string representation of it.
 
@@ -20,6 +23,9 @@ def hash_bloc(bloc):
         :bloc: The bloc that should be hashed.
     """
     hashable_bloc = bloc.__dict__.copy()
+    # Blocs from before the difficulty was recorded keep their hashes
+    if hashable_bloc.get('difficulty') is None:
+        hashable_bloc.pop('difficulty', None)
     hashable_bloc['submissions'] = [
         tx.to_ordered_dict() for tx in hashable_bloc['submissions']
     ]
@@ -0,0 +1,116 @@
+"""Provides time-boxed profiling of a running node."""
+
+from collections import Counter
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+
+
+class ProfilerBusy(Exception):
+    """Raised when a capture is requested while another one runs."""
+
+
+class ProfileCapture:
+    """Captures a profile of a live node for a limited time.
+
+    Two modes are supported:
+        :cprofile: Every request which starts during the window is run
+        under cProfile (see begin_request and end_request) and the
+        results are merged.
+        :sample: A background thread samples the stacks of all threads.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__profiles = None
+
+    def begin_request(self):
+        """Returns a running cProfile.Profile if a capture is active (to be
+        passed to end_request), None otherwise."""
+        if self.__profiles is None:
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def end_request(self, profile):
+        """Stops a request's profile and adds it to the capture."""
+        if profile is None:
+            return
+        profile.disable()
+        profiles = self.__profiles
+        if profiles is not None:
+            profiles.append(profile)
+
+    def capture(self, seconds, mode='cprofile', limit=30, interval=0.005):
+        """Profiles the node for the given time and returns the report.
+
+        Arguments:
+            :seconds: How long the capture runs.
+            :mode: 'cprofile' or 'sample'.
+            :limit: The number of functions in the report.
+            :interval: Seconds between two samples (sample mode).
+        """
+        if not self.__lock.acquire(False):
+            raise ProfilerBusy('A capture is already running.')
+        try:
+            if mode == 'sample':
+                return self.__sample(seconds, limit, interval)
+            return self.__cprofile(seconds, limit)
+        finally:
+            self.__lock.release()
+
+    def __cprofile(self, seconds, limit):
+        self.__profiles = []
+        time.sleep(seconds)
+        profiles, self.__profiles = self.__profiles, None
+        if not profiles:
+            return {'mode': 'cprofile', 'seconds': seconds, 'requests': 0,
+                    'stats': ''}
+        stream = io.StringIO()
+        stats = pstats.Stats(profiles[0], stream=stream)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.sort_stats('cumulative').print_stats(limit)
+        return {'mode': 'cprofile', 'seconds': seconds,
+                'requests': len(profiles), 'stats': stream.getvalue()}
+
+    def __sample(self, seconds, limit, interval):
+        own_thread = threading.get_ident()
+        inclusive = Counter()
+        exclusive = Counter()
+        samples = 0
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                samples += 1
+                seen = set()
+                leaf = True
+                while frame is not None:
+                    code = frame.f_code
+                    location = '{}:{}({})'.format(
+                        code.co_filename, code.co_firstlineno, code.co_name)
+                    if leaf:
+                        exclusive[location] += 1
+                        leaf = False
+                    if location not in seen:
+                        inclusive[location] += 1
+                        seen.add(location)
+                    frame = frame.f_back
+            time.sleep(interval)
+        return {
+            'mode': 'sample',
+            'seconds': seconds,
+            'samples': samples,
+            'inclusive': inclusive.most_common(limit),
+            'exclusive': exclusive.most_common(limit)
+        }
+
+
+# The capture used by node.py
+profile_capture = ProfileCapture()
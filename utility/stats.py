@@ -0,0 +1,23 @@
+"""Provides small statistics helpers for node metrics."""
+
+import math
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """Return the nearest-rank percentiles of a list of samples as a
+    dictionary ({'p50': ..., 'p90': ..., 'p99': ...}).
+
+    Arguments:
+        :samples: The measured values.
+        :points: The percentiles which should be reported.
+    """
+    ordered = sorted(samples)
+    result = {}
+    for point in points:
+        key = 'p{}'.format(point)
+        if not ordered:
+            result[key] = None
+            continue
+        rank = int(math.ceil(point / 100.0 * len(ordered))) - 1
+        result[key] = ordered[max(rank, 0)]
+    return result
@@ -0,0 +1,161 @@
+"""Provides lightweight tracing spans to find out where a slow request spent
+its time.
+
+A trace is started per request (see node.py); code on the way marks its
+sections with span() or @traced(). Spans outside of a trace cost a single
+thread-local lookup. Traces slower than the threshold go to the sink.
+"""
+
+from contextlib import contextmanager
+import functools
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class LogSink:
+    """Writes slow traces to the log."""
+
+    def emit(self, trace):
+        logger.warning('Slow request %s took %.1f ms: %s', trace['name'],
+                       trace['duration_ms'], json.dumps(trace['totals_ms']))
+
+
+class JsonFileSink:
+    """Appends slow traces as JSON lines to a file.
+
+    Attributes:
+        :path: The file the traces are written to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+
+    def emit(self, trace):
+        line = json.dumps(trace)
+        with self.__lock:
+            try:
+                with open(self.path, mode='a') as f:
+                    f.write(line)
+                    f.write('\n')
+            except IOError:
+                logger.exception('Writing trace to %s failed', self.path)
+
+
+class Tracer:
+    """Collects the spans of the current thread's trace.
+
+    Attributes:
+        :sink: Receives the traces which are slower than the threshold.
+        :slow_threshold: Seconds a trace has to take to be emitted.
+    """
+
+    def __init__(self, sink=None, slow_threshold=0.5):
+        self.sink = sink or LogSink()
+        self.slow_threshold = slow_threshold
+
+    def start(self, name):
+        """Starts a trace for the current thread.
+
+        Arguments:
+            :name: The name of the trace (e.g. the request).
+        """
+        _local.trace = {'name': name, 'started': time.time(), 'spans': [],
+                        'depth': 0}
+
+    def current(self):
+        """Returns the trace of the current thread (None if none is
+        running), e.g. to continue it on another thread with attach."""
+        return getattr(_local, 'trace', None)
+
+    @contextmanager
+    def attach(self, trace):
+        """Records the spans of the enclosed code into a trace started on
+        another thread, which has to wait for the code to finish.
+
+        Arguments:
+            :trace: The trace returned by current() (None records nothing).
+        """
+        previous = getattr(_local, 'trace', None)
+        _local.trace = trace
+        try:
+            yield
+        finally:
+            _local.trace = previous
+
+    def finish(self):
+        """Ends the trace of the current thread, hands it to the sink if it
+        was slow and returns it (None if no trace was running)."""
+        trace = getattr(_local, 'trace', None)
+        if trace is None:
+            return None
+        _local.trace = None
+        duration = time.time() - trace['started']
+        totals = {}
+        for recorded_span in trace['spans']:
+            totals[recorded_span['name']] = (
+                totals.get(recorded_span['name'], 0) +
+                recorded_span['duration_ms'])
+        result = {
+            'name': trace['name'],
+            'started': trace['started'],
+            'duration_ms': duration * 1000,
+            'totals_ms': totals,
+            'spans': trace['spans']
+        }
+        if duration >= self.slow_threshold:
+            self.sink.emit(result)
+        return result
+
+
+# The tracer used by node.py
+tracer = Tracer()
+
+
+@contextmanager
+def span(name):
+    """Measures the enclosed code as part of the current trace.
+
+    Arguments:
+        :name: The name of the span.
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        yield
+        return
+    started = time.time()
+    depth = trace['depth']
+    trace['depth'] = depth + 1
+    try:
+        yield
+    finally:
+        trace['depth'] = depth
+        trace['spans'].append({
+            'name': name,
+            'start_ms': (started - trace['started']) * 1000,
+            'duration_ms': (time.time() - started) * 1000,
+            'depth': depth
+        })
+
+
+def traced(name):
+    """Decorator which runs a function inside a span.
+
+    Arguments:
+        :name: The name of the span.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if getattr(_local, 'trace', None) is None:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
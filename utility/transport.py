@@ -0,0 +1,48 @@
+"""Provides the transports a blocchain uses to talk to its peers.
+
+requests is imported on the first peer request rather than with the module,
+it takes longer to load than the rest of the node's imports.
+"""
+
+
+class PeerUnavailable(IOError):
+    """Raised by a transport when a peer can't be reached."""
+
+
+class HttpTransport:
+    """Sends peer requests over HTTP (the default transport).
+
+    Attributes:
+        :timeout: Seconds to wait for a peer (None waits forever).
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def get(self, url, **kwargs):
+        """Sends a GET request and returns the response.
+
+        Arguments:
+            :url: The URL of the peer endpoint.
+        """
+        import requests
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            return requests.get(url, **kwargs)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            raise PeerUnavailable(str(e))
+
+    def post(self, url, **kwargs):
+        """Sends a POST request and returns the response.
+
+        Arguments:
+            :url: The URL of the peer endpoint.
+        """
+        import requests
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            return requests.post(url, **kwargs)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            raise PeerUnavailable(str(e))
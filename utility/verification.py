@@ -1,16 +1,73 @@
 """Provides verification helper methods."""
 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from collections import deque
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+
 from utility.hash_util import hash_string_256, hash_bloc
+from utility.tracing import traced
+import ballot
 from ballot import Ballot
 
+logger = logging.getLogger(__name__)
+
+# Chains shorter than this are verified in-process, the pool only pays off
+# for longer ones
+PARALLEL_MIN_BLOCS = 200
+# Ranges per worker; small ranges let a failure cancel most of the work
+RANGES_PER_WORKER = 4
+# Seconds a parallel verification may take before the pool is given up on
+# and the chain is verified in-process
+PARALLEL_TIMEOUT = 600.0
+
+# Leading zero bits of the proof hash, the old two hex zeros are 8 bits
+DEFAULT_DIFFICULTY = 8
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 64
+# The difficulty is retargeted every RETARGET_INTERVAL blocs so that blocs
+# come TARGET_INTERVAL seconds apart
+RETARGET_INTERVAL = 20
+TARGET_INTERVAL = 30.0
+# The most bits one retarget may add or remove (a factor of 4 either way)
+MAX_RETARGET_STEP = 2
+# A bloc's timestamp has to be later than the median of this many blocs
+# before it...
+MEDIAN_TIME_BLOCS = 11
+# ... and may be at most this many seconds ahead of the verifying node
+MAX_FUTURE_DRIFT = 2 * TARGET_INTERVAL
+
+
+def _init_worker(cache_entries):
+    """Gives a worker process the signature cache size of the process
+    which started the pool."""
+    ballot.verified_signatures.max_entries = cache_entries
+
+
+def _verify_range(blocs, first, check_signatures, now):
+    """Verifies the blocs of a range from position first on; the blocs
+    before it only provide the link, the timestamps and the difficulty of
+    the first one (runs in the worker processes)."""
+    recent = deque(blocs[:first], maxlen=RETARGET_INTERVAL)
+    for bloc in blocs[first:]:
+        if recent and not Verification.verify_next(recent, bloc,
+                                                   check_signatures, now):
+            return False
+        recent.append(bloc)
+    return True
+
 
 class Verification:
     """A helper class which offer various static and class-based verification
     and validation methods."""
     @staticmethod
-    def valid_proof(submissions, last_hash, proof):
+    def valid_proof(submissions, last_hash, proof, difficulty=None):
         """Validate a proof by vote number and see if it solves the puzzle
-        algorithm (for now, two leading 0s)
+        algorithm (a hash with difficulty leading zero bits)
 
         Arguments:
             :submissions: The submissions in the bloc for which the proof
@@ -18,7 +75,15 @@ class Verification:
             :last_hash: The previous bloc's hash which will be stored in the
             current bloc.
             :proof: The proof number we're testing.
+            :difficulty: The leading zero bits required (None for the
+            genesis bloc, which doesn't record it: DEFAULT_DIFFICULTY).
+            Anything but an int from MIN_DIFFICULTY to MAX_DIFFICULTY is
+            no valid proof.
         """
+        if difficulty is None:
+            difficulty = DEFAULT_DIFFICULTY
+        if not Verification.valid_difficulty_value(difficulty):
+            return False
         # Create a string with all the hash inputs
         guess = (str([tx.to_ordered_dict() for tx in submissions]
                      ) + str(last_hash) + str(proof)).encode()
@@ -28,29 +93,298 @@ class Verification:
         # proof-of-work algorithm.
         guess_hash = hash_string_256(guess)
         # Only a hash (which is based on the above inputs) which starts with
-        # two 0s is treated as valid
-        # This condition is of course defined by you. You could also require
-        # 10 leading 0s - this would take significantly longer (and this
-        # allows you to control the speed at which new blocs can be added)
-        return guess_hash[0:2] == '00'
+        # enough 0 bits is treated as valid; every bit doubles the guesses
+        # needed (see next_difficulty)
+        return int(guess_hash, 16) >> (256 - difficulty) == 0
+
+    @staticmethod
+    def valid_difficulty_value(difficulty):
+        """Returns True if a difficulty (e.g. from a peer's JSON) is an int
+        within MIN_DIFFICULTY and MAX_DIFFICULTY."""
+        return (isinstance(difficulty, int) and
+                not isinstance(difficulty, bool) and
+                MIN_DIFFICULTY <= difficulty <= MAX_DIFFICULTY)
+
+    @staticmethod
+    def chain_work(blocs):
+        """Returns the work that went into the given blocs (the expected
+        number of guesses, 2 ** difficulty per bloc). Forks are decided by
+        it rather than by the number of blocs, which are cheap at low
+        difficulties. The genesis bloc doesn't count."""
+        return sum(2 ** bloc.difficulty for bloc in blocs
+                   if bloc.difficulty is not None)
+
+    @staticmethod
+    def is_retarget_height(index):
+        """Returns True if the difficulty may change at the bloc with this
+        index. The first window starts after the genesis bloc, whose
+        timestamp is day zero rather than the time it was made."""
+        return index > RETARGET_INTERVAL and index % RETARGET_INTERVAL == 0
+
+    @classmethod
+    def next_difficulty(cls, blocs):
+        """Returns the difficulty the bloc after the given ones has to
+        record, or None if that depends on blocs which weren't given.
+
+        At a retarget height the difficulty moves by the bits which bring
+        the time the last RETARGET_INTERVAL blocs took back to
+        TARGET_INTERVAL per bloc (at most MAX_RETARGET_STEP bits).
+
+        Arguments:
+            :blocs: The last blocs of the chain (a list or deque), at least
+            RETARGET_INTERVAL of them to answer at retarget heights.
+        """
+        parent = blocs[-1]
+        if parent.difficulty is None:
+            # Only the genesis bloc records none, the chain starts at the
+            # old fixed difficulty
+            return DEFAULT_DIFFICULTY
+        index = parent.index + 1
+        if not cls.is_retarget_height(index):
+            return parent.difficulty
+        if (len(blocs) < RETARGET_INTERVAL or
+                blocs[-RETARGET_INTERVAL].index != index - RETARGET_INTERVAL):
+            return None
+        span = parent.timestamp - blocs[-RETARGET_INTERVAL].timestamp
+        target = TARGET_INTERVAL * (RETARGET_INTERVAL - 1)
+        step = round(math.log2(target / max(span, 1e-3)))
+        step = max(-MAX_RETARGET_STEP, min(MAX_RETARGET_STEP, step))
+        return max(MIN_DIFFICULTY,
+                   min(MAX_DIFFICULTY, parent.difficulty + step))
+
+    @classmethod
+    def lowest_difficulty(cls, bloc, index, timestamp):
+        """Returns the lowest difficulty a bloc at the given index and
+        timestamp can record on a chain through the given bloc. Used for
+        blocs too far ahead to check their difficulty exactly.
+
+        Every retarget in between can remove MAX_RETARGET_STEP bits, but
+        only after a window which took more than sqrt(2) times the target,
+        so the time between the blocs limits those retargets too."""
+        difficulty = bloc.difficulty
+        if difficulty is None:
+            difficulty = DEFAULT_DIFFICULTY
+        retargets = sum(1 for height in range(bloc.index + 1, index + 1)
+                        if cls.is_retarget_height(height))
+        if bloc.index > 0:
+            slow_window = (TARGET_INTERVAL * (RETARGET_INTERVAL - 1) *
+                           math.sqrt(2))
+            # The window the bloc is part of may have been slow already
+            retargets = min(retargets, 1 + int(
+                max(timestamp - bloc.timestamp, 0) // slow_window))
+        return max(MIN_DIFFICULTY,
+                   difficulty - retargets * MAX_RETARGET_STEP)
+
+    @staticmethod
+    def valid_difficulty(bloc, expected):
+        """Checks the difficulty a bloc records; every bloc after the
+        genesis bloc has to record one.
+
+        Arguments:
+            :bloc: The bloc which should be checked.
+            :expected: The difficulty from next_difficulty (None, when the
+            blocs it depends on are missing, fails every bloc).
+        """
+        return (Verification.valid_difficulty_value(bloc.difficulty) and
+                expected is not None and bloc.difficulty == expected)
+
+    @staticmethod
+    def median_time(blocs):
+        """Returns the median timestamp of the last MEDIAN_TIME_BLOCS blocs
+        (None if there are none). The genesis bloc doesn't count, its
+        timestamp is day zero rather than the time it was made."""
+        timestamps = sorted(bloc.timestamp for bloc in
+                            list(blocs)[-MEDIAN_TIME_BLOCS:] if bloc.index > 0)
+        if not timestamps:
+            return None
+        return timestamps[len(timestamps) // 2]
+
+    @classmethod
+    def valid_timestamp(cls, blocs, bloc, now=None):
+        """Checks that a bloc's timestamp is later than the median of the
+        blocs before it and not more than MAX_FUTURE_DRIFT seconds ahead of
+        now, so miners can't bend the retarget with made up times.
+
+        Arguments:
+            :blocs: The last blocs of the chain before it.
+            :bloc: The bloc which should be checked.
+            :now: The current time (default: time.time()).
+        """
+        median = cls.median_time(blocs)
+        if median is not None and bloc.timestamp <= median:
+            return False
+        if now is None:
+            now = time.time()
+        return bloc.timestamp <= now + MAX_FUTURE_DRIFT
 
     @classmethod
-    def verify_chain(cls, blocchain):
+    def verify_bloc(cls, previous_bloc, bloc, check_signatures=False,
+                    difficulty=None):
+        """Verify a bloc's link to the previous bloc (hash and index), its
+        difficulty and its proof (and the signatures of its submissions if
+        asked to).
+
+        Arguments:
+            :previous_bloc: The bloc before it in the chain.
+            :bloc: The bloc which should be verified.
+            :check_signatures: Whether the voters' signatures are checked.
+            :difficulty: The expected difficulty (see next_difficulty); by
+            default what the previous bloc alone tells, which is nothing at
+            retarget heights (use verify_next there).
+        """
+        if difficulty is None:
+            difficulty = cls.next_difficulty([previous_bloc])
+        if bloc.previous_hash != hash_bloc(previous_bloc):
+            return False
+        if bloc.index != previous_bloc.index + 1:
+            logger.info('Bloc %s does not follow bloc %s', bloc.index,
+                        previous_bloc.index)
+            return False
+        if not cls.valid_difficulty(bloc, difficulty):
+            logger.info('Difficulty of bloc %s is invalid', bloc.index)
+            return False
+        if not cls.valid_proof(bloc.submissions[:-1],
+                               bloc.previous_hash,
+                               bloc.proof,
+                               bloc.difficulty):
+            logger.info('Proof by vote is invalid')
+            return False
+        if check_signatures and not Ballot.verify_submissions(
+                [tx for tx in bloc.submissions if tx.voter != 'STATION']):
+            logger.info('Signature in bloc %s is invalid', bloc.index)
+            return False
+        return True
+
+    @classmethod
+    def verify_next(cls, blocs, bloc, check_signatures=False, now=None):
+        """Verifies a bloc on top of the last blocs of a chain: its
+        timestamp, its difficulty and everything verify_bloc checks.
+
+        Arguments:
+            :blocs: The last blocs before it (RETARGET_INTERVAL of them, or
+            all blocs after the genesis bloc of a shorter chain).
+            :bloc: The bloc which should be verified.
+            :check_signatures: Whether the voters' signatures are checked.
+            :now: The current time (default: time.time()).
+        """
+        if not cls.valid_timestamp(blocs, bloc, now):
+            logger.info('Timestamp of bloc %s is invalid', bloc.index)
+            return False
+        return cls.verify_bloc(blocs[-1], bloc, check_signatures,
+                               cls.next_difficulty(blocs))
+
+    @classmethod
+    @traced('Verification.verify_chain')
+    def verify_chain(cls, blocchain, check_signatures=False, workers=None,
+                     abort=None, now=None):
         """ Verify the current blocchain and return True if it's valid, False
-        otherwise."""
-        for (index, bloc) in enumerate(blocchain):
-            if index == 0:
-                continue
-            if bloc.previous_hash != hash_bloc(blocchain[index - 1]):
+        otherwise.
+
+        Any iterable of blocs works, so archived segments can be verified
+        while they are read (e.g. itertools.chain(archive.iter_blocs(),
+        hot_blocs)). Long lists of blocs are split into ranges which are
+        verified by a pool of worker processes; the first invalid range
+        cancels the ranges which have not started yet.
+
+        Arguments:
+            :blocchain: The blocs to verify.
+            :check_signatures: Whether the voters' signatures are checked.
+            :workers: The number of worker processes (default: one per CPU,
+            1 verifies in-process).
+            :abort: An optional threading.Event which stops the
+            verification (the chain is then reported as invalid).
+            :now: The current time the timestamps are checked against
+            (default: time.time()).
+        """
+        if now is None:
+            now = time.time()
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if (workers > 1 and isinstance(blocchain, list) and
+                len(blocchain) >= PARALLEL_MIN_BLOCS):
+            return cls.__verify_parallel(blocchain, check_signatures,
+                                         workers, abort, now)
+        # The blocs the next timestamp and difficulty are checked against
+        recent = deque(maxlen=RETARGET_INTERVAL)
+        for bloc in blocchain:
+            if abort is not None and abort.is_set():
                 return False
-            if not cls.valid_proof(bloc.submissions[:-1],
-                                   bloc.previous_hash,
-                                   bloc.proof):
-                print('Proof by vote is invalid')
+            if recent and not cls.verify_next(recent, bloc,
+                                              check_signatures, now):
                 return False
+            recent.append(bloc)
         return True
 
+    __pools = {}
+    __pools_lock = threading.Lock()
+
+    @classmethod
+    def pool(cls, workers):
+        """Returns the (shared) process pool with the given number of
+        workers, starting it on first use.
+
+        The workers are spawned rather than forked: the pool is started
+        inside a node whose other threads may hold locks (logging, the
+        signature cache) at that moment, and a forked worker would inherit
+        them locked."""
+        with cls.__pools_lock:
+            executor = cls.__pools.get(workers)
+            if executor is None:
+                executor = ProcessPoolExecutor(
+                    workers, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(ballot.verified_signatures.max_entries,))
+                cls.__pools[workers] = executor
+            return executor
+
+    @classmethod
+    def __discard_pool(cls, workers, executor):
+        with cls.__pools_lock:
+            if cls.__pools.get(workers) is executor:
+                del cls.__pools[workers]
+        executor.shutdown(wait=False)
+
+    @classmethod
+    def __verify_parallel(cls, blocchain, check_signatures, workers, abort,
+                          now):
+        executor = cls.pool(workers)
+        size = -(-len(blocchain) // (workers * RANGES_PER_WORKER))
+        # Each range starts with the last RETARGET_INTERVAL blocs of the
+        # ones before, which its first timestamp and difficulty depend on
+        pending = set()
+        deadline = time.time() + PARALLEL_TIMEOUT
+        try:
+            for start in range(0, len(blocchain), size):
+                context = min(start, RETARGET_INTERVAL)
+                pending.add(executor.submit(
+                    _verify_range, blocchain[start - context:start + size],
+                    context, check_signatures, now))
+            while pending:
+                done, pending = wait(pending, timeout=0.1,
+                                     return_when=FIRST_COMPLETED)
+                if any(not future.result() for future in done):
+                    return False
+                if abort is not None and abort.is_set():
+                    return False
+                if pending and time.time() > deadline:
+                    logger.error('Parallel verification timed out, '
+                                 'verifying in-process')
+                    break
+            else:
+                return True
+        except Exception as e:
+            # E.g. BrokenProcessPool after a worker was killed, the pool
+            # fails every later job as well
+            logger.error('Parallel verification failed (%s), verifying '
+                         'in-process', e)
+        finally:
+            for future in pending:
+                future.cancel()
+        cls.__discard_pool(workers, executor)
+        return cls.verify_chain(blocchain, check_signatures, 1, abort, now)
+
     @staticmethod
+    @traced('Verification.verify_submission')
     def verify_submission(submission, get_balance, check_funds=True):
         """Verify a submission by checking whether the voter has the right.
 